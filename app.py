@@ -1,24 +1,36 @@
 # system imports
 import base64
+import functools
+import inspect
 import io
+import os
+import threading
 import time
 import uuid
 import json
-from tqdm.auto import tqdm
-from typing import Any, cast
+from typing import Any, Callable, cast
+
+IMPORT_STARTED_AT = time.perf_counter()
 
 # third party imports
-from flask import Flask, request, session, make_response, Response, render_template
-from flask_socketio import SocketIO, emit
+from dotenv import find_dotenv, load_dotenv
+from flask import Flask, g, request, session, make_response, Response, render_template
 from flask_cors import CORS
 from flask_executor import Executor
 from langchain_core.messages.base import messages_to_dict
-from langchain_community.chat_message_histories import SQLChatMessageHistory
 from werkzeug.datastructures import FileStorage
 
 # local imports
 from server_modules import set_logging_config
+from server_modules.admission import AdmissionController, AdmissionRejected
 from server_modules.methods import ServerMethods, ExperimentSessionMethods
+from server_modules.responses import OrjsonProvider, compression
+from server_modules.structured_logging import (
+    bind_log_context,
+    end_request_context,
+    job_progress,
+    start_request_context,
+)
 from server_modules.class_defs import (
     IdentifyResponse,
     Identity,
@@ -26,20 +38,38 @@ from server_modules.class_defs import (
     PromptResponse,
     ChatHistoryResponse,
     WEMUploadResponse,
+    UploadStatusResponse,
     SessionQueryResponse,	
+    SessionStatsResponse,
+    ChatModelStatsResponse,
+    AdmissionStatsResponse,
+    ProfilingStatusResponse,
 )
+from chatdoc.chat_history import NormalizedChatMessageHistory
 from chatdoc.chatbot import Chatbot
+from chatdoc.chat_router import get_router_stats
+from chatdoc.metrics import generate_metrics
+from chatdoc.profiling import profiler
+from chatdoc.tracing import (
+    configure_tracing,
+    current_trace_id,
+    end_request_span,
+    start_request_span,
+    with_trace_context,
+)
 from chatdoc.utils import Utils
 
-
+load_dotenv(find_dotenv())
 set_logging_config(Utils.get_env_variable("LOGGING_FILE_PATH"))
+configure_tracing()
 
 
 app = Flask(__name__)
 app.config["SESSION_COOKIE_SAMESITE"] = "None"
 app.config["SESSION_COOKIE_SECURE"] = True
 app.config['SECRET_KEY'] = 'secret!'
-socketio = SocketIO(app)
+app.json = OrjsonProvider(app)
+compression.init_app(app)
 
 current_env = Utils.get_env_variable("CURRENT_ENV")
 match current_env:
@@ -55,7 +85,12 @@ match current_env:
 
 app.secret_key = str(uuid.uuid4())
 sm_app = ServerMethods(app)
+admission = AdmissionController()
+# ingestion jobs keep the heavy slot of their upload request, so they never outnumber its slots
+app.config["EXECUTOR_MAX_WORKERS"] = admission.pools["heavy"].max_concurrency
 executor = Executor(app)
+DEBUG_SAMPLE_RATIO = float(os.environ.get("LOGGING_DEBUG_SAMPLE_RATIO", 0.01))
+app.logger.info("App imported in %.2f seconds", time.perf_counter() - IMPORT_STARTED_AT)
 
 Basic = str | int | float | bool
 Property = Basic | dict | tuple | list
@@ -81,7 +116,7 @@ def get_property(
         property_value = session[property_name]
     elif property_name in request.form:
         property_value = request.form[property_name]
-    elif (json_payload := request.json) is not None:
+    elif (json_payload := request.get_json(silent=True)) is not None:
         if isinstance(json_payload, dict) and property_name in json_payload:
             property_value = json.dumps(json_payload[property_name], ensure_ascii=False)
         elif isinstance(json_payload, list):
@@ -103,6 +138,161 @@ def get_property(
     return json.loads(property_value)
 
 
+def get_request_session_id() -> str:
+    """
+    Gets the session ID of a request for admission control, without raising if there is none.
+
+    Returns:
+        str: The session ID, or the address of the client if the request has no session ID.
+    """
+    json_payload = request.get_json(silent=True)
+    if isinstance(json_payload, dict) and "sessionId" in json_payload:
+        return str(json_payload["sessionId"])
+    session_id = request.form.get("sessionId") or request.args.get("sessionId")
+    return session_id or str(request.remote_addr)
+
+
+def is_request_thread() -> bool:
+    """
+    Whether this is the thread handling the request, rather than an executor job: jobs run in a
+    copy of the request context and g of the request that submitted them, so the teardown
+    functions also run when a job ends, where they must not release what the request holds.
+    """
+    return g.get("request_thread_id") == threading.get_ident()
+
+
+@app.before_request
+def start_log_context() -> None:
+    """
+    Binds the request ID (from the X-Request-ID header if the client sent one) and the session ID
+    to the records logged while handling the request.
+    """
+    g.request_thread_id = threading.get_ident()
+    g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    g.log_context_tokens = start_request_context(g.request_id, get_request_session_id(), DEBUG_SAMPLE_RATIO)
+
+
+@app.after_request
+def add_request_id_header(response: Response) -> Response:
+    """
+    Returns the request ID, so that a client can find the log records of its request.
+    """
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
+
+@app.teardown_request
+def end_log_context(_error: BaseException | None) -> None:
+    """
+    Unbinds the request and session ID.
+    """
+    if "log_context_tokens" in g and is_request_thread():
+        end_request_context(g.pop("log_context_tokens"))
+
+
+@app.before_request
+def start_trace() -> None:
+    """
+    Starts the span of the request, continuing the trace of the client if it sent a traceparent header.
+    """
+    route = request.url_rule.rule if request.url_rule is not None else request.path
+    g.trace_span, g.trace_token = start_request_span(
+        f"{request.method} {route}",
+        request.headers,
+        **{"http.method": request.method, "http.route": route, "session.id": get_request_session_id()},
+    )
+
+
+@app.after_request
+def record_trace_status(response: Response) -> Response:
+    """
+    Records the status code of the response on the span of the request.
+    """
+    if "trace_span" in g:
+        g.trace_span.set_attribute("http.status_code", response.status_code)
+    return response
+
+
+@app.teardown_request
+def end_trace(error: BaseException | None) -> None:
+    """
+    Ends the span of the request.
+    """
+    if "trace_span" in g and is_request_thread():
+        end_request_span(g.pop("trace_span"), g.pop("trace_token"), error)
+
+
+def start_profile() -> None:
+    """
+    Starts profiling the request if its route is armed.
+    """
+    g.profile = profiler.start_request(request.path)
+
+
+def finish_profile(_error: BaseException | None) -> None:
+    """
+    Writes the profile of the request, if it was profiled.
+    """
+    if is_request_thread():
+        profiler.finish(g.pop("profile", None))
+
+
+def ensure_sync_profiled(func: Callable) -> Callable:
+    """
+    Makes a view or hook callable synchronously like Flask does. The coroutine of an async view
+    runs in the thread of its own event loop, so a profile of its request samples that thread
+    while the coroutine runs.
+    """
+    if not inspect.iscoroutinefunction(func):
+        return Flask.ensure_sync(app, func)
+
+    @functools.wraps(func)
+    async def profiled_view(*args: Any, **kwargs: Any) -> Any:
+        if (profile := g.get("profile")) is None:
+            return await func(*args, **kwargs)
+        with profile.follow_current_thread():
+            return await func(*args, **kwargs)
+
+    return app.async_to_sync(profiled_view)
+
+
+if profiler.enabled:
+    # only registered when enabled, so that profiling costs nothing when it is off
+    app.before_request(start_profile)
+    app.teardown_request(finish_profile)
+    app.ensure_sync = ensure_sync_profiled  # type: ignore[method-assign]
+
+
+@app.before_request
+def admit_request() -> Response | None:
+    """
+    Admits the request, or rejects it with 429 and a Retry-After header when its session is
+    rate-limited or the queue of its concurrency pool is full.
+
+    Returns:
+        Response | None: The rejection response, or None if the request is admitted.
+    """
+    if request.method == "OPTIONS":
+        return None
+    try:
+        g.admission_ticket = admission.admit(request.path, get_request_session_id())
+    except AdmissionRejected as rejection:
+        response = make_response(ResponseMessage(message="", error=str(rejection)), 429)
+        response.headers["Retry-After"] = str(rejection.retry_after)
+        return response
+    return None
+
+
+@app.teardown_request
+def release_admission(_error: BaseException | None) -> None:
+    """
+    Releases the concurrency slot of the finished request.
+    """
+    if is_request_thread():
+        admission.release(g.pop("admission_ticket", None))
+
+
 @app.errorhandler(Exception)
 def handle_value_error(error: Exception) -> Response:
     """
@@ -200,30 +390,42 @@ def identify() -> Response:
     return response
 
 
-async def process_files(files: dict, session_id: str) -> WEMUploadResponse:
+async def process_files(
+    original_names_dict: dict[str, str],
+    buffer_dict: dict,
+    session_id: str,
+    upload_id: str,
+) -> WEMUploadResponse:
     """
-    Processes the files and returns a response object.
+    Processes the buffered files and returns a response object.
 
     Args:
-        files (dict): The files to process.
+        original_names_dict (dict): The original file names keyed by unique file name.
+        buffer_dict (dict): The upload buffers keyed by unique file name.
         session_id (str): The session ID.
+        upload_id (str): The ID of the upload.
 
     Returns:
         dict: A response object containing the message and error.
     """
-    original_names_dict, full_document_dict = await sm_app.save_files_to_tmp(
-        files, session_id=session_id
-    )
-    internal_file_id_mapping = await sm_app.save_files_to_vector_db(
-        full_document_dict, user_id=session_id
-    )
+    with bind_log_context(session_id=session_id, upload_id=upload_id), profiler.profile_job(session_id, upload_id):
+        try:
+            internal_file_id_mapping, duplicates_removed_mapping = await sm_app.save_files_to_vector_db(
+                buffer_dict, user_id=session_id, upload_id=upload_id
+            )
+        finally:
+            job_progress.finish(upload_id)
     time.sleep(1)
     external_file_id_mapping = [
-        {"filename": original_names_dict[filename], "documentIds": document_ids}
+        {
+            "filename": original_names_dict[filename],
+            "documentIds": document_ids,
+            "duplicatesRemoved": duplicates_removed_mapping[filename],
+        }
         for filename, document_ids in internal_file_id_mapping.items()
     ]
     response_message = WEMUploadResponse(
-        message=f"{str(len(files))} bestand{'en' if len(files) != 1 else ''} succesvol geüpload!",
+        message=f"{str(len(buffer_dict))} bestand{'en' if len(buffer_dict) != 1 else ''} succesvol geüpload!",
         error="",
         fileIdMapping=external_file_id_mapping,
     )
@@ -261,7 +463,7 @@ def upload_files_json() -> Response:
     files = {}
     prefix: str = ""
     session_id: str | None = None
-    for file_dict in tqdm(json_payload, desc="Extract files from payload"):
+    for file_dict in json_payload:
         session_id = file_dict["sessionId"] if session_id is None else session_id
         prefix = get_prefix()
         files = {**files, **get_files()}
@@ -269,7 +471,11 @@ def upload_files_json() -> Response:
     if session_id is None:
         raise ValueError("No session ID found in request.json")
 
-    executor.submit_stored("process_files", process_files, files, session_id)
+    upload_id = str(uuid.uuid4())
+    original_names_dict, buffer_dict = sm_app.buffer_files(
+        files, session_id=session_id, upload_id=upload_id
+    )
+    submit_process_files(original_names_dict, buffer_dict, session_id, upload_id)
     response_message = ResponseMessage(
         message=f"{str(len(files))} bestand{'en' if len(files) != 1 else ''} geüpload!",
         error="",
@@ -277,19 +483,48 @@ def upload_files_json() -> Response:
     response = make_response(response_message, 200)
     return response
 
+def submit_process_files(
+    original_names_dict: dict[str, str], buffer_dict: dict, session_id: str, upload_id: str
+) -> None:
+    """
+    Submits the processing of an upload to the executor.
+
+    The job takes over the admission slot of the upload request and releases it when it has
+    finished, so the heavy pool also bounds the ingestion jobs that run or wait in the executor.
+    """
+    admission_ticket = g.pop("admission_ticket", None)
+    job = with_trace_context(process_files, "process_files", **{"upload.id": upload_id, "session.id": session_id})
+
+    async def process_files_in_slot(*args: Any) -> WEMUploadResponse:
+        try:
+            return await job(*args)
+        finally:
+            admission.release(admission_ticket)
+
+    app.logger.info("Submitting upload %s of session %s (trace %s)", upload_id, session_id, current_trace_id())
+    try:
+        executor.submit_stored(
+            "process_files", process_files_in_slot, original_names_dict, buffer_dict, session_id, upload_id
+        )
+    except Exception:
+        admission.release(admission_ticket)
+        raise
+
+
 @app.route("/get_file_id_mappings", methods=["GET"])
 def get_file_id_mappings() -> Response:
     """
-    Gets the file ID mappings.
+    Gets the file ID mappings, or the progress of the upload while it is still being processed.
     """
     response_message: WEMUploadResponse
     process_files_state = executor.futures._state("process_files")
-    app.logger.info("process_files_state: %s", process_files_state)
+    app.logger.debug("process_files_state: %s", process_files_state)
     if not executor.futures.done("process_files"):
-        response_message = WEMUploadResponse(
+        response_message = UploadStatusResponse(
             message=str(process_files_state),
             error="",
             fileIdMapping=[],
+            progress=job_progress.snapshot(),
         )
         return make_response(response_message, 202)
     future = executor.futures.pop("process_files")
@@ -325,7 +560,11 @@ async def upload_files() -> Response:
     prefix: str = get_prefix()
     files = get_files()
 
-    executor.submit_stored("process_files", process_files, files, session_id)
+    upload_id = str(uuid.uuid4())
+    original_names_dict, buffer_dict = sm_app.buffer_files(
+        files, session_id=session_id, upload_id=upload_id
+    )
+    submit_process_files(original_names_dict, buffer_dict, session_id, upload_id)
     response_message = ResponseMessage(
         message=f"{str(len(files))} bestand{'en' if len(files) != 1 else ''} geüpload!",
         error="",
@@ -364,20 +603,30 @@ def prompt() -> Response:
     """
     This function handles the prompt request from the client.
 
+    The chat history of the result only holds the new turn, unless includeHistory is true.
+
     Returns:
         tuple: A tuple containing the response message and the HTTP status code.
     """
     session_id = str(get_property("sessionId"))
     message = str(get_property("prompt"))
+    include_history = str(get_property("includeHistory", with_error=False)).lower() == "true"
     chatbot = Chatbot(user_id=session_id)
     prompt_response = PromptResponse(
         message="Prompt result is found under the result key.",
         error="",
-        result=chatbot.send_prompt(message),
+        result=chatbot.send_prompt(message, include_history=include_history),
     )
     return make_response(prompt_response, 200)
 
 
+def get_chat_message_history(session_id: str) -> NormalizedChatMessageHistory:
+    """
+    Gets the chat history of a session.
+    """
+    return NormalizedChatMessageHistory(session_id, Utils.get_env_variable("CHAT_HISTORY_CONNECTION_STRING"))
+
+
 @app.route("/get_chat_history", methods=["GET"])
 def get_chat_history() -> Response:
     """
@@ -387,9 +636,7 @@ def get_chat_history() -> Response:
         Response: A response object containing the chat history and status code.
     """
     session_id = str(get_property("sessionId"))
-    memory_db = SQLChatMessageHistory(
-        session_id, Utils.get_env_variable("CHAT_HISTORY_CONNECTION_STRING")
-    )
+    memory_db = get_chat_message_history(session_id)
     response_message = ChatHistoryResponse(
         message="Chatgeschiedenis succesvol opgehaald!",
         error="",
@@ -407,9 +654,7 @@ def clear_chat_history() -> Response:
         Response: A response object containing the message and status code.
     """
     session_id = str(get_property("sessionId"))
-    memory_db = SQLChatMessageHistory(
-        session_id, Utils.get_env_variable("CHAT_HISTORY_CONNECTION_STRING")
-    )
+    memory_db = get_chat_message_history(session_id)
     memory_db.clear()
     response_message = ResponseMessage(
         message="Chatgeschiedenis succesvol gewist!", error=""
@@ -439,65 +684,156 @@ def submit_final_answer() -> Response:
     )
     return make_response(response_message, 200)
 
+
+def make_conditional_response(etag: str, build_response: Callable[[], ResponseMessage]) -> Response:
+    """
+    Answers with 304 Not Modified if the client has the response with the ETag already, and
+    builds the response otherwise. The ETag is weak, since the body is compressed per client
+    and a strong ETag must differ between encodings.
+
+    Args:
+        etag (str): The ETag of the current response.
+        build_response (Callable[[], ResponseMessage]): Builds the response message.
+
+    Returns:
+        Response: A response object with the ETag.
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = make_response(build_response(), 200)
+    response.set_etag(etag, weak=True)
+    # clients revalidate every poll, which costs a single read of the summary
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Access-Control-Expose-Headers"] = "ETag"
+    return response
+
+
 @app.route("/get_sessions", methods=["GET"])
 def get_sessions() -> Response:
     """
-    This function handles the get sessions request from the client.
+    This function handles the get sessions request from the client. The ETag of the response
+    changes with the version of the experiment summary, i.e. when a session changes.
 
     Returns:
         tuple: A tuple containing the response message and the HTTP status code.
     """
-    sessions = ExperimentSessionMethods.retrieve_sessions(app.logger)
-    response_message = SessionQueryResponse(
-        message="Sessions successfully retrieved!",
+    version = ExperimentSessionMethods.retrieve_summary()["version"]
+    return make_conditional_response(
+        f"sessions-{version}",
+        lambda: SessionQueryResponse(
+            message="Sessions successfully retrieved!",
+            error="",
+            result=ExperimentSessionMethods.retrieve_sessions(app.logger, version),
+        ),
+    )
+
+
+@app.route("/get_session_stats", methods=["GET"])
+def get_session_stats() -> Response:
+    """
+    Gets the aggregates of the experiment sessions: the number of sessions, of finished sessions
+    and their average duration, number of messages and edit distance between the original and
+    edited answer.
+
+    Returns:
+        Response: A response object containing the aggregates and status code.
+    """
+    summary = ExperimentSessionMethods.retrieve_summary()
+    return make_conditional_response(
+        f"stats-{summary['version']}",
+        lambda: SessionStatsResponse(
+            message="Session statistics successfully retrieved!",
+            error="",
+            result=summary,
+        ),
+    )
+
+
+@app.route("/get_chat_model_stats", methods=["GET"])
+def get_chat_model_stats() -> Response:
+    """
+    Gets the request counters and latency percentiles of the chat model router backends of this worker.
+
+    Returns:
+        Response: A response object containing the statistics per backend and status code.
+    """
+    response_message = ChatModelStatsResponse(
+        message="Chat model statistics successfully retrieved!",
         error="",
-        result=sessions,
+        result=get_router_stats(),
     )
     return make_response(response_message, 200)
 
-chat_history = [
-    {
-        "author": "assistant",
-        "content": "Hello, I'm DoRA! How can I help you?",
-        "attachments": []
-    },
-    {
-        "author": "user",
-        "content": "hey dora, can you help me with someting?",
-        "attachments": []
-    },
-    {
-        "author": "assistant",
-        "content": "Ofcourse, how can I help you?",
-        "attachments": []
-    },
-]
-
-
-@socketio.event
-def get_history(message):
-    emit('get_history', chat_history)
-
-@socketio.event
-def chat_send(message):
-    chat_history.append(message)
-
-    chatobj = {
-        "author": "assistant",
-        "content": "INTERNAL_TYPING",
-        "attachments": []
-    }
-    emit('chat_recieve', chatobj)
-    chatobj["content"] = message["content"]
-
-    socketio.sleep(2)
-    
-    emit('chat_recieve', chatobj)
-    chat_history.append(chatobj)
 
+@app.route("/get_admission_stats", methods=["GET"])
+def get_admission_stats() -> Response:
+    """
+    Gets the queue depths, requests in flight and shed counts of the admission control of this worker.
 
+    Returns:
+        Response: A response object containing the admission statistics and status code.
+    """
+    response_message = AdmissionStatsResponse(
+        message="Admission statistics successfully retrieved!",
+        error="",
+        result=admission.stats(),
+    )
+    return make_response(response_message, 200)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics() -> Response:
+    """
+    Gets the stage durations, token counts and cache hits in the Prometheus text format, of all
+    workers when PROMETHEUS_MULTIPROC_DIR is set.
+
+    Returns:
+        Response: A response object containing the metrics.
+    """
+    body, content_type = generate_metrics()
+    return Response(body, status=200, content_type=content_type)
+
+
+@app.route("/profile", methods=["GET", "POST", "DELETE"])
+def profile() -> Response:
+    """
+    Gets (GET), arms (POST) or clears (DELETE) the profiling of this worker. POST takes either a
+    route and a count, e.g. {"route": "/prompt", "count": 5}, with "allocations": true to trace
+    the allocations of the requests too, or the session or upload ID of an ingestion job, e.g.
+    {"jobId": "<sessionId>"}. The request must carry the admin token as "Authorization: Bearer <token>".
+
+    Returns:
+        Response: A response object containing the armed routes and jobs, status code 404 if
+        profiling is disabled, or status code 403 without the admin token.
+    """
+    if not profiler.enabled:
+        return make_response(ResponseMessage(message="", error="Profiling is disabled"), 404)
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not profiler.is_admin(token.strip()):
+        return make_response(ResponseMessage(message="", error="Profiling requires the admin token"), 403)
+    if request.method == "POST":
+        payload = cast(dict, request.get_json(force=True))
+        if "jobId" in payload:
+            profiler.arm_job(str(payload["jobId"]))
+        elif "route" in payload:
+            profiler.arm_route(
+                str(payload["route"]), int(payload.get("count", 1)), bool(payload.get("allocations", False))
+            )
+        else:
+            raise ValueError("No route or jobId found in request.json")
+    elif request.method == "DELETE":
+        profiler.disarm()
+    response_message = ProfilingStatusResponse(
+        message="Profiling status successfully retrieved!",
+        error="",
+        result=profiler.status(),
+    )
+    return make_response(response_message, 200)
 
 
 if __name__ == "__main__":
-    # Threaded option to enable multiple instances for multiple user access support
-    socketio.run(app, cors_allowed_orgins="*", threaded=True, port=5000)
+    # The Socket.IO chat and the async /prompt route are served by the ASGI app next to this Flask app
+    import uvicorn
+
+    uvicorn.run("asgi:application", port=5000)
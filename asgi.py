@@ -0,0 +1,154 @@
+"""
+ASGI entry point that serves /prompt asynchronously and mounts the Flask app for all other routes
+
+Run with `gunicorn -k uvicorn.workers.UvicornWorker asgi:application`. A prompt that is waiting on
+the chat model no longer holds a thread, so one worker can keep many prompts and Socket.IO chat
+connections in flight; the Flask routes run on a thread pool of ASGI_WSGI_THREADS threads.
+"""
+import asyncio
+import json
+import os
+import uuid
+from collections.abc import Mapping
+from typing import Any
+
+import socketio
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+
+from app import DEBUG_SAMPLE_RATIO, admission, app
+from chatdoc.chatbot import Chatbot
+from chatdoc.profiling import profiler
+from chatdoc.tracing import end_request_span, start_request_span
+from server_modules.admission import AdmissionRejected
+from server_modules.chat_socket import ChatSocketServer
+from server_modules.class_defs import PromptResponse, ResponseMessage
+from server_modules.responses import compression, dumps
+from server_modules.structured_logging import end_request_context, start_request_context, update_log_context
+
+
+CURRENT_HOST_PORT = "127.0.0.1:5000"
+
+
+def get_flask_session(request: Request) -> Mapping[str, Any]:
+    """
+    Gets the Flask session of a request, opened from its session cookie by the session interface of the Flask app.
+    """
+    flask_request = app.request_class({"REQUEST_METHOD": request.method, "HTTP_COOKIE": request.headers.get("Cookie", "")})
+    return app.session_interface.open_session(app, flask_request) or {}
+
+
+async def get_request_property(request: Request, property_name: str, default: str | None = None) -> str:
+    """
+    Gets a property from the session, the form or the JSON payload of a request, in the same
+    order and with the same quote handling as `get_property` of the Flask routes.
+
+    Raises:
+        ValueError: If the property is not found in the request and has no default.
+    """
+    property_value: str | None = None
+    if property_name in (flask_session := get_flask_session(request)):
+        property_value = flask_session[property_name]
+    elif request.headers.get("Content-Type", "").startswith("application/json"):
+        payload = await request.json()
+        items = payload if isinstance(payload, list) else [payload]
+        for item in items:
+            if isinstance(item, dict) and property_name in item:
+                property_value = json.dumps(item[property_name], ensure_ascii=False)
+                break
+    elif property_name in (form := await request.form()):
+        property_value = str(form[property_name])
+    if property_value is None:
+        if default is not None:
+            return default
+        raise ValueError(f"No {property_name} found in request.form, session, or request.json")
+    return str(property_value).replace("\"", "")
+
+
+def make_json_response(request: Request, content: ResponseMessage, status_code: int) -> Response:
+    """
+    Makes a JSON response with the same CORS headers, request ID header, serialisation and
+    compression as the Flask routes.
+    """
+    origin = request.headers.get("Origin")
+    host = request.headers.get("Host")
+    if host != CURRENT_HOST_PORT and origin is not None:
+        content, status_code = ResponseMessage(message="", error="No origin header found"), 400
+    if host == CURRENT_HOST_PORT:
+        origin = host
+    headers = {
+        "Access-Control-Allow-Origin": str(origin),
+        "Access-Control-Allow-Credentials": "true",
+        "X-Request-ID": request.state.request_id,
+        "Vary": "Accept-Encoding",
+    }
+    body, encoding = compression.compress(
+        dumps(content), "application/json", request.headers.get("Accept-Encoding", "")
+    )
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(body, status_code=status_code, headers=headers, media_type="application/json")
+
+
+async def prompt(request: Request) -> Response:
+    """
+    Handles the prompt request from the client without blocking the worker.
+
+    A profile of the request samples the event loop thread, so it includes the other requests
+    that the loop served in the meantime.
+
+    Returns:
+        Response: The prompt result under the result key, or the error with status code 400.
+    """
+    admission_ticket = None
+    request.state.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    log_context_tokens = start_request_context(request.state.request_id, "", DEBUG_SAMPLE_RATIO)
+    profile = profiler.start_request(request.url.path) if profiler.enabled else None
+    span, trace_token = start_request_span(
+        "POST /prompt", request.headers, **{"http.method": "POST", "http.route": "/prompt"}
+    )
+    try:
+        session_id = await get_request_property(request, "sessionId")
+        span.set_attribute("session.id", session_id)
+        update_log_context(session_id=session_id)
+        message = await get_request_property(request, "prompt")
+        include_history = (await get_request_property(request, "includeHistory", "false")).lower() == "true"
+        admission_ticket = await admission.aadmit(request.url.path, session_id)
+        chatbot = await asyncio.to_thread(Chatbot, user_id=session_id)
+        result = await chatbot.asend_prompt(message, include_history=include_history)
+    except AdmissionRejected as rejection:
+        span.set_attribute("http.status_code", 429)
+        response = make_json_response(request, ResponseMessage(message="", error=str(rejection)), 429)
+        response.headers["Retry-After"] = str(rejection.retry_after)
+        return response
+    except Exception as error:  # pylint: disable=broad-except
+        app.logger.exception("Prompt failed")
+        span.set_attribute("http.status_code", 400)
+        span.record_exception(error)
+        return make_json_response(request, ResponseMessage(message="", error=str(error)), 400)
+    else:
+        span.set_attribute("http.status_code", 200)
+    finally:
+        admission.release(admission_ticket)
+        end_request_span(span, trace_token)
+        profiler.finish(profile)
+        end_request_context(log_context_tokens)
+    prompt_response = PromptResponse(
+        message="Prompt result is found under the result key.",
+        error="",
+        result=result,
+    )
+    return make_json_response(request, prompt_response, 200)
+
+
+http_application = Starlette(
+    routes=[
+        Route("/prompt", prompt, methods=["POST"]),
+        Mount("/", app=WSGIMiddleware(app, workers=int(os.environ.get("ASGI_WSGI_THREADS", 8)))),  # type: ignore[arg-type]
+    ]
+)
+chat_socket = ChatSocketServer(admission, app.logger)
+application = socketio.ASGIApp(chat_socket.server, other_asgi_app=http_application)
@@ -0,0 +1,573 @@
+"""
+Module defining the NormalizedChatMessageHistory class, a blocking and non-blocking reader and
+writer of the chat history in normalized tables
+
+A message is a row of chat_message. The citations of an answer are rows of chat_citation, and the
+sentences they quote are rows of chat_citation_span that refer to the chunk they are taken from,
+so a message row only holds its own content. Citations are only read when they are asked for (the
+chat history passed to the chat model does not need them), and then for all messages at once in
+two queries. The number of messages of a session is kept in chat_session as messages are added.
+Messages are written by the write-behind buffer of the worker, and read back from it until then.
+
+`migrate_message_store` copies the messages that langchain's SQLChatMessageHistory stored in
+message_store to these tables, leaving message_store as it is. It is an explicit step, run with
+`python -m chatdoc.chat_history` before the server is started.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from functools import cached_property
+from typing import Any, Sequence
+
+from dotenv import find_dotenv, load_dotenv
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from sqlalchemy import (
+    Connection,
+    Engine,
+    Text,
+    delete,
+    func,
+    insert,
+    inspect,
+    select,
+    type_coerce,
+    update,
+)
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from server_modules.models import (
+    ChatCitationModel,
+    ChatCitationSpanModel,
+    ChatHistoryModel,
+    ChatMessageModel,
+    ChatMigrationModel,
+    ChatSessionModel,
+    SecondBase,
+)
+from .citation import BaseCitation, ProofCitation, ProofSpan
+from .utils import Utils
+from .write_behind import get_engine, write_behind
+
+
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "mysql": "mysql+aiomysql", "mariadb": "mysql+aiomysql"}
+CHAT_TABLES = [
+    model.__table__ for model in (ChatSessionModel, ChatMessageModel, ChatCitationModel, ChatCitationSpanModel)
+]
+CITATION_FIELDS = frozenset({"source", "page", "ranking", "score"})
+
+logger = logging.getLogger("chat_history")
+
+_async_engines: dict[str, AsyncEngine] = {}
+_created_tables: set[str] = set()
+_engines_lock = threading.Lock()
+_tables_lock = threading.Lock()
+
+
+def to_async_connection_string(connection_string: str) -> str:
+    """
+    Convert a (synchronous) SQLAlchemy connection string into one with an async driver.
+
+    Args:
+        connection_string (str): The connection string, e.g. "mariadb+mariadbconnector://user:pw@host/db".
+
+    Returns:
+        str: The connection string with an async driver, e.g. "mysql+aiomysql://user:pw@host/db".
+
+    Raises:
+        ValueError: If there is no async driver for the database.
+    """
+    url = make_url(connection_string)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for {backend} databases")
+    return url.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+
+def get_async_engine(connection_string: str) -> AsyncEngine:
+    """
+    Get the async engine of a connection string, shared by all histories in the process.
+    """
+    with _engines_lock:
+        if connection_string not in _async_engines:
+            _async_engines[connection_string] = create_async_engine(connection_string, pool_pre_ping=True)
+        return _async_engines[connection_string]
+
+
+def create_tables(connection: Connection) -> None:
+    """
+    Create the chat history tables that do not exist yet.
+    """
+    SecondBase.metadata.create_all(connection, tables=CHAT_TABLES)
+
+
+def split_citations(
+    additional_kwargs: dict[str, Any]
+) -> tuple[dict[str, Any], list[dict[str, Any]] | None, bool | None]:
+    """
+    Take the citations (in the format of `Citations.__dict__`) out of the additional kwargs of a message.
+
+    Returns:
+        tuple: The other additional kwargs, the citations and whether they have proof; the
+        citations are None, and left in the additional kwargs, if they are in another format.
+    """
+    citations = additional_kwargs.get("citations")
+    if not (
+        isinstance(citations, dict)
+        and isinstance(citations.get("citations"), list)
+        and set(citations) <= {"citations", "with_proof"}
+        and all(
+            isinstance(citation, dict) and CITATION_FIELDS <= citation.keys() for citation in citations["citations"]
+        )
+    ):
+        return additional_kwargs, None, None
+    other_kwargs = {key: value for key, value in additional_kwargs.items() if key != "citations"}
+    return other_kwargs, citations["citations"], bool(citations.get("with_proof", True))
+
+
+def citation_rows(message_id: int, citations: list[dict[str, Any]]) -> tuple[list[dict], list[dict]]:
+    """
+    The chat_citation and chat_citation_span rows of the citations of a message. A citation
+    stored before citations had spans gets its whole proof as a single span.
+    """
+    rows, span_rows = [], []
+    for position, citation in enumerate(citations):
+        rows.append(
+            {
+                "message_id": message_id,
+                "position": position,
+                "source": citation["source"],
+                "page": citation["page"],
+                "page_end": citation.get("page_end"),
+                "section": citation.get("section", ""),
+                "ranking": citation["ranking"],
+                "score": citation["score"],
+            }
+        )
+        spans = citation.get("spans")
+        if spans is None and citation.get("proof"):
+            spans = [
+                {"text": citation["proof"], "start": 0, "end": len(citation["proof"]), "ranking": citation["ranking"]}
+            ]
+        for span_position, span in enumerate(spans or []):
+            span_rows.append(
+                {
+                    "message_id": message_id,
+                    "citation_position": position,
+                    "position": span_position,
+                    "chunk_id": span.get("chunk_id") or None,
+                    "text": span["text"],
+                    "start_offset": span["start"],
+                    "end_offset": span["end"],
+                    "ranking": span["ranking"],
+                    "score": span.get("score", 0.0),
+                }
+            )
+    return rows, span_rows
+
+
+def to_citation(row: Any, spans: list[Any], with_proof: bool) -> dict[str, Any]:
+    """
+    Rebuild a citation from its chat_citation row and chat_citation_span rows.
+    """
+    kwargs = {"page_end": row.page_end, "section": row.section or ""}
+    if not with_proof:
+        return BaseCitation(row.source, row.page, row.ranking, row.score, **kwargs).__dict__()
+    proof_spans = tuple(
+        ProofSpan(span.text, span.start_offset, span.end_offset, span.ranking, span.score, chunk_id=span.chunk_id or "")
+        for span in spans
+    )
+    proof = " … ".join(span.text for span in proof_spans)
+    return ProofCitation(row.source, row.page, row.ranking, row.score, proof, spans=proof_spans, **kwargs).__dict__()
+
+
+class NormalizedChatMessageHistory(BaseChatMessageHistory):
+    """
+    The chat history of a session, stored in the chat_session, chat_message, chat_citation and
+    chat_citation_span tables.
+
+    The async methods use the connection string of the chat history with an async driver,
+    unless CHAT_HISTORY_ASYNC_CONNECTION_STRING is set. The engines and their connection pools
+    are shared by all histories in the process.
+
+    Attributes:
+        session_id (str): The session whose messages are read and written.
+        connection_string (str): The connection string.
+    """
+
+    def __init__(self, session_id: str, connection_string: str) -> None:
+        self.session_id = session_id
+        self.connection_string = connection_string
+
+    @property
+    def engine(self) -> Engine:
+        """
+        The engine of the blocking methods.
+        """
+        return get_engine(self.connection_string)
+
+    @cached_property
+    def async_connection_string(self) -> str:
+        """
+        The connection string of the async methods.
+        """
+        return os.environ.get("CHAT_HISTORY_ASYNC_CONNECTION_STRING") or to_async_connection_string(
+            self.connection_string
+        )
+
+    @property
+    def async_engine(self) -> AsyncEngine:
+        """
+        The engine of the async methods.
+        """
+        return get_async_engine(self.async_connection_string)
+
+    def _create_tables(self) -> None:
+        if self.connection_string in _created_tables:
+            return
+        # threads that create the tables at the same time would fail on SQLite
+        with _tables_lock:
+            if self.connection_string not in _created_tables:
+                with self.engine.begin() as connection:
+                    create_tables(connection)
+                _created_tables.add(self.connection_string)
+
+    async def _acreate_tables(self) -> None:
+        if self.async_connection_string in _created_tables:
+            return
+        async with self.async_engine.begin() as connection:
+            await connection.run_sync(create_tables)
+        _created_tables.add(self.async_connection_string)
+
+    def _read_citations(
+        self, connection: Connection, with_proof: dict[int, bool]
+    ) -> dict[int, list[dict[str, Any]]]:
+        citations: dict[int, list[dict[str, Any]]] = {message_id: [] for message_id in with_proof}
+        if not citations:
+            return citations
+        message_ids = list(citations)
+        spans_table, citations_table = ChatCitationSpanModel.__table__, ChatCitationModel.__table__
+        spans = defaultdict(list)
+        span_query = (
+            select(spans_table)
+            .where(spans_table.c.message_id.in_(message_ids))
+            .order_by(spans_table.c.message_id, spans_table.c.citation_position, spans_table.c.position)
+        )
+        for span in connection.execute(span_query):
+            spans[(span.message_id, span.citation_position)].append(span)
+        citation_query = (
+            select(citations_table)
+            .where(citations_table.c.message_id.in_(message_ids))
+            .order_by(citations_table.c.message_id, citations_table.c.position)
+        )
+        for row in connection.execute(citation_query):
+            citations[row.message_id].append(
+                to_citation(row, spans[(row.message_id, row.position)], with_proof[row.message_id])
+            )
+        return citations
+
+    def _read(self, connection: Connection, with_citations: bool, last_n: int | None) -> list[BaseMessage]:
+        messages_table = ChatMessageModel.__table__
+        query = select(
+            messages_table.c.id,
+            messages_table.c.type,
+            messages_table.c.content,
+            messages_table.c.additional_kwargs,
+            messages_table.c.citations_with_proof,
+        ).where(messages_table.c.session_id == self.session_id)
+        if last_n:
+            rows = connection.execute(query.order_by(messages_table.c.id.desc()).limit(last_n)).all()[::-1]
+        else:
+            rows = connection.execute(query.order_by(messages_table.c.id.asc())).all()
+        citations = (
+            self._read_citations(
+                connection, {row.id: row.citations_with_proof for row in rows if row.citations_with_proof is not None}
+            )
+            if with_citations
+            else {}
+        )
+        message_dicts = []
+        for row in rows:
+            additional_kwargs = dict(row.additional_kwargs or {})
+            if row.id in citations:
+                additional_kwargs["citations"] = {
+                    "citations": citations[row.id],
+                    "with_proof": row.citations_with_proof,
+                }
+            message_dicts.append(
+                {"type": row.type, "data": {"content": row.content, "additional_kwargs": additional_kwargs}}
+            )
+        return messages_from_dict(message_dicts)
+
+    def _count_messages(self, connection: Connection, count: int) -> None:
+        sessions_table = ChatSessionModel.__table__
+        values = {"session_id": self.session_id, "number_of_messages": 0}
+        match connection.dialect.name:
+            case "sqlite":
+                create_session = sqlite_insert(sessions_table).values(values).on_conflict_do_nothing()
+            case "postgresql":
+                create_session = postgresql_insert(sessions_table).values(values).on_conflict_do_nothing()
+            case _:
+                create_session = (
+                    mysql_insert(sessions_table)
+                    .values(values)
+                    .on_duplicate_key_update(session_id=sessions_table.c.session_id)
+                )
+        connection.execute(create_session)
+        connection.execute(
+            update(sessions_table)
+            .where(sessions_table.c.session_id == self.session_id)
+            .values(
+                number_of_messages=sessions_table.c.number_of_messages + count,
+                updated_at=func.now(),  # pylint: disable=not-callable
+            )
+        )
+
+    def _write(self, connection: Connection, messages: Sequence[BaseMessage]) -> None:
+        self._count_messages(connection, len(messages))
+        for message in messages:
+            message_dict = message_to_dict(message)
+            additional_kwargs, citations, with_proof = split_citations(
+                message_dict["data"].get("additional_kwargs") or {}
+            )
+            message_id = connection.execute(
+                insert(ChatMessageModel.__table__).values(
+                    session_id=self.session_id,
+                    type=message_dict["type"],
+                    content=message_dict["data"]["content"],
+                    additional_kwargs=additional_kwargs or None,
+                    citations_with_proof=with_proof,
+                )
+            ).inserted_primary_key[0]
+            if not citations:
+                continue
+            rows, span_rows = citation_rows(message_id, citations)
+            connection.execute(insert(ChatCitationModel.__table__), rows)
+            if span_rows:
+                connection.execute(insert(ChatCitationSpanModel.__table__), span_rows)
+
+    def _delete(self, connection: Connection) -> None:
+        message_ids = select(ChatMessageModel.id).where(ChatMessageModel.session_id == self.session_id)
+        connection.execute(delete(ChatCitationSpanModel).where(ChatCitationSpanModel.message_id.in_(message_ids)))
+        connection.execute(delete(ChatCitationModel).where(ChatCitationModel.message_id.in_(message_ids)))
+        connection.execute(delete(ChatMessageModel).where(ChatMessageModel.session_id == self.session_id))
+        connection.execute(
+            update(ChatSessionModel)
+            .where(ChatSessionModel.session_id == self.session_id)
+            .values(number_of_messages=0, updated_at=func.now())  # pylint: disable=not-callable
+        )
+
+    @property
+    def _key(self) -> tuple[str, str, str]:
+        return ("chat_history", self.connection_string, self.session_id)
+
+    def _merge(
+        self, messages: list[BaseMessage], pending: list[BaseMessage], with_citations: bool, last_n: int | None
+    ) -> list[BaseMessage]:
+        if not with_citations:
+            pending = [
+                message.copy(
+                    update={
+                        "additional_kwargs": {
+                            key: value for key, value in message.additional_kwargs.items() if key != "citations"
+                        }
+                    }
+                )
+                for message in pending
+            ]
+        merged = messages + pending
+        return merged[-last_n:] if last_n else merged
+
+    @property
+    def messages(self) -> list[BaseMessage]:  # type: ignore[override]
+        """
+        The messages of the session with their citations, oldest first.
+        """
+        return self.get_messages()
+
+    def get_messages(self, with_citations: bool = True, last_n: int | None = None) -> list[BaseMessage]:
+        """
+        Read the messages of the session, oldest first, including those this worker has not written yet.
+
+        Args:
+            with_citations (bool): Whether to read the citations of the answers as well.
+            last_n (int | None): The number of most recent messages to read, or None for all.
+        """
+        self._create_tables()
+        while True:
+            if (snapshot := write_behind.snapshot(self._key)) is None:
+                time.sleep(0.001)  # the queued messages of the session are being committed
+                continue
+            generation, pending = snapshot
+            with self.engine.connect() as connection:
+                messages = self._read(connection, with_citations, last_n)
+            if write_behind.generation(self._key) == generation:
+                return self._merge(messages, pending, with_citations, last_n)
+
+    async def aget_messages(self, with_citations: bool = True, last_n: int | None = None) -> list[BaseMessage]:
+        """
+        Read the messages of the session without blocking, oldest first; see `get_messages`.
+        """
+        await self._acreate_tables()
+        while True:
+            if (snapshot := write_behind.snapshot(self._key)) is None:
+                await asyncio.sleep(0.001)
+                continue
+            generation, pending = snapshot
+            async with self.async_engine.connect() as connection:
+                messages = await connection.run_sync(self._read, with_citations, last_n)
+            if write_behind.generation(self._key) == generation:
+                return self._merge(messages, pending, with_citations, last_n)
+
+    def count_messages(self, connection: Connection | None = None) -> int:
+        """
+        The number of messages of the session, without counting them.
+
+        Args:
+            connection (Connection | None): A connection to read the number of written messages
+                with, e.g. that of a queued write; without one, the messages that this worker has
+                not written yet are counted as well.
+        """
+        query = select(ChatSessionModel.number_of_messages).where(ChatSessionModel.session_id == self.session_id)
+        if connection is not None:
+            return connection.execute(query).scalar() or 0
+        self._create_tables()
+        while True:
+            if (snapshot := write_behind.snapshot(self._key)) is None:
+                time.sleep(0.001)
+                continue
+            generation, pending = snapshot
+            with self.engine.connect() as own_connection:
+                number_of_messages = own_connection.execute(query).scalar() or 0
+            if write_behind.generation(self._key) == generation:
+                return number_of_messages + len(pending)
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.add_messages([message])
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """
+        Queue messages to be appended to the history of the session, in a single transaction
+        with the other writes of the next flush of the write-behind buffer.
+        """
+        if not messages:
+            return
+        self._create_tables()
+        messages = list(messages)
+        write_behind.submit(
+            self.connection_string,
+            lambda connection: self._write(connection, messages),
+            key=self._key,
+            items=messages,
+        )
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """
+        Queue messages to be appended to the history of the session without blocking; see `add_messages`.
+        """
+        if not messages:
+            return
+        await self._acreate_tables()
+        messages = list(messages)
+        write_behind.submit(
+            self.connection_string,
+            lambda connection: self._write(connection, messages),
+            key=self._key,
+            items=messages,
+        )
+
+    def clear(self) -> None:
+        """
+        Delete the messages of the session, after writing the queued writes.
+        """
+        self._create_tables()
+        write_behind.flush()
+        with self.engine.begin() as connection:
+            self._delete(connection)
+
+    async def aclear(self) -> None:
+        """
+        Delete the messages of the session without blocking, after writing the queued writes.
+        """
+        await self._acreate_tables()
+        await asyncio.to_thread(write_behind.flush)
+        async with self.async_engine.begin() as connection:
+            await connection.run_sync(self._delete)
+
+
+def migrate_message_store(connection_string: str, batch_size: int = 500) -> int:
+    """
+    Copy the messages in message_store to the normalized tables, oldest first, in batches that
+    are each copied in a single transaction. message_store is not changed: the ID of the last
+    copied row is kept in message_store_migration, so an interrupted migration is resumed and
+    running it again only copies the rows added since. Run it before serving requests: messages
+    added in the meantime would precede the copied ones.
+
+    Returns:
+        int: The number of copied messages.
+    """
+    engine = get_engine(connection_string)
+    try:
+        return _migrate_message_store(engine, connection_string, batch_size)
+    finally:
+        engine.dispose()
+
+
+def _migrate_message_store(engine: Engine, connection_string: str, batch_size: int) -> int:
+    with engine.begin() as connection:
+        create_tables(connection)
+        if not inspect(connection).has_table(ChatHistoryModel.__tablename__):
+            return 0
+        ChatMigrationModel.__table__.create(connection, checkfirst=True)
+    message_store = ChatHistoryModel.__table__
+    migration = ChatMigrationModel.__table__
+    query = (
+        select(message_store.c.id, message_store.c.session_id, type_coerce(message_store.c.message, Text))
+        .order_by(message_store.c.id)
+        .limit(batch_size)
+    )
+    migrated = 0
+    while True:
+        with engine.begin() as connection:
+            last_message_id = connection.execute(select(migration.c.last_message_id)).scalar()
+            rows = connection.execute(
+                query if last_message_id is None else query.where(message_store.c.id > last_message_id)
+            ).all()
+            if not rows:
+                break
+            sessions: dict[str, list[dict[str, Any]]] = defaultdict(list)
+            for _, session_id, message in rows:
+                sessions[session_id].append(json.loads(message) if isinstance(message, str) else message)
+            for session_id, message_dicts in sessions.items():
+                NormalizedChatMessageHistory(session_id, connection_string)._write(  # pylint: disable=protected-access
+                    connection, messages_from_dict(message_dicts)
+                )
+            if last_message_id is None:
+                connection.execute(insert(migration).values(id=1, last_message_id=rows[-1][0]))
+            else:
+                connection.execute(update(migration).values(last_message_id=rows[-1][0]))
+        migrated += len(rows)
+        logger.info("Copied %d messages from message_store", migrated)
+    return migrated
+
+
+def main() -> None:
+    """
+    Copy the chat history in message_store to the normalized tables.
+    """
+    load_dotenv(find_dotenv())
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s in %(module)s: %(message)s")
+    migrated = migrate_message_store(Utils.get_env_variable("CHAT_HISTORY_CONNECTION_STRING"))
+    logger.info("Copied %d messages from message_store in total", migrated)
+
+
+if __name__ == "__main__":
+    main()
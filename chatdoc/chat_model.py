@@ -1,17 +1,23 @@
 import json
-from langchain_community.chat_models.azureml_endpoint import AzureMLChatOnlineEndpoint
-from langchain_community.chat_models import ChatOpenAI
+import os
 from langchain_core.pydantic_v1 import SecretStr
 from langchain_core.language_models.chat_models import BaseChatModel
 from pathlib import Path
 from .utils import Utils
-from .local_llm import build_llm
+from .chat_router import ChatModelRouter, get_router_backend
+from .local_llm import LocalServerChatModel, build_llm, load_local_llm_settings
+from .model_registry import get_model
 
 
 class ChatModel:
     """
     A class representing a chat model.
 
+    The chat model classes are imported when the chat model of their vendor is loaded, so that
+    importing this module stays cheap. A loaded chat model is kept in the model registry and shared
+    by all ChatModels of the process with the same settings, except a llama.cpp model loaded in
+    this process.
+
     Attributes:
         chat_model (object): The chat model.
 
@@ -34,7 +40,9 @@ class ChatModel:
             case "openai":
                 if self.api_key is None:
                     self.api_key = Utils.get_env_variable("OPENAI_API_KEY")
-                return ChatOpenAI(api_key=self.api_key, model=self.chat_model_name)
+                from langchain_community.chat_models.openai import ChatOpenAI  # pylint: disable=import-outside-toplevel
+
+                return ChatOpenAI(api_key=self.api_key, model=self.chat_model_name, streaming=self.streaming)
             case "huggingface":
                 if self.api_key is None:
                     self.api_key = Utils.get_env_variable("HUGGINGFACE_API_KEY")
@@ -47,24 +55,79 @@ class ChatModel:
                 if self.chat_model_name not in azure_chat_models:
                     raise ValueError("Invalid Azure ML chat model name")
                 chat_model_url = azure_chat_models[self.chat_model_name]
+                from langchain_community.chat_models.azureml_endpoint import (  # pylint: disable=import-outside-toplevel
+                    AzureMLChatOnlineEndpoint,
+                )
+
                 return AzureMLChatOnlineEndpoint(endpoint_api_key=SecretStr(self.api_key), endpoint_url=chat_model_url)
             case "local":
+                local_llm_settings = load_local_llm_settings()
+                if "LOCAL_LLM_SERVER_URL" in os.environ:
+                    return LocalServerChatModel(
+                        server_url=os.environ["LOCAL_LLM_SERVER_URL"],
+                        max_tokens=local_llm_settings["max_tokens"],
+                        temperature=0,
+                    )
                 model_path = str(Path(Utils.get_env_variable("CHAT_MODEL_FOLDER_PATH")) / self.chat_model_name)
                 return build_llm(
                     model_path=model_path,
-                    length=128,  # TODO: Change this to env variable
+                    length=local_llm_settings["max_tokens"],
                     temp=0,
-                    gpu_layers=5,  # TODO: Change this to env variable
+                    gpu_layers=local_llm_settings["n_gpu_layers"],
                     chat_box=None,  # TODO: Change this to env variable
+                    streaming=self.streaming,
                 )
+            case "fake":
+                from .fake_models import FakeChatModel  # pylint: disable=import-outside-toplevel
+
+                return FakeChatModel(
+                    model_name=self.chat_model_name,
+                    latency=float(os.environ.get("FAKE_CHAT_MODEL_LATENCY", 0.5)),
+                    tokens_per_second=float(os.environ.get("FAKE_CHAT_MODEL_TOKENS_PER_SECOND", 50)),
+                    answer_tokens=int(os.environ.get("FAKE_CHAT_MODEL_ANSWER_TOKENS", 64)),
+                )
+            case "router":
+                return self._load_chat_model_router()
             case _:
                 raise ValueError("Invalid vendor name")
 
+    def _load_chat_model_router(self) -> BaseChatModel:
+        """
+        Loads a router over the backends listed in the chat model name, e.g. "openai:gpt-3.5-turbo,local:mistral.gguf".
+
+        Returns:
+            BaseChatModel: The chat model router.
+
+        Raises:
+            ValueError: If a backend is not of the form vendor:model, or is not a chat model.
+        """
+        backends = []
+        for backend_name in self.chat_model_name.split(","):
+            vendor_name, _, model_name = backend_name.strip().partition(":")
+            if not vendor_name or not model_name or vendor_name == "router":
+                raise ValueError(f"Invalid chat model router backend: {backend_name}")
+            # streaming and non-streaming routers need backends of their own, whose models stream or not
+            backends.append(
+                get_router_backend(
+                    f"{vendor_name}:{model_name}" + (" (streaming)" if self.streaming else ""),
+                    lambda vendor_name=vendor_name, model_name=model_name: ChatModel(
+                        vendor_name, model_name, streaming=self.streaming
+                    ).chat_model,
+                )
+            )
+        return ChatModelRouter(
+            backends=backends,
+            hedge_percentile=float(os.environ.get("CHAT_MODEL_ROUTER_HEDGE_PERCENTILE", 0.95)),
+            min_hedge_delay=float(os.environ.get("CHAT_MODEL_ROUTER_MIN_HEDGE_DELAY", 1.0)),
+            queue_timeout=float(os.environ.get("CHAT_MODEL_ROUTER_QUEUE_TIMEOUT", 10.0)),
+        )
+
     def __init__(
         self,
         chat_model_vendor_name: str | None = None,
         chat_model_name: str | None = None,
         api_key: str | None = None,
+        streaming: bool = False,
     ) -> None:
         """
         Initializes the ChatModel object by setting
@@ -79,4 +142,11 @@ class ChatModel:
             chat_model_name if chat_model_name is not None else Utils.get_env_variable("CHAT_MODEL_NAME")
         )
         self.api_key = api_key
-        self.chat_model: BaseChatModel = self._load_chat_model()
+        self.streaming = streaming
+        if self.vendor_name == "local" and "LOCAL_LLM_SERVER_URL" not in os.environ:
+            # a llama.cpp model in this process cannot serve two chatbots at once, so it is not shared
+            self.chat_model: BaseChatModel = self._load_chat_model()
+        else:
+            self.chat_model = get_model(
+                ("chat_model", self.vendor_name, self.chat_model_name, api_key, streaming), self._load_chat_model
+            )
@@ -0,0 +1,371 @@
+"""
+Module defining the ChatModelRouter class, which spreads chat requests over several chat model backends
+"""
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, List, Optional
+
+from langchain_core.callbacks.manager import CallbackManager, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatResult
+
+
+class LatencyTracker:
+    """
+    Keeps the latencies of the most recent successful requests of a backend.
+
+    Attributes:
+        window (int): The number of latencies that are kept.
+    """
+
+    def __init__(self, window: int = 500) -> None:
+        self.window = window
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._latencies)
+
+    def record(self, latency: float) -> None:
+        """
+        Record the latency of a request in seconds.
+        """
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, percentile: float) -> float | None:
+        """
+        Compute a percentile (between 0 and 1) of the recorded latencies, or None without any latencies.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, max(0, math.ceil(percentile * len(latencies)) - 1))]
+
+
+class StreamClaim:
+    """
+    Lets only one of the backend calls of a request stream tokens: the first one that produces a
+    token, so the tokens of a hedged request are not interleaved.
+    """
+
+    def __init__(self) -> None:
+        self.owner: int | None = None
+        self._given_up: set[int] = set()
+        self._lock = threading.Lock()
+
+    def claim(self, call_id: int) -> bool:
+        """
+        Whether the call may stream its tokens, claiming the stream if no call has claimed it yet.
+        """
+        with self._lock:
+            if self.owner is None and call_id not in self._given_up:
+                self.owner = call_id
+            return self.owner == call_id
+
+    def give_up(self, call_id: int) -> None:
+        """
+        Stop streaming the tokens of a call that failed or timed out, so the backend that replaces it can stream.
+        """
+        with self._lock:
+            self._given_up.add(call_id)
+            if self.owner == call_id:
+                self.owner = None
+
+
+class TokenFilter:
+    """
+    Wraps a callback handler so that it only gets the tokens of the backend call that owns the
+    stream; all other events are passed on.
+    """
+
+    def __init__(self, handler: Any, stream_claim: StreamClaim, call_id: int) -> None:
+        self.handler = handler
+        self.stream_claim = stream_claim
+        self.call_id = call_id
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.handler, name)
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> Any:
+        if self.stream_claim.claim(self.call_id):
+            return self.handler.on_llm_new_token(token, **kwargs)
+        return None
+
+
+class RouterBackend:
+    """
+    A chat model backend with its own concurrency limit, timeout and latency statistics.
+
+    Backends are shared by all routers in the process (see `get_router_backend`), so their
+    limits and statistics hold for the whole server worker.
+
+    Attributes:
+        name (str): The name of the backend, e.g. "openai:gpt-3.5-turbo".
+        chat_model (BaseChatModel): The chat model of the backend.
+        timeout (float): The number of seconds after which a request counts as failed.
+        latencies (LatencyTracker): The latencies of the successful requests.
+        counters (dict[str, int]): The number of requests, errors, timeouts, hedges and rejections.
+    """
+
+    def __init__(self, name: str, chat_model: BaseChatModel, max_concurrency: int, timeout: float) -> None:
+        self.name = name
+        self.chat_model = chat_model
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.latencies = LatencyTracker()
+        self.counters = {"requests": 0, "errors": 0, "timeouts": 0, "hedges": 0, "rejected": 0}
+        self.in_flight = 0
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+
+    def count(self, counter: str) -> None:
+        """
+        Increment one of the counters of the backend.
+        """
+        with self._lock:
+            self.counters[counter] += 1
+
+    def try_acquire(self) -> bool:
+        """
+        Claim a concurrency slot of the backend without waiting.
+        """
+        if not self._semaphore.acquire(blocking=False):
+            self.count("rejected")
+            return False
+        with self._lock:
+            self.in_flight += 1
+            self.counters["requests"] += 1
+        return True
+
+    def call(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]],
+        callbacks: Optional[CallbackManager] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """
+        Generate a response on the backend, reporting it to the callbacks as a run of its own; the
+        slot claimed with `try_acquire` is released afterwards.
+        """
+        start_time = time.monotonic()
+        try:
+            result = self.chat_model.generate([messages], stop=stop, callbacks=callbacks, **kwargs)
+        except Exception:
+            self.count("errors")
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            with _slot_released:
+                self._semaphore.release()
+                _slot_released.notify_all()
+        self.latencies.record(time.monotonic() - start_time)
+        return ChatResult(generations=result.generations[0], llm_output=result.llm_output)
+
+    def stats(self) -> dict[str, Any]:
+        """
+        The counters, number of requests in flight and latency percentiles (in seconds) of the backend.
+        """
+        with self._lock:
+            stats: dict[str, Any] = {**self.counters, "in_flight": self.in_flight}
+        for percentile in (0.5, 0.95, 0.99):
+            stats[f"p{int(percentile * 100)}"] = self.latencies.percentile(percentile)
+        stats["samples"] = len(self.latencies)
+        return stats
+
+
+_backends: dict[str, RouterBackend] = {}
+_backends_lock = threading.Lock()
+_slot_released = threading.Condition()
+_executor: ThreadPoolExecutor | None = None
+
+
+def get_router_executor() -> ThreadPoolExecutor:
+    """
+    Get the process-wide thread pool that backend requests run in, creating it on first use, so
+    CHAT_MODEL_ROUTER_THREADS is read after the .env file is loaded.
+    """
+    global _executor  # pylint: disable=global-statement
+    with _backends_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(os.environ.get("CHAT_MODEL_ROUTER_THREADS", 32)), thread_name_prefix="chat-router"
+            )
+        return _executor
+
+
+def get_router_backend(name: str, create_chat_model: Callable[[], BaseChatModel]) -> RouterBackend:
+    """
+    Get the process-wide backend with the given name, creating it on first use.
+
+    The concurrency limit and timeout are read from CHAT_MODEL_ROUTER_CONCURRENCY and
+    CHAT_MODEL_ROUTER_TIMEOUT.
+
+    Args:
+        name (str): The name of the backend, e.g. "openai:gpt-3.5-turbo".
+        create_chat_model (Callable[[], BaseChatModel]): Creates the chat model of the backend.
+
+    Returns:
+        RouterBackend: The backend.
+
+    Raises:
+        ValueError: If the model of the backend is not a chat model.
+    """
+    with _backends_lock:
+        if name not in _backends:
+            chat_model = create_chat_model()
+            if not isinstance(chat_model, BaseChatModel):
+                raise ValueError(
+                    f"Chat model router backend {name} is not a chat model ({type(chat_model).__name__}); "
+                    "local models need LOCAL_LLM_SERVER_URL to be routed"
+                )
+            _backends[name] = RouterBackend(
+                name,
+                chat_model,
+                max_concurrency=int(os.environ.get("CHAT_MODEL_ROUTER_CONCURRENCY", 8)),
+                timeout=float(os.environ.get("CHAT_MODEL_ROUTER_TIMEOUT", 60)),
+            )
+        return _backends[name]
+
+
+def get_router_stats() -> dict[str, dict[str, Any]]:
+    """
+    The statistics of all backends in this process.
+    """
+    with _backends_lock:
+        backends = list(_backends.values())
+    return {backend.name: backend.stats() for backend in backends}
+
+
+class ChatModelRouter(BaseChatModel):
+    """
+    A chat model that routes every request over an ordered list of backends.
+
+    A request goes to the first backend with a free concurrency slot, waiting up to the queue
+    timeout when all backends are busy. When it has not answered after the hedge percentile of
+    that backend's latencies, the request is also sent to the next backend with a free slot, and
+    the first answer wins. A backend that fails or times out is replaced by the next one; only
+    when all backends have failed is the error raised.
+
+    Every backend request is a child run of the router's run, so callbacks see it; only the first
+    backend request that streams a token streams the answer.
+
+    Attributes:
+        backends (list[RouterBackend]): The backends, in order of preference.
+        hedge_percentile (float): The latency percentile of a backend after which a request is hedged.
+        min_hedge_delay (float): The minimum number of seconds before a request is hedged.
+        min_samples (int): The number of latencies a backend needs before requests to it are hedged.
+        queue_timeout (float): The number of seconds a request waits for a free slot when all backends are busy.
+    """
+
+    backends: List[RouterBackend]
+    hedge_percentile: float = 0.95
+    min_hedge_delay: float = 1.0
+    min_samples: int = 20
+    queue_timeout: float = 10.0
+
+    class Config:
+        """
+        Allows the backends, which are not pydantic models.
+        """
+
+        arbitrary_types_allowed = True
+
+    @property
+    def _llm_type(self) -> str:
+        return "chat-model-router"
+
+    def hedge_delay(self, backend: RouterBackend) -> float | None:
+        """
+        The number of seconds after which a request to a backend is hedged, or None if it is not hedged yet.
+        """
+        if len(backend.latencies) < self.min_samples:
+            return None
+        return max(self.min_hedge_delay, backend.latencies.percentile(self.hedge_percentile) or 0)
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        pending_backends = list(self.backends)
+        running: dict[Future, tuple[RouterBackend, float]] = {}
+        errors: list[str] = []
+        stream_claim = StreamClaim()
+
+        def backend_callbacks(call_id: int) -> Optional[CallbackManager]:
+            if run_manager is None:
+                return None
+            callbacks = CallbackManager(handlers=[], parent_run_id=run_manager.run_id)
+            callbacks.set_handlers(
+                [TokenFilter(handler, stream_claim, call_id) for handler in run_manager.inheritable_handlers]
+            )
+            callbacks.add_tags(run_manager.inheritable_tags)
+            callbacks.add_metadata(run_manager.inheritable_metadata)
+            return callbacks
+
+        def start_next(hedge: bool = False) -> None:
+            # a hedge only takes a free slot, a request waits for one
+            deadline = time.monotonic() + (0 if hedge else self.queue_timeout)
+            with _slot_released:
+                while True:
+                    for backend in pending_backends:
+                        if backend.try_acquire():
+                            pending_backends.remove(backend)
+                            if hedge:
+                                backend.count("hedges")
+                            future = get_router_executor().submit(
+                                backend.call, messages, stop, backend_callbacks(id(backend)), **kwargs
+                            )
+                            running[future] = (backend, time.monotonic())
+                            return
+                    if not pending_backends or not _slot_released.wait(max(0, deadline - time.monotonic())):
+                        break
+            errors.extend(f"{backend.name}: no free slot" for backend in pending_backends)
+            pending_backends.clear()
+
+        start_next()
+        answers: list[ChatResult] = []
+        while running:
+            hedge_time = None
+            if pending_backends and len(running) == 1 and stream_claim.owner is None:
+                backend, start_time = next(iter(running.values()))
+                if (delay := self.hedge_delay(backend)) is not None:
+                    hedge_time = start_time + delay
+            wake_up_times = [start_time + backend.timeout for backend, start_time in running.values()]
+            wake_up_time = min(wake_up_times + ([hedge_time] if hedge_time is not None else []))
+            done, _ = wait(list(running), timeout=max(0, wake_up_time - time.monotonic()), return_when=FIRST_COMPLETED)
+            for future in done:
+                backend, _ = running.pop(future)
+                try:
+                    answer = future.result()
+                except Exception as error:  # pylint: disable=broad-except
+                    stream_claim.give_up(id(backend))
+                    errors.append(f"{backend.name}: {error!r}")
+                    continue
+                if stream_claim.claim(id(backend)):
+                    return answer
+                answers.append(answer)  # another backend is streaming its answer, which wins unless it fails
+            for future, (backend, start_time) in list(running.items()):
+                if time.monotonic() >= start_time + backend.timeout:
+                    del running[future]  # the call keeps its slot until it actually finishes
+                    stream_claim.give_up(id(backend))
+                    backend.count("timeouts")
+                    errors.append(f"{backend.name}: timed out after {backend.timeout}s")
+            if answers and stream_claim.owner is None:
+                return answers[0]
+            if not running:
+                start_next()
+            elif hedge_time is not None and time.monotonic() >= hedge_time:
+                start_next(hedge=True)
+        raise RuntimeError(f"All chat model backends failed: {'; '.join(errors)}")
@@ -1,55 +1,256 @@
+import asyncio
+from functools import cached_property
 from os import environ as os_environ
 from typing import Any
 
-from langchain.chains import ConversationalRetrievalChain
-from langchain.chat_models.base import BaseChatModel
-from langchain.memory import ConversationBufferMemory
-from langchain_community.chat_message_histories import SQLChatMessageHistory
+from langchain_core.callbacks import BaseCallbackHandler
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, get_buffer_string
 from langchain_core.messages.base import messages_to_dict
+from langchain_core.prompts import PromptTemplate
 
 
+from .chat_history import NormalizedChatMessageHistory
 from .vector_db import VectorDatabase
 from .citation import Citations
 from .embed.embedding_factory import EmbeddingFactory
+from .metrics import InstrumentedEmbeddings, record_cache_lookup, stage_timer, token_usage_handler
+from .tracing import tracing_handler
 from .chat_model import ChatModel
+from .local_llm import LocalServerChatModel
+from .context_packer import ContextPacker, PackedContext
+from .question_condenser import QuestionCondenser
+from .single_flight import SingleFlight
 from .utils import Utils
 
+QA_PROMPT = PromptTemplate.from_template(
+    """Use the following pieces of context to answer the question at the end. If you don't know the answer, just say that you don't know, don't try to make up an answer.
+
+{context}
+
+Chat History:
+{chat_history}
+
+Question: {question}
+Helpful Answer:"""
+)
+
 
 class Chatbot:
     """
     The chatbot class with a run method
+
+    Identical first-turn prompts on the same documents that arrive while one of them is being
+    answered are coalesced, also across sessions: they wait for that answer instead of retrieving
+    and generating again.
     """
 
+    single_flight = SingleFlight()
+
     def __init__(
         self,
         user_id: str,
+        streaming: bool = False,
     ):
         self.user_id = user_id
-        self.embedding_fn = EmbeddingFactory().create()
+        self.embedding_fn = InstrumentedEmbeddings(EmbeddingFactory().create(), "prompt")
         self.vector_db = VectorDatabase(self.user_id, self.embedding_fn)
-        self.memory_db = SQLChatMessageHistory(self.user_id, Utils.get_env_variable("CHAT_HISTORY_CONNECTION_STRING"))
-        self.memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True, output_key="answer")
-        self.chat_model: BaseChatModel = ChatModel().chat_model
-        self.chatQA = ConversationalRetrievalChain.from_llm(  # pylint: disable=invalid-name
-            llm=self.chat_model,
-            retriever=self.vector_db.retriever,
-            memory=self.memory,
-            return_source_documents=True,
-        )
-        self.chat_history = self.memory_db.messages
+        self.chat_model: BaseChatModel = ChatModel(streaming=streaming).chat_model
+        # condense requests go to the shared chat model without a session: the local server would
+        # cache their state under the session, where the state of the answer replaces it right away
+        self.question_condenser = QuestionCondenser(self.chat_model)
+        if isinstance(self.chat_model, LocalServerChatModel):
+            # lets the local server reuse the KV cache of this session, on a copy of the shared chat model
+            self.chat_model = self.chat_model.copy(update={"session_id": self.user_id})
+        self.context_packer = ContextPacker(self.chat_model, prompt_template=QA_PROMPT)
+        # langchain.chains imports every chain, so it is imported when the first chatbot is built
+        from langchain.chains.question_answering import load_qa_chain  # pylint: disable=import-outside-toplevel
+
+        self.qa_chain = load_qa_chain(self.chat_model, chain_type="stuff", prompt=QA_PROMPT)
         self.last_n_messages = int(os_environ.get("LAST_N_MESSAGES", 5))
+        self.coalesce_enabled = os_environ.get("COALESCE_ENABLED", "true").lower() == "true"
 
-    def send_prompt(self, prompt: str) -> dict[str, Any]:
+    @cached_property
+    def memory_db(self) -> NormalizedChatMessageHistory:
         """
-        Method to send a prompt to the chatbot
+        The chat history of the session, read and written blocking by `send_prompt` and without
+        blocking by `asend_prompt`.
+        """
+        return NormalizedChatMessageHistory(self.user_id, Utils.get_env_variable("CHAT_HISTORY_CONNECTION_STRING"))
+
+    @property
+    def chat_history(self) -> list[BaseMessage]:
         """
-        result = self.chatQA({"question": prompt, "chat_history": self.chat_history[-self.last_n_messages :]})
-        citations = Citations(result["source_documents"])
+        The messages of the session, oldest first.
+        """
+        return self.memory_db.messages
+
+    def _build_result(
+        self,
+        prompt: str,
+        standalone_question: str,
+        answer: str,
+        packed_context: PackedContext,
+        history: list[BaseMessage] | None = None,
+    ) -> tuple[dict[str, Any], list[BaseMessage]]:
+        """
+        Build the result of a prompt and the messages of the new turn, with the citations of the answer.
+
+        The stored answer carries its citations, but in the chat history of the result it refers
+        to `result["citations"]` instead of repeating them. The chat history of the result is the
+        new turn, preceded by the earlier messages of the session if a history is passed.
+        """
+        messages: list[BaseMessage] = [HumanMessage(content=prompt), AIMessage(content=answer)]
+        result: dict[str, Any] = {
+            "question": prompt,
+            "standalone_question": standalone_question,
+            "answer": answer,
+            "context_tokens": dict(packed_context.token_usage),
+        }
+        citations = Citations(packed_context.documents, answer=answer)
         result["citations"] = citations.__dict__()
-        for message in result["chat_history"]:
+        for message in messages:
             if message.type == "ai":
                 message.additional_kwargs["citations"] = result["citations"]
-            self.memory_db.add_message(message)
-        del result["source_documents"]
-        result["chat_history"] = messages_to_dict(result["chat_history"]) 
+        turn = messages_to_dict(messages)
+        for message_dict in turn:
+            if message_dict["type"] == "ai":
+                message_dict["data"]["additional_kwargs"] = {"citations_ref": "citations"}
+        result["chat_history"] = messages_to_dict(history or []) + turn
+        return result, messages
+
+    def _coalesce_key(self, prompt: str, chat_history: list[BaseMessage]) -> tuple[str, str, bool] | None:
+        """
+        The key on which identical prompts are coalesced: the content fingerprint of the collection,
+        the normalised question and the empty-history flag. Sessions that uploaded the same documents
+        share a fingerprint. Follow-up prompts depend on their history and are never coalesced.
+        """
+        if not self.coalesce_enabled or chat_history:
+            return None
+        return (self.vector_db.content_fingerprint, " ".join(prompt.lower().split()), True)
+
+    def _record_condense_outcome(self) -> None:
+        if self.question_condenser.last_outcome in ("cache_hit", "rewritten"):
+            record_cache_lookup("condense", self.question_condenser.last_outcome == "cache_hit")
+
+    def _answer(self, prompt: str, chat_history: list[BaseMessage]) -> tuple[str, str, PackedContext]:
+        """
+        Condense the prompt, retrieve and pack the context and generate the answer.
+        """
+        with stage_timer("prompt", "condense"):
+            standalone_question = self.question_condenser.condense(prompt, chat_history)
+        self._record_condense_outcome()
+        with stage_timer("prompt", "retrieve"):
+            source_documents = self.vector_db.retriever.get_relevant_documents(
+                standalone_question, callbacks=[tracing_handler]
+            )
+        with stage_timer("prompt", "pack"):
+            packed_context = self.context_packer.pack(standalone_question, source_documents, chat_history)
+        with stage_timer("prompt", "llm"):
+            answer = self.qa_chain.run(
+                input_documents=packed_context.documents,
+                question=standalone_question,
+                chat_history=get_buffer_string(packed_context.chat_history),
+                callbacks=[token_usage_handler, tracing_handler],
+            )
+        return standalone_question, answer, packed_context
+
+    async def _aanswer(
+        self, prompt: str, chat_history: list[BaseMessage], callbacks: list[BaseCallbackHandler] | None = None
+    ) -> tuple[str, str, PackedContext]:
+        """
+        The async counterpart of `_answer`; the callbacks receive the tokens of the answer.
+        """
+        with stage_timer("prompt", "condense"):
+            standalone_question = await self.question_condenser.acondense(prompt, chat_history)
+        self._record_condense_outcome()
+        with stage_timer("prompt", "retrieve"):
+            source_documents = await self.vector_db.retriever.aget_relevant_documents(
+                standalone_question, callbacks=[tracing_handler]
+            )
+        with stage_timer("prompt", "pack"):
+            # counting tokens and comparing chunks is CPU work that would hold up the event loop
+            packed_context = await asyncio.to_thread(
+                self.context_packer.pack, standalone_question, source_documents, chat_history
+            )
+        with stage_timer("prompt", "llm"):
+            answer = await self.qa_chain.arun(
+                input_documents=packed_context.documents,
+                question=standalone_question,
+                chat_history=get_buffer_string(packed_context.chat_history),
+                callbacks=[*(callbacks or []), token_usage_handler, tracing_handler],
+            )
+        return standalone_question, answer, packed_context
+
+    def send_prompt(self, prompt: str, include_history: bool = False) -> dict[str, Any]:
+        """
+        Method to send a prompt to the chatbot
+
+        The question is condensed into a standalone question, the retrieved chunks and the recent
+        chat history are packed into the token budget of the prompt, and only the packed chunks
+        are passed to the chat model and cited. Every caller gets its own result and citations
+        and the turn is written to its own session, also when the answer was coalesced. The chat
+        history of the result only holds the new turn, unless `include_history` is set.
+        """
+        with stage_timer("prompt", "history"):
+            if include_history:
+                history = self.chat_history
+                chat_history = history[-self.last_n_messages :]
+            else:
+                history = []
+                # only the recent messages are passed to the chat model, without their citations
+                chat_history = self.memory_db.get_messages(with_citations=False, last_n=self.last_n_messages or None)
+        if (coalesce_key := self._coalesce_key(prompt, chat_history)) is not None:
+            computed = []
+
+            def answer() -> tuple[str, str, PackedContext]:
+                computed.append(True)
+                return self._answer(prompt, chat_history)
+
+            answered = self.single_flight.do(coalesce_key, answer)
+            record_cache_lookup("coalesce", not computed)
+        else:
+            answered = self._answer(prompt, chat_history)
+        result, messages = self._build_result(prompt, *answered, history=history)
+        with stage_timer("prompt", "db_write"):
+            self.memory_db.add_messages(messages)
+        return result
+
+    async def asend_prompt(
+        self, prompt: str, callbacks: list[BaseCallbackHandler] | None = None, include_history: bool = False
+    ) -> dict[str, Any]:
+        """
+        Method to send a prompt to the chatbot without blocking the event loop
+
+        Works like `send_prompt`, but the chat history is read and written with an async driver
+        and the retrieval and chat model calls are awaited, so a single worker can serve many
+        prompts that are waiting on the chat model at the same time. The callbacks receive the
+        tokens of the answer as they are generated (for a chatbot created with streaming=True);
+        a coalesced prompt only receives the final answer.
+        """
+        with stage_timer("prompt", "history"):
+            if include_history:
+                history = await self.memory_db.aget_messages()
+                chat_history = history[-self.last_n_messages :]
+            else:
+                history = []
+                chat_history = await self.memory_db.aget_messages(
+                    with_citations=False, last_n=self.last_n_messages or None
+                )
+        # the fingerprint is read from the vector database, which only has a blocking client
+        if (coalesce_key := await asyncio.to_thread(self._coalesce_key, prompt, chat_history)) is not None:
+            computed = []
+
+            async def aanswer() -> tuple[str, str, PackedContext]:
+                computed.append(True)
+                return await self._aanswer(prompt, chat_history, callbacks)
+
+            answered = await self.single_flight.ado(coalesce_key, aanswer)
+            record_cache_lookup("coalesce", not computed)
+        else:
+            answered = await self._aanswer(prompt, chat_history, callbacks)
+        result, messages = self._build_result(prompt, *answered, history=history)
+        with stage_timer("prompt", "db_write"):
+            await self.memory_db.aadd_messages(messages)
         return result
@@ -2,6 +2,11 @@ from dataclasses import dataclass, field
 from abc import abstractmethod
 from typing import Any
 from pathlib import Path
+import hashlib
+import heapq
+import math
+import os
+import re
 from chatdoc.utils import Utils
 
 
@@ -20,12 +25,37 @@ class BaseCitation:
         Returns:
             dict: The citation as a dictionary.
         """
-        return {"source": self.source, "page": self.page, "ranking": self.ranking, "score": self.score, "text": self.format_citation_text()}
+        return {
+            "source": self.source,
+            "page": self.page,
+            "page_end": self.page_end,
+            "section": self.section,
+            "ranking": self.ranking,
+            "score": self.score,
+            "text": self.format_citation_text(),
+        }
 
     source: str
     page: int
     ranking: int
     score: float
+    page_end: int | None = field(default=None, kw_only=True)
+    section: str = field(default="", kw_only=True)
+
+    def format_page_reference(self) -> str:
+        """
+        Format the page range and section of the citation, e.g. "pages 12–13, §3.2".
+
+        Returns:
+            str: The page reference of the citation.
+        """
+        if self.page_end is not None and self.page_end != self.page:
+            page_reference = f"pages {self.page}–{self.page_end}"
+        else:
+            page_reference = f"page {self.page}"
+        if self.section:
+            page_reference += f", {self.section}"
+        return page_reference
 
     @abstractmethod
     def format_citation_text(self):
@@ -34,7 +64,45 @@ class BaseCitation:
 
         This method formats the text from the citation into a specific format. It returns a string that includes the source and the page number of the citation.
         """
-        return f" - {self.source} on page {self.page}"
+        return f" - {self.source} on {self.format_page_reference()}"
+
+
+@dataclass(frozen=True)
+class ProofSpan:
+    """
+    A sentence of a chunk that supports the answer.
+
+    Attributes:
+        text (str): The sentence.
+        start (int): The offset of the sentence in the text of the chunk.
+        end (int): The offset just past the sentence in the text of the chunk.
+        ranking (int): The ranking of the chunk the sentence is taken from.
+        score (float): The lexical overlap of the sentence with the answer.
+        chunk_id (str): The ID of the chunk the sentence is taken from, see `get_chunk_id`.
+    """
+
+    text: str
+    start: int
+    end: int
+    ranking: int
+    score: float
+    chunk_id: str = field(default="", kw_only=True)
+
+    def __dict__(self):
+        """
+        Return the span as a dictionary.
+
+        Returns:
+            dict: The span as a dictionary.
+        """
+        return {
+            "text": self.text,
+            "start": self.start,
+            "end": self.end,
+            "ranking": self.ranking,
+            "score": round(self.score, 3),
+            "chunk_id": self.chunk_id,
+        }
 
 
 @dataclass(frozen=True)
@@ -50,9 +118,15 @@ class ProofCitation(BaseCitation):
         Returns:
             dict: The citation as a dictionary.
         """
-        return {**super().__dict__(), "proof": self.proof,"text": self.format_citation_text()}
+        return {
+            **super().__dict__(),
+            "proof": self.proof,
+            "spans": [span.__dict__() for span in self.spans],
+            "text": self.format_citation_text(),
+        }
 
     proof: str
+    spans: tuple[ProofSpan, ...] = field(default=(), kw_only=True)
 
     def format_citation_text(self):
         """
@@ -60,30 +134,85 @@ class ProofCitation(BaseCitation):
 
         Returns a formatted string containing the source, page number, and proof of the citation.
         """
-        return f" - {self.source} on page {self.page}; PROOF: {self.proof}"
+        return f" - {self.source} on {self.format_page_reference()}; PROOF: {self.proof}"
 
 
 Citation = BaseCitation | ProofCitation
 
+# a sentence ends at punctuation followed by whitespace (so "2.4" does not end one) or at the end of a line
+SENTENCE_PATTERN = re.compile(r"\S(?:[^.!?\n]+|[.!?]+(?!\s|$))*[.!?]*")
+WORD_PATTERN = re.compile(r"\w{3,}")
+# common English and Dutch words that say nothing about whether a sentence supports the answer
+STOP_WORDS = frozenset(
+    "the and for are was were with that this from have has not but all can its their there which "
+    "een het van die dat met voor niet zijn ook aan als bij dan door maar nog naar wel wat worden wordt".split()
+)
+
+
+def content_words(text: str) -> set[str]:
+    """
+    The lower-cased words of three or more characters of a text, without stop words.
+    """
+    return set(WORD_PATTERN.findall(text.lower())) - STOP_WORDS
+
+
+def get_chunk_id(text: str) -> str:
+    """
+    The ID of a chunk, a hash of its text, so the same chunk has the same ID in every citation.
+    """
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def find_proof_spans(text: str, answer_words: set[str], ranking: int, limit: int | None = None) -> list[ProofSpan]:
+    """
+    Score the sentences of a chunk by the content words they share with the answer, normalised by
+    the square root of their own number of content words, so that short sentences that are mostly
+    about the answer win over long sentences that happen to share a word.
+
+    Args:
+        text (str): The text of the chunk.
+        answer_words (set[str]): The content words of the answer.
+        ranking (int): The ranking of the chunk.
+        limit (int | None): The maximum number of sentences to return, the best-scoring first.
+
+    Returns:
+        list[ProofSpan]: The sentences that share a word with the answer, in order of the text
+        unless a limit is given.
+    """
+    scored = []
+    for match in SENTENCE_PATTERN.finditer(text):
+        sentence_words = content_words(match.group())
+        if overlap := len(sentence_words & answer_words):
+            sentence = match.group().rstrip()
+            scored.append((overlap / math.sqrt(len(sentence_words)), match.start(), match.start() + len(sentence)))
+    if limit is not None:
+        scored = heapq.nlargest(limit, scored, key=lambda item: item[0])
+    chunk_id = get_chunk_id(text)
+    return [ProofSpan(text[start:end], start, end, ranking, score, chunk_id=chunk_id) for score, start, end in scored]
+
 
 @dataclass
 class Citations:
     """
     A set of citations.
 
-    This class represents a collection of citations. It provides methods to add citations, get unique citations from source documents, and print the citations.
+    The chunks of the same page of the same source are merged into one citation in a single pass,
+    which keeps the best ranking and score of the chunks. With proof, a citation carries the
+    sentences of its chunks that best match the answer (up to CITATION_MAX_SPANS, default 2, with
+    their offsets in the chunk) instead of the whole chunks; without an answer, the first sentence
+    of its best-ranked chunk.
     """
     source_documents: list[Any]
-    citations: set[Citation] = field(default_factory=set)
+    citations: list[Citation] = field(default_factory=list)
     with_proof: bool = True
+    answer: str = ""
+    max_spans: int = field(default_factory=lambda: int(os.environ.get("CITATION_MAX_SPANS", 2)))
 
     def __post_init__(self):
         """
         Initialize the citations.
         """
         self.get_unique_citations()
-        
-        
 
     def __dict__(self):
         """
@@ -92,28 +221,76 @@ class Citations:
         Returns:
             dict: The citations as a dictionary.
         """
-        source_citations = [citation.__dict__() for citation in self.citations]
-        source_citations.sort(key=lambda citation: citation["ranking"])
-        return {"citations": source_citations, "with_proof": self.with_proof}
+        return {"citations": [citation.__dict__() for citation in self.citations], "with_proof": self.with_proof}
 
-    
     def get_unique_citations(self):
         """
         Get the unique citations from the source documents.
 
-        Iterate through the list of source documents and extract the source, page number, and proof for each document. Then, add the citation to the collection of unique citations.
+        Iterate through the list of source documents once, merging the documents of the same source
+        and page, and add the merged citations in order of ranking.
         """
-
+        answer_words = content_words(self.answer)
+        merged: dict[tuple[str, int], dict[str, Any]] = {}
         for source_document in self.source_documents:
-            raw_source = source_document.metadata["source"]
-            source = Utils.remove_date_from_filename(Path(raw_source).name)
-            page = source_document.metadata["page"] + 1
-            proof = source_document.page_content
-            ranking = source_document.metadata["ranking"]
-            score = source_document.metadata["score"] if "score" in source_document.metadata else -1.0
-            citation: Citation = ProofCitation(source, page, ranking, score, proof) if self.with_proof else BaseCitation(source, page, ranking, score)
-            self.citations.add(citation)
-
+            metadata = source_document.metadata
+            source = Utils.remove_date_from_filename(Path(metadata["source"]).name)
+            # Word documents have no pages, their chunks are cited as page 1
+            page = metadata.get("page", 0) + 1
+            ranking = metadata["ranking"]
+            score = metadata.get("score", -1.0)
+            spans = (
+                find_proof_spans(source_document.page_content, answer_words, ranking, self.max_spans)
+                if self.with_proof
+                else []
+            )
+            if (citation := merged.get((source, page))) is None:
+                merged[(source, page)] = {
+                    "page_end": metadata["page_end"] + 1 if "page_end" in metadata else None,
+                    "section": metadata.get("section", ""),
+                    "ranking": ranking,
+                    "score": score,
+                    "spans": spans,
+                    "first_chunk": (ranking, source_document.page_content),
+                }
+                continue
+            if "page_end" in metadata:
+                citation["page_end"] = max(citation["page_end"] or page, metadata["page_end"] + 1)
+            citation["ranking"] = min(citation["ranking"], ranking)
+            citation["score"] = max(citation["score"], score)
+            citation["spans"].extend(spans)
+            citation["first_chunk"] = min(citation["first_chunk"], (ranking, source_document.page_content))
+        for (source, page), citation in sorted(merged.items(), key=lambda item: item[1]["ranking"]):
+            kwargs = {"page_end": citation["page_end"], "section": citation["section"]}
+            if not self.with_proof:
+                self.citations.append(BaseCitation(source, page, citation["ranking"], citation["score"], **kwargs))
+                continue
+            spans = heapq.nlargest(self.max_spans, citation["spans"], key=lambda span: span.score)
+            if not spans:
+                first_ranking, first_text = citation["first_chunk"]
+                if (match := SENTENCE_PATTERN.search(first_text)) is not None:
+                    sentence = match.group().rstrip()
+                    spans = [
+                        ProofSpan(
+                            sentence,
+                            match.start(),
+                            match.start() + len(sentence),
+                            first_ranking,
+                            0.0,
+                            chunk_id=get_chunk_id(first_text),
+                        )
+                    ]
+            self.citations.append(
+                ProofCitation(
+                    source,
+                    page,
+                    citation["ranking"],
+                    citation["score"],
+                    " … ".join(span.text for span in spans),
+                    spans=tuple(spans),
+                    **kwargs,
+                )
+            )
 
     def print_citations(self):
         """
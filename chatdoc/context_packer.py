@@ -0,0 +1,205 @@
+"""
+Module defining the ContextPacker class, which fits retrieved chunks and chat history into a token budget
+"""
+import os
+from dataclasses import dataclass, field
+from functools import cached_property
+
+from langchain.schema import Document
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.prompts import BasePromptTemplate
+
+from .chat_router import ChatModelRouter
+from .doc_loader.dedup import MinHashDeduplicator
+from .local_llm import LocalServerChatModel, load_local_llm_settings
+
+
+DEFAULT_TOKEN_BUDGET = 3000
+MIN_TRIMMED_MESSAGE_TOKENS = 32
+TRIMMED_MESSAGE_MARKER = "…"
+
+
+@dataclass
+class PackedContext:
+    """
+    The context that fits in the prompt.
+
+    Attributes:
+        documents (list[Document]): The selected chunks, in order of ranking.
+        chat_history (list[BaseMessage]): The selected (and possibly trimmed) messages, oldest first.
+        token_usage (dict[str, int]): The number of tokens used per part of the prompt and the number of dropped items.
+    """
+
+    documents: list[Document]
+    chat_history: list[BaseMessage]
+    token_usage: dict[str, int] = field(default_factory=dict)
+
+
+def model_token_budget(chat_model: BaseChatModel) -> int:
+    """
+    The number of prompt tokens a chat model has room for: the context size minus the maximum
+    number of generated tokens for local models, the smallest budget of the backends for a
+    router, and DEFAULT_TOKEN_BUDGET for models whose context size is not known.
+    """
+    if isinstance(chat_model, ChatModelRouter):
+        return min(model_token_budget(backend.chat_model) for backend in chat_model.backends)
+    if isinstance(chat_model, LocalServerChatModel):
+        return load_local_llm_settings()["n_ctx"] - chat_model.max_tokens
+    # a llama.cpp model in this process (LlamaCpp)
+    n_ctx, max_tokens = getattr(chat_model, "n_ctx", None), getattr(chat_model, "max_tokens", None)
+    if isinstance(n_ctx, int) and isinstance(max_tokens, int):
+        return n_ctx - max_tokens
+    return DEFAULT_TOKEN_BUDGET
+
+
+class ContextPacker:
+    """
+    Packs the retrieved chunks and the chat history into a token budget for the chat model.
+
+    Tokens are counted with the tokenizer of the configured chat model. The budget defaults to the
+    prompt tokens the chat model has room for (see `model_token_budget`), and the tokens of the
+    prompt template are taken off it. The newest messages are taken first, up to a share of the
+    budget, and the oldest message that does not fit entirely is trimmed. The rest of the budget
+    is filled with chunks in order of their ranking, skipping chunks that are near-duplicates of
+    a chunk that was already selected.
+
+    Attributes:
+        chat_model (BaseChatModel): The chat model whose tokenizer is used.
+        token_budget (int): The number of prompt tokens available for the template, question, history and chunks.
+        history_ratio (float): The share of the budget that the chat history may use.
+        redundancy_threshold (float): The estimated similarity from which a chunk counts as redundant.
+        prompt_template (BasePromptTemplate | None): The prompt the question, history and chunks are put in.
+    """
+
+    def __init__(
+        self,
+        chat_model: BaseChatModel,
+        token_budget: int | None = None,
+        history_ratio: float | None = None,
+        redundancy_threshold: float | None = None,
+        prompt_template: BasePromptTemplate | None = None,
+    ) -> None:
+        self.chat_model = chat_model
+        if token_budget is None:
+            token_budget = (
+                int(os.environ["CONTEXT_TOKEN_BUDGET"])
+                if "CONTEXT_TOKEN_BUDGET" in os.environ
+                else model_token_budget(chat_model)
+            )
+        self.token_budget = token_budget
+        self.history_ratio = (
+            history_ratio if history_ratio is not None else float(os.environ.get("CONTEXT_HISTORY_RATIO", 0.25))
+        )
+        self.redundancy_threshold = (
+            redundancy_threshold
+            if redundancy_threshold is not None
+            else float(os.environ.get("CONTEXT_REDUNDANCY_THRESHOLD", 0.8))
+        )
+        self.prompt_template = prompt_template
+        self._has_tokenizer = True
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Count the tokens of a text with the tokenizer of the chat model.
+
+        Falls back on an estimate of four characters per token for models without a tokenizer.
+        """
+        if self._has_tokenizer:
+            try:
+                return self.chat_model.get_num_tokens(text)
+            except ImportError:
+                self._has_tokenizer = False
+        return len(text) // 4 + 1
+
+    @cached_property
+    def template_tokens(self) -> int:
+        """
+        The number of tokens of the prompt template, rendered without a question, history or chunks.
+        """
+        if self.prompt_template is None:
+            return 0
+        return self.count_tokens(
+            self.prompt_template.format(**{variable: "" for variable in self.prompt_template.input_variables})
+        )
+
+    def _trim_message(self, message: BaseMessage, tokens: int, max_tokens: int) -> BaseMessage:
+        """
+        Trim a message to roughly the given number of tokens, keeping its most recent part.
+        """
+        content = str(message.content)
+        keep_characters = int(len(content) * max_tokens / tokens)
+        return message.copy(update={"content": TRIMMED_MESSAGE_MARKER + content[len(content) - keep_characters :]})
+
+    def pack_chat_history(self, chat_history: list[BaseMessage], max_tokens: int) -> tuple[list[BaseMessage], int]:
+        """
+        Select the newest messages that fit in the given number of tokens.
+
+        Returns:
+            tuple[list[BaseMessage], int]: The selected messages, oldest first, and the tokens they use.
+        """
+        packed_history: list[BaseMessage] = []
+        used_tokens = 0
+        for message in reversed(chat_history):
+            tokens = self.count_tokens(str(message.content))
+            if used_tokens + tokens > max_tokens:
+                remaining_tokens = max_tokens - used_tokens
+                if remaining_tokens >= MIN_TRIMMED_MESSAGE_TOKENS:
+                    packed_history.append(self._trim_message(message, tokens, remaining_tokens))
+                    used_tokens += remaining_tokens
+                break
+            packed_history.append(message)
+            used_tokens += tokens
+        packed_history.reverse()
+        return packed_history, used_tokens
+
+    def pack(self, question: str, documents: list[Document], chat_history: list[BaseMessage]) -> PackedContext:
+        """
+        Pack the chunks and chat history for a question into the token budget.
+
+        Args:
+            question (str): The (standalone) question.
+            documents (list[Document]): The retrieved chunks with a "ranking" in their metadata.
+            chat_history (list[BaseMessage]): The recent messages of the conversation.
+
+        Returns:
+            PackedContext: The selected chunks and messages and the token usage.
+        """
+        question_tokens = self.count_tokens(question)
+        available_tokens = max(0, self.token_budget - self.template_tokens - question_tokens)
+        packed_history, history_tokens = self.pack_chat_history(
+            chat_history, int(available_tokens * self.history_ratio)
+        )
+        document_budget = available_tokens - history_tokens
+        deduplicator = MinHashDeduplicator(threshold=self.redundancy_threshold)
+        packed_documents: list[Document] = []
+        document_tokens = 0
+        dropped_redundant = 0
+        dropped_over_budget = 0
+        for document in sorted(documents, key=lambda doc: doc.metadata.get("ranking", 0)):
+            signature = deduplicator.signature(document.page_content)
+            if deduplicator.find_duplicate(signature) is not None:
+                dropped_redundant += 1
+                continue
+            tokens = self.count_tokens(document.page_content)
+            if document_tokens + tokens > document_budget:
+                dropped_over_budget += 1
+                continue
+            deduplicator.add(signature)
+            packed_documents.append(document)
+            document_tokens += tokens
+        return PackedContext(
+            documents=packed_documents,
+            chat_history=packed_history,
+            token_usage={
+                "template": self.template_tokens,
+                "question": question_tokens,
+                "chat_history": history_tokens,
+                "documents": document_tokens,
+                "total": self.template_tokens + question_tokens + history_tokens + document_tokens,
+                "budget": self.token_budget,
+                "dropped_messages": len(chat_history) - len(packed_history),
+                "dropped_redundant_documents": dropped_redundant,
+                "dropped_over_budget_documents": dropped_over_budget,
+            },
+        )
@@ -0,0 +1,118 @@
+"""
+Module defining the BoilerplateStripper class for running headers, footers and page numbers
+"""
+import os
+import re
+from collections import Counter
+from typing import Iterable, Iterator
+
+from langchain.schema import Document
+
+
+DIGIT_PATTERN = re.compile(r"\d+")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+class BoilerplateStripper:
+    """
+    Strips the lines that repeat at the top or bottom of most pages of a document.
+
+    The first and last few lines of every page are normalised (digits are masked, so "Page 3 of 10"
+    and "Page 4 of 10" are the same line) and counted across all pages in one pass. Lines that
+    appear on at least a given ratio of the pages are running headers or footers and are removed
+    from the edges of every page before the document is split into chunks.
+
+    Attributes:
+        edge_lines (int): The number of lines at the top and bottom of a page that are considered.
+        page_ratio (float): The ratio of pages a line must appear on to be considered boilerplate.
+        min_pages (int): The minimum number of pages a document needs before anything is stripped.
+    """
+
+    def __init__(
+        self, edge_lines: int | None = None, page_ratio: float | None = None, min_pages: int | None = None
+    ) -> None:
+        self.edge_lines = edge_lines if edge_lines is not None else int(os.environ.get("BOILERPLATE_EDGE_LINES", 3))
+        self.page_ratio = (
+            page_ratio if page_ratio is not None else float(os.environ.get("BOILERPLATE_PAGE_RATIO", 0.6))
+        )
+        self.min_pages = min_pages if min_pages is not None else int(os.environ.get("BOILERPLATE_MIN_PAGES", 3))
+
+    @staticmethod
+    def normalize_line(line: str) -> str:
+        """
+        Normalise a line so that repetitions differing only in numbers or whitespace match.
+        """
+        return WHITESPACE_PATTERN.sub(" ", DIGIT_PATTERN.sub("#", line)).strip().lower()
+
+    def _edge_lines(self, lines: list[str]) -> list[str]:
+        return lines[: self.edge_lines] + lines[max(self.edge_lines, len(lines) - self.edge_lines) :]
+
+    def find_boilerplate(self, pages: list[list[str]]) -> set[str]:
+        """
+        Find the normalised lines that repeat at the edges of most pages.
+
+        Args:
+            pages (list[list[str]]): The non-empty lines of every page.
+
+        Returns:
+            set[str]: The normalised boilerplate lines.
+        """
+        line_counter: Counter[str] = Counter()
+        for lines in pages:
+            line_counter.update({self.normalize_line(line) for line in self._edge_lines(lines)})
+        min_count = max(2, self.page_ratio * len(pages))
+        return {line for line, count in line_counter.items() if line and count >= min_count}
+
+    def strip_page(self, lines: list[str], boilerplate: set[str]) -> tuple[list[str], list[str]]:
+        """
+        Strip the boilerplate lines from the top and bottom edges of a page; blank lines are kept.
+
+        Returns:
+            tuple[list[str], list[str]]: The remaining lines and the removed lines.
+        """
+        content_indices = [index for index, line in enumerate(lines) if line.strip()]
+        removed_indices: set[int] = set()
+        for index in content_indices[: self.edge_lines]:
+            if self.normalize_line(lines[index]) not in boilerplate:
+                break
+            removed_indices.add(index)
+        for index in reversed(content_indices[-self.edge_lines :]):
+            if index in removed_indices or self.normalize_line(lines[index]) not in boilerplate:
+                break
+            removed_indices.add(index)
+        if len(removed_indices) == len(content_indices):
+            return lines, []  # never strip a page bare, its content merely looks like boilerplate
+        kept_lines = [line for index, line in enumerate(lines) if index not in removed_indices]
+        return kept_lines, [lines[index] for index in sorted(removed_indices)]
+
+    def process(self, documents: Iterable[Document]) -> Iterator[Document]:
+        """
+        Yield the page-level documents with their running headers and footers removed.
+
+        The removed lines are recorded in the "boilerplate" metadata of every page.
+
+        Args:
+            documents (Iterable[Document]): The page-level documents of a single file.
+
+        Yields:
+            Document: The cleaned page-level documents.
+        """
+        pages = list(documents)
+        if len(pages) < self.min_pages:
+            yield from pages
+            return
+        page_lines = [page.page_content.splitlines() for page in pages]
+        boilerplate = self.find_boilerplate([[line for line in lines if line.strip()] for lines in page_lines])
+        if not boilerplate:
+            yield from pages
+            return
+        removed_lines: dict[str, str] = {}
+        for page, lines in zip(pages, page_lines):
+            kept_lines, page_removed_lines = self.strip_page(lines, boilerplate)
+            for line in page_removed_lines:
+                removed_lines.setdefault(self.normalize_line(line), line.strip())
+            page.page_content = "\n".join(kept_lines).strip()
+        removed_summary = " | ".join(removed_lines.values())
+        for page in pages:
+            page.metadata["boilerplate"] = removed_summary
+            yield page
@@ -0,0 +1,156 @@
+"""
+Module defining the MinHashDeduplicator class for near-duplicate chunk detection
+"""
+import os
+import random
+import re
+import zlib
+from langchain.schema import Document
+
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+WORD_PATTERN = re.compile(r"\w+")
+DIGIT_PATTERN = re.compile(r"\d+")
+
+Signature = tuple[int, ...]
+
+
+class MinHashDeduplicator:
+    """
+    Detects near-duplicate chunks with MinHash signatures and locality-sensitive hashing.
+
+    Every chunk is reduced to a set of word shingles, of which a MinHash signature is computed.
+    The signature is split into bands that are hashed into buckets, so only chunks sharing a
+    bucket are compared. Two chunks are near-duplicates when the estimated Jaccard similarity of
+    their shingle sets reaches the threshold.
+
+    Attributes:
+        num_permutations (int): The number of hash permutations in a signature.
+        threshold (float): The estimated Jaccard similarity from which chunks count as duplicates.
+        shingle_size (int): The number of words per shingle.
+        bands (int): The number of LSH bands the signature is split into.
+        rows (int): The number of signature values per band.
+    """
+
+    def __init__(
+        self,
+        num_permutations: int | None = None,
+        threshold: float | None = None,
+        shingle_size: int | None = None,
+        seed: int = 1,
+    ) -> None:
+        self.num_permutations = (
+            num_permutations if num_permutations is not None else int(os.environ.get("DEDUP_NUM_PERMUTATIONS", 64))
+        )
+        self.threshold = threshold if threshold is not None else float(os.environ.get("DEDUP_THRESHOLD", 0.9))
+        self.shingle_size = shingle_size if shingle_size is not None else int(os.environ.get("DEDUP_SHINGLE_SIZE", 5))
+        self.bands, self.rows = self.optimal_bands(self.num_permutations, self.threshold)
+        rng = random.Random(seed)
+        self._permutations = [
+            (rng.randint(1, MERSENNE_PRIME - 1), rng.randint(0, MERSENNE_PRIME - 1))
+            for _ in range(self.num_permutations)
+        ]
+        self._signatures: list[Signature] = []
+        self._buckets: dict[tuple[int, Signature], list[int]] = {}
+
+    @staticmethod
+    def optimal_bands(num_permutations: int, threshold: float) -> tuple[int, int]:
+        """
+        Choose the number of bands and rows whose LSH threshold (1/b)^(1/r) is closest to the threshold.
+
+        Returns:
+            tuple[int, int]: The number of bands and the number of rows per band.
+        """
+        divisors = [bands for bands in range(1, num_permutations + 1) if num_permutations % bands == 0]
+        bands = min(divisors, key=lambda b: abs((1 / b) ** (b / num_permutations) - threshold))
+        return bands, num_permutations // bands
+
+    def shingles(self, text: str) -> set[int]:
+        """
+        Compute the hashed word shingles of a text; digits are masked so page numbers do not matter.
+        """
+        words = WORD_PATTERN.findall(DIGIT_PATTERN.sub("0", text.lower()))
+        if len(words) <= self.shingle_size:
+            return {zlib.crc32(" ".join(words).encode("utf-8"))}
+        return {
+            zlib.crc32(" ".join(words[index : index + self.shingle_size]).encode("utf-8"))
+            for index in range(len(words) - self.shingle_size + 1)
+        }
+
+    def signature(self, text: str) -> Signature:
+        """
+        Compute the MinHash signature of a text.
+        """
+        shingles = self.shingles(text)
+        return tuple(
+            min(((a * shingle + b) % MERSENNE_PRIME) & MAX_HASH for shingle in shingles)
+            for a, b in self._permutations
+        )
+
+    def similarity(self, signature: Signature, other_signature: Signature) -> float:
+        """
+        Estimate the Jaccard similarity of two texts from their signatures.
+        """
+        return sum(value == other for value, other in zip(signature, other_signature)) / self.num_permutations
+
+    def _band_keys(self, signature: Signature) -> list[tuple[int, Signature]]:
+        return [(band, signature[band * self.rows : (band + 1) * self.rows]) for band in range(self.bands)]
+
+    def find_duplicate(self, signature: Signature) -> int | None:
+        """
+        Find an indexed signature that is a near-duplicate of the given signature.
+
+        Returns:
+            int | None: The index of the near-duplicate, or None if there is none.
+        """
+        seen: set[int] = set()
+        for band_key in self._band_keys(signature):
+            for index in self._buckets.get(band_key, []):
+                if index in seen:
+                    continue
+                seen.add(index)
+                if self.similarity(signature, self._signatures[index]) >= self.threshold:
+                    return index
+        return None
+
+    def add(self, signature: Signature) -> int:
+        """
+        Index a signature.
+
+        Returns:
+            int: The index of the signature.
+        """
+        index = len(self._signatures)
+        self._signatures.append(signature)
+        for band_key in self._band_keys(signature):
+            self._buckets.setdefault(band_key, []).append(index)
+        return index
+
+    def deduplicate(self, documents: list[Document]) -> tuple[list[Document], int]:
+        """
+        Remove the chunks that are near-duplicates of an earlier chunk.
+
+        A kept chunk counts the duplicates that were merged into it in its "duplicate_count"
+        metadata.
+
+        Args:
+            documents (list[Document]): The chunks of a file, in order.
+
+        Returns:
+            tuple[list[Document], int]: The kept chunks and the number of removed chunks.
+        """
+        kept_documents: list[Document] = []
+        kept_by_index: dict[int, Document] = {}
+        removed = 0
+        for document in documents:
+            signature = self.signature(document.page_content)
+            duplicate_index = self.find_duplicate(signature)
+            if duplicate_index is None:
+                kept_by_index[self.add(signature)] = document
+                kept_documents.append(document)
+                continue
+            removed += 1
+            if (kept_document := kept_by_index.get(duplicate_index)) is not None:
+                kept_document.metadata["duplicate_count"] = kept_document.metadata.get("duplicate_count", 0) + 1
+        return kept_documents, removed
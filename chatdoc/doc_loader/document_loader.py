@@ -1,13 +1,17 @@
+from contextlib import ExitStack
 from pathlib import Path
 from logging import Logger
-from typing import Iterator
-from tqdm.auto import tqdm
+from typing import Iterable, Iterator
 import os
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter, TextSplitter
 from langchain.schema import Document
 
-from chatdoc.doc_loader.document_loader_factory import DocumentLoaderFactory, BaseLoader
+from chatdoc.doc_loader.boilerplate import BoilerplateStripper
+from chatdoc.doc_loader.document_loader_factory import DocumentLoaderFactory
+from chatdoc.doc_loader.ocr import OCRStage
+from chatdoc.doc_loader.upload_buffer import Loader, UploadBuffer
+from chatdoc.doc_loader.structure_splitter import StructureAwareTextSplitter
 
 
 class DocumentLoader:
@@ -15,7 +19,7 @@ class DocumentLoader:
     A class that loads documents using a loader factory.
 
     Args:
-        document_dict (dict): A dictionary containing document names as keys and file paths as values.
+        document_dict (dict): A dictionary containing document names as keys and file paths or upload buffers as values.
         loader_factory (LoaderFactory): An instance of the loader factory used to create loaders.
 
     Attributes:
@@ -29,31 +33,41 @@ class DocumentLoader:
     """
 
     def __init__(
-        self, document_dict: dict[str, Path], loader_factory: DocumentLoaderFactory, logger: Logger | None = None
+        self,
+        document_dict: dict[str, Path | UploadBuffer],
+        loader_factory: DocumentLoaderFactory,
+        logger: Logger | None = None,
     ):
         self.loader_factory = loader_factory
         self.logger = logger if logger else Logger("DocumentLoader")
-        self.loaders_dict: dict[str, BaseLoader] = self.initialize_loaders(document_dict)
+        self.document_dict = document_dict
+        self.ocr_stage: OCRStage | None = self.load_ocr_stage()
+        self.boilerplate_stripper: BoilerplateStripper | None = self.load_boilerplate_stripper()
+        self.loaders_dict: dict[str, Loader] = self.initialize_loaders(document_dict)
         self.document_iterators_dict: dict[str, Iterator[Document]] = self.map_document_iterators()
         self.text_splitter: TextSplitter = self.load_token_text_splitter()
 
-    def initialize_loaders(self, document_dict: dict[str, Path]) -> dict[str, BaseLoader]:
+    def initialize_loaders(self, document_dict: dict[str, Path | UploadBuffer]) -> dict[str, Loader]:
         """
         Initializes the loaders using the document dictionary.
 
         Args:
-            document_dict (dict): A dictionary containing document names as keys and file paths as values.
+            document_dict (dict): A dictionary containing document names as keys and file paths or upload buffers as values.
 
         Returns:
             list: A list of loaders initialized using the document dictionary.
 
         """
         loaders_dict = {
-            file_name: self.loader_factory.create(
-                abs_file_path=str(file_path_obj.absolute()),
-                file_extension=file_path_obj.suffix,
+            file_name: (
+                self.loader_factory.create_from_buffer(file_obj)
+                if isinstance(file_obj, UploadBuffer)
+                else self.loader_factory.create(
+                    abs_file_path=str(file_obj.absolute()),
+                    file_extension=file_obj.suffix,
+                )
             )
-            for file_name, file_path_obj in tqdm(document_dict.items(), desc="load documents")
+            for file_name, file_obj in document_dict.items()
         }
         return loaders_dict
 
@@ -66,10 +80,69 @@ class DocumentLoader:
 
         """
         return {
-            file_name: loader.lazy_load()
-            for file_name, loader in tqdm(self.loaders_dict.items(), desc="map document iterators")
+            file_name: self.apply_loading_stages(file_name, loader.lazy_load())
+            for file_name, loader in self.loaders_dict.items()
         }
 
+    def apply_loading_stages(self, file_name: str, documents: Iterable[Document]) -> Iterator[Document]:
+        """
+        Applies the document-level loading stages to the documents of a single file.
+
+        Args:
+            file_name (str): The name of the file the documents were loaded from.
+            documents (Iterable[Document]): The page-level documents of the file.
+
+        Returns:
+            Iterator[Document]: The processed page-level documents.
+
+        """
+        file_obj = self.document_dict[file_name]
+        with ExitStack() as stack:
+            if self.ocr_stage is not None and file_obj.suffix == ".pdf":
+                if isinstance(file_obj, UploadBuffer):
+                    # the stream is closed once the documents are consumed, or when they are discarded
+                    pdf_source = stack.enter_context(file_obj.open()) if file_obj.in_memory else str(file_obj.path)
+                else:
+                    pdf_source = str(file_obj.absolute())
+                documents = self.ocr_stage.process(documents, pdf_source, file_name)
+            if self.boilerplate_stripper is not None:
+                documents = self.boilerplate_stripper.process(documents)
+            yield from documents
+
+    def load_ocr_stage(self) -> OCRStage | None:
+        """
+        Load the OCR fallback stage for image-only PDF pages.
+
+        The stage is enabled unless the environment variable "OCR_ENABLED" is set to "false",
+        and only if the optional OCR dependencies are installed.
+
+        Returns:
+            OCRStage | None: The OCR stage, or None if OCR is disabled or unavailable.
+
+        """
+        if os.environ.get("OCR_ENABLED", "true").lower() == "false":
+            self.logger.info(msg="OCR fallback disabled")
+            return None
+        if not OCRStage.is_available():
+            self.logger.warning(msg="OCR fallback unavailable, install the `ocr` extra to enable it")
+            return None
+        return OCRStage(self.logger)
+
+    def load_boilerplate_stripper(self) -> BoilerplateStripper | None:
+        """
+        Load the stage that strips running headers, footers and page numbers before splitting.
+
+        The stage is enabled unless the environment variable "BOILERPLATE_ENABLED" is set to "false".
+
+        Returns:
+            BoilerplateStripper | None: The boilerplate stripper, or None if it is disabled.
+
+        """
+        if os.environ.get("BOILERPLATE_ENABLED", "true").lower() == "false":
+            self.logger.info(msg="Boilerplate stripping disabled")
+            return None
+        return BoilerplateStripper()
+
     def load_token_text_splitter(self) -> TextSplitter:
         """
         Load and return the TextSplitter instance.
@@ -77,6 +150,9 @@ class DocumentLoader:
         If the chunk size is specified in the environment variable "CHUNK_SIZE",
         it will be used. Otherwise, if the chunk size is specified in the kwargs,
         it will be used. Otherwise, a default chunk size of 1000 will be used.
+        The environment variable "CHUNKING_STRATEGY" selects either the
+        structure-aware splitter ("structure", default) or the plain recursive
+        character splitter ("recursive").
 
         Args:
             **kwargs: Additional keyword arguments.
@@ -97,4 +173,12 @@ class DocumentLoader:
         else:
             self.logger.info(msg="No chunk overlap specified, defaulting to 0")
             chunk_overlap = 0
-        return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        chunking_strategy = os.environ.get("CHUNKING_STRATEGY", "structure")
+        self.logger.info(msg=f"Using {chunking_strategy} chunking strategy")
+        match chunking_strategy:
+            case "structure":
+                return StructureAwareTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+            case "recursive":
+                return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+            case _:
+                raise ValueError(f"Invalid chunking strategy: {chunking_strategy}")
@@ -1,20 +1,29 @@
-from langchain.document_loaders import PyPDFLoader, Docx2txtLoader
-from langchain.document_loaders.base import BaseLoader
+import importlib
+
+from chatdoc.doc_loader.upload_buffer import BufferedDocxLoader, BufferedPDFLoader, Loader, UploadBuffer
 
 
 class DocumentLoaderFactory:
     """
     Factory class for creating document loaders based on file extension.
+
+    The langchain loaders are given by import path and only imported when a loader is created,
+    since importing them pulls in every langchain document loader.
     """
 
     def __init__(self):
-        self.loader_map: dict[str, type[BaseLoader]] = {
-            ".pdf": PyPDFLoader,
-            ".docx": Docx2txtLoader,
+        self.loader_map: dict[str, str] = {
+            ".pdf": "langchain_community.document_loaders.pdf:PyPDFLoader",
+            ".docx": "langchain_community.document_loaders.word_document:Docx2txtLoader",
             # Add other file types and their corresponding loaders here
         }
+        self.buffer_loader_map: dict[str, type[BufferedPDFLoader] | type[BufferedDocxLoader]] = {
+            ".pdf": BufferedPDFLoader,
+            ".docx": BufferedDocxLoader,
+            # Add other file types and their corresponding in-memory loaders here
+        }
 
-    def create(self, abs_file_path: str, file_extension: str) -> BaseLoader:
+    def create(self, abs_file_path: str, file_extension: str) -> Loader:
         """
         Create a document loader based on the file extension.
 
@@ -23,12 +32,36 @@ class DocumentLoaderFactory:
             file_extension (str): The file extension of the document.
 
         Returns:
-            BaseLoader: An instance of the appropriate document loader.
+            Loader: An instance of the appropriate document loader.
 
         Raises:
             ValueError: If no loader is available for the given file extension.
         """
-        loader_class = self.loader_map.get(file_extension)
-        if loader_class is None:
+        loader_path = self.loader_map.get(file_extension)
+        if loader_path is None:
             raise ValueError(f"No loader available for file extension {file_extension}")
-        return loader_class(abs_file_path)
+        module_name, _, class_name = loader_path.partition(":")
+        return getattr(importlib.import_module(module_name), class_name)(abs_file_path)
+
+    def create_from_buffer(self, buffer: UploadBuffer) -> Loader:
+        """
+        Create a document loader that reads from an upload buffer.
+
+        Uploads held in memory are read directly from the buffer; uploads that were spilled to
+        disk are read by path with the regular loaders.
+
+        Args:
+            buffer (UploadBuffer): The upload buffer of the document.
+
+        Returns:
+            Loader: An instance of the appropriate document loader.
+
+        Raises:
+            ValueError: If no loader is available for the file extension of the upload.
+        """
+        if buffer.path is not None:
+            return self.create(str(buffer.path.absolute()), buffer.suffix)
+        loader_class = self.buffer_loader_map.get(buffer.suffix)
+        if loader_class is None:
+            raise ValueError(f"No loader available for file extension {buffer.suffix}")
+        return loader_class(buffer)
@@ -0,0 +1,262 @@
+"""
+Module defining the OCRStage class, an OCR fallback for image-only PDF pages
+"""
+import hashlib
+import importlib.util
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from logging import Logger
+from typing import BinaryIO, Callable, Iterable, Iterator
+
+from langchain.schema import Document
+
+from chatdoc.metrics import record_cache_lookup
+
+
+ProgressCallback = Callable[[str, int, int], None]
+# the OCR result of a page, its deadline and the pool it runs in
+Submission = tuple[Future[str], float, ProcessPoolExecutor]
+
+
+def ocr_page_images(images: list[bytes], language: str, timeout: float) -> str:
+    """
+    Run OCR on the images of a single page; executed inside a worker process.
+
+    Args:
+        images (list[bytes]): The encoded images found on the page.
+        language (str): The tesseract language(s) to use, e.g. "nld+eng".
+        timeout (float): The maximum number of seconds tesseract may spend on one image.
+
+    Returns:
+        str: The recognised text of the page.
+    """
+    import pytesseract  # pylint: disable=import-outside-toplevel
+    from PIL import Image  # pylint: disable=import-outside-toplevel
+
+    page_text = []
+    for image_bytes in images:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            page_text.append(pytesseract.image_to_string(image, lang=language, timeout=timeout))
+    return "\n".join(page_text)
+
+
+class OCRCache:
+    """
+    A thread-safe LRU cache of OCR results keyed by the hash of the page images.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        """
+        Get the OCR result for the given key, if cached.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: str, text: str) -> None:
+        """
+        Store the OCR result for the given key, evicting the least recently used entry when full.
+        """
+        with self._lock:
+            self._entries[key] = text
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class OCRStage:
+    """
+    A document loading stage that replaces the text of image-only PDF pages with OCR output.
+
+    Pages with no or very little text are sent to a local OCR engine (tesseract) running in a
+    process pool that is shared by all ingestion jobs of this worker. A page is only submitted
+    when a process is free, so every page has its own deadline from the moment it is submitted.
+    A page that runs past its deadline cannot be cancelled, so the pool is recycled: its
+    processes are terminated, and the pages of other jobs that were running in it are submitted
+    again to the new pool.
+    """
+
+    _executor: ProcessPoolExecutor | None = None
+    _in_flight: threading.BoundedSemaphore | None = None
+    _cache: OCRCache | None = None
+    _class_lock = threading.Lock()
+
+    def __init__(self, logger: Logger, progress_callback: ProgressCallback | None = None) -> None:
+        self.logger = logger
+        self.progress_callback = progress_callback if progress_callback else self.log_progress
+        self.min_chars = int(os.environ.get("OCR_MIN_CHARS", 20))
+        self.max_workers = int(os.environ.get("OCR_MAX_WORKERS", 2))
+        self.page_timeout = float(os.environ.get("OCR_PAGE_TIMEOUT", 60))
+        self.language = os.environ.get("OCR_LANGUAGE", "nld+eng")
+        self.cache_size = int(os.environ.get("OCR_CACHE_SIZE", 1024))
+        self.ocr_function: Callable[[list[bytes], str, float], str] = ocr_page_images
+
+    @staticmethod
+    def is_available() -> bool:
+        """
+        Check whether the optional OCR dependencies are installed.
+        """
+        return all(importlib.util.find_spec(module) is not None for module in ("pytesseract", "PIL"))
+
+    def log_progress(self, file_name: str, done: int, total: int) -> None:
+        """
+        The default progress callback, which logs the progress of the OCR stage.
+        """
+        self.logger.info(msg=f"OCR progress for {file_name}: {done}/{total} pages")
+
+    def _get_shared_resources(self) -> tuple[ProcessPoolExecutor, threading.BoundedSemaphore, OCRCache]:
+        """
+        Get the process pool, in-flight semaphore and cache shared by all OCR stages in this process.
+        """
+        with OCRStage._class_lock:
+            if OCRStage._in_flight is None:
+                OCRStage._in_flight = threading.BoundedSemaphore(self.max_workers)
+                OCRStage._cache = OCRCache(self.cache_size)
+            if OCRStage._executor is None:
+                OCRStage._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return OCRStage._executor, OCRStage._in_flight, OCRStage._cache  # type: ignore[return-value]
+
+    @staticmethod
+    def _recycle_executor(executor: ProcessPoolExecutor) -> None:
+        """
+        Terminate the processes of the pool, which fails the pages running in it, and let the
+        next submission start a new pool.
+        """
+        with OCRStage._class_lock:
+            if OCRStage._executor is not executor:
+                return
+            OCRStage._executor = None
+        for process in list(executor._processes.values()):  # pylint: disable=protected-access
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, images: list[bytes]) -> Submission:
+        """
+        Submit the images of a page once a process of the pool is free.
+
+        Returns:
+            Submission: The OCR result and the deadline of the page, and the pool it runs in.
+        """
+        while True:
+            executor, in_flight, _ = self._get_shared_resources()
+            if not in_flight.acquire(timeout=self.page_timeout):  # pylint: disable=consider-using-with
+                # no process became free within a page timeout, so all running pages are past their deadline
+                self._recycle_executor(executor)
+                continue
+            try:
+                future = executor.submit(self.ocr_function, images, self.language, self.page_timeout)
+            except (BrokenProcessPool, RuntimeError):
+                # the pool was recycled or broke between getting and using it
+                in_flight.release()
+                self._recycle_executor(executor)
+                continue
+            future.add_done_callback(lambda _: in_flight.release())
+            return future, time.monotonic() + self.page_timeout, executor
+
+    def needs_ocr(self, document: Document) -> bool:
+        """
+        Check whether a page has no or very little extracted text.
+        """
+        return len(document.page_content.strip()) < self.min_chars
+
+    def process(
+        self, documents: Iterable[Document], pdf_source: str | BinaryIO, file_name: str
+    ) -> Iterator[Document]:
+        """
+        Yield the documents, replacing the text of image-only pages with OCR output.
+
+        Args:
+            documents (Iterable[Document]): The page-level documents of the PDF.
+            pdf_source (str | BinaryIO): The path to, or a binary stream of, the PDF.
+            file_name (str): The name of the file, used for progress reporting.
+
+        Yields:
+            Document: The page-level documents in their original order.
+        """
+        pages = list(documents)
+        ocr_page_numbers = [
+            page_number
+            for page_number, page in enumerate(pages)
+            if self.needs_ocr(page) and isinstance(page.metadata.get("page"), int)
+        ]
+        if not ocr_page_numbers:
+            yield from pages
+            return
+        self.logger.info(msg=f"Running OCR on {len(ocr_page_numbers)} image-only pages of {file_name}")
+        from pypdf import PdfReader  # pylint: disable=import-outside-toplevel
+
+        _, _, cache = self._get_shared_resources()
+        reader = PdfReader(pdf_source)
+        pending: dict[int, tuple[str, list[bytes], Submission | str]] = {}
+        done = 0
+        for page_number in ocr_page_numbers:
+            pdf_page_number = pages[page_number].metadata["page"]
+            try:
+                images = [image.data for image in reader.pages[pdf_page_number].images]
+            except Exception as image_error:  # pylint: disable=broad-except
+                self.logger.warning(
+                    msg=f"Skipping OCR of page {pdf_page_number} of {file_name}, its images cannot be read: {image_error}"
+                )
+                continue
+            if not images:
+                continue
+            image_hash = hashlib.sha256(b"".join(images)).hexdigest()
+            cached_text = cache.get(image_hash)
+            record_cache_lookup("ocr", cached_text is not None)
+            if cached_text is not None:
+                pending[page_number] = (image_hash, images, cached_text)
+                continue
+            pending[page_number] = (image_hash, images, self._submit(images))
+        for page_number, page in enumerate(pages):
+            if page_number in pending:
+                image_hash, images, result = pending[page_number]
+                text = result if isinstance(result, str) else self._collect(result, images, image_hash, cache, file_name)
+                if text:
+                    page.page_content = text
+                    page.metadata["ocr"] = True
+                done += 1
+                self.progress_callback(file_name, done, len(pending))
+            yield page
+
+    def _collect(
+        self,
+        submission: Submission,
+        images: list[bytes],
+        image_hash: str,
+        cache: OCRCache,
+        file_name: str,
+    ) -> str:
+        """
+        Wait for the OCR result of a single page until its deadline. A page whose pool was
+        recycled for another page is submitted once more.
+        """
+        future, deadline, executor = submission
+        try:
+            try:
+                text = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except BrokenProcessPool:
+                future, deadline, executor = self._submit(images)
+                text = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            if not future.cancel():
+                self._recycle_executor(executor)
+            self.logger.warning(msg=f"OCR timed out after {self.page_timeout}s on a page of {file_name}")
+            return ""
+        except Exception as ocr_error:  # pylint: disable=broad-except
+            self.logger.warning(msg=f"OCR failed on a page of {file_name}: {ocr_error}")
+            return ""
+        cache.put(image_hash, text)
+        return text
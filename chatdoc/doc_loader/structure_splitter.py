@@ -0,0 +1,233 @@
+"""
+Module defining the StructureAwareTextSplitter class
+"""
+import re
+from dataclasses import dataclass
+from typing import Any, Iterable, Literal
+
+from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter, TextSplitter
+
+
+BlockKind = Literal["heading", "list", "table", "paragraph"]
+
+NUMBERED_HEADING_PATTERN = re.compile(r"^(?P<number>\d{1,2}(?:\.\d{1,2}){0,4})\.?\s+(?P<title>[A-ZÀ-Þ].{0,118})$")
+KEYWORD_HEADING_PATTERN = re.compile(
+    r"^(?P<keyword>hoofdstuk|paragraaf|artikel|bijlage|chapter|section|article|annex|appendix)\s+(?P<number>[\dIVXLC]+[a-z]?)\b.{0,100}$",
+    re.IGNORECASE,
+)
+LIST_ITEM_PATTERN = re.compile(r"^(?:[-•*▪–●]|\(?[a-zA-Z0-9]{1,3}[.)])\s+\S")
+TABLE_CELL_SEPARATOR_PATTERN = re.compile(r"\t|\s{3,}|\s\|\s")
+SENTENCE_END_PATTERN = re.compile(r"[.!?:;]['\"”)\]]?$")
+MAX_HEADING_WORDS = 12
+
+
+@dataclass
+class LayoutBlock:
+    """
+    A block of text in the layout stream of a document.
+
+    Attributes:
+        kind (BlockKind): The kind of block (heading, list, table or paragraph).
+        lines (list[str]): The lines of text belonging to the block.
+        page_start (int | None): The page on which the block starts.
+        page_end (int | None): The page on which the block ends.
+        level (int): The heading level, only meaningful for headings.
+        label (str): The section label of a heading, e.g. "§3.2" or the heading title.
+    """
+
+    kind: BlockKind
+    lines: list[str]
+    page_start: int | None
+    page_end: int | None
+    level: int = 0
+    label: str = ""
+
+    @property
+    def text(self) -> str:
+        """
+        The text of the block; paragraph lines are joined into one line, other blocks keep their line breaks.
+        """
+        if self.kind == "paragraph":
+            return " ".join(self.lines)
+        return "\n".join(self.lines)
+
+
+class StructureAwareTextSplitter(TextSplitter):
+    """
+    A text splitter that chunks documents along their layout instead of per page.
+
+    The pages of a document are merged into a single layout stream, in which headings, lists,
+    tables and paragraphs are detected. Paragraphs that continue on the next page are kept
+    together and chunks never cross a heading, so every chunk carries the section it belongs to
+    and the range of pages it spans in its metadata.
+    """
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._fallback_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=self._chunk_size,
+            chunk_overlap=self._chunk_overlap,
+            length_function=self._length_function,
+        )
+
+    def split_text(self, text: str) -> list[str]:
+        """
+        Split a single text into structure-aware chunks.
+
+        Args:
+            text (str): The text to split.
+
+        Returns:
+            list[str]: The chunks of text.
+        """
+        blocks = self.build_layout_stream([Document(page_content=text)])
+        return [chunk.page_content for chunk in self.chunk_blocks(blocks, {})]
+
+    def split_documents(self, documents: Iterable[Document]) -> list[Document]:
+        """
+        Split the page-level documents of one or more sources into structure-aware chunks.
+
+        Args:
+            documents (Iterable[Document]): The page-level documents, in reading order.
+
+        Returns:
+            list[Document]: The chunks with section and page-range metadata.
+        """
+        chunks: list[Document] = []
+        source_pages: list[Document] = []
+        current_source: Any = None
+        for document in documents:
+            source = document.metadata.get("source")
+            if source_pages and source != current_source:
+                chunks.extend(self.chunk_blocks(self.build_layout_stream(source_pages), source_pages[0].metadata))
+                source_pages = []
+            current_source = source
+            source_pages.append(document)
+        if source_pages:
+            chunks.extend(self.chunk_blocks(self.build_layout_stream(source_pages), source_pages[0].metadata))
+        return chunks
+
+    @staticmethod
+    def classify_line(line: str) -> tuple[BlockKind, int, str]:
+        """
+        Classify a single line of text.
+
+        Args:
+            line (str): The stripped line of text.
+
+        Returns:
+            tuple[BlockKind, int, str]: The kind of the line, the heading level and the section label.
+        """
+        if len(TABLE_CELL_SEPARATOR_PATTERN.findall(line)) >= 2:
+            return "table", 0, ""
+        words = line.split()
+        if len(words) <= MAX_HEADING_WORDS and not SENTENCE_END_PATTERN.search(line):
+            if match := NUMBERED_HEADING_PATTERN.match(line):
+                number = match.group("number")
+                return "heading", number.count(".") + 1, f"§{number}"
+            if match := KEYWORD_HEADING_PATTERN.match(line):
+                return "heading", 1, f"{match.group('keyword').capitalize()} {match.group('number')}"
+            letters = [char for char in line if char.isalpha()]
+            if len(letters) >= 3 and all(char.isupper() for char in letters):
+                return "heading", 1, line.title()
+        if LIST_ITEM_PATTERN.match(line):
+            return "list", 0, ""
+        return "paragraph", 0, ""
+
+    def build_layout_stream(self, pages: list[Document]) -> list[LayoutBlock]:
+        """
+        Merge the text of the pages into a stream of layout blocks.
+
+        A paragraph that does not end in a sentence-ending character at the bottom of a page is
+        continued on the next page, so it ends up in a single block spanning both pages.
+
+        Args:
+            pages (list[Document]): The page-level documents of a single source.
+
+        Returns:
+            list[LayoutBlock]: The layout blocks in reading order.
+        """
+        blocks: list[LayoutBlock] = []
+        current: LayoutBlock | None = None
+        for page in pages:
+            page_number = page.metadata.get("page")
+            for raw_line in page.page_content.splitlines():
+                line = raw_line.strip()
+                if not line:
+                    current = None
+                    continue
+                kind, level, label = self.classify_line(line)
+                continues_block = current is not None and (
+                    (kind == current.kind and kind in ("paragraph", "table"))
+                    or (current.kind == "list" and kind in ("list", "paragraph"))
+                )
+                if current is not None and continues_block:
+                    current.lines.append(line)
+                    current.page_end = page_number
+                    continue
+                current = LayoutBlock(kind, [line], page_number, page_number, level, label)
+                blocks.append(current)
+                if kind == "heading":
+                    current = None
+            if current is not None and current.kind == "paragraph" and SENTENCE_END_PATTERN.search(current.lines[-1]):
+                current = None
+        return blocks
+
+    def chunk_blocks(self, blocks: list[LayoutBlock], base_metadata: dict[str, Any]) -> list[Document]:
+        """
+        Group layout blocks into chunks that do not cross section boundaries.
+
+        Args:
+            blocks (list[LayoutBlock]): The layout blocks of a single source.
+            base_metadata (dict[str, Any]): The metadata shared by all chunks, e.g. the source.
+
+        Returns:
+            list[Document]: The chunks with section and page-range metadata.
+        """
+        chunks: list[Document] = []
+        section_stack: list[LayoutBlock] = []
+        pending: list[LayoutBlock] = []
+
+        def flush() -> None:
+            if pending:
+                chunks.extend(self._create_chunks(pending, section_stack, base_metadata))
+                pending.clear()
+
+        for block in blocks:
+            if block.kind == "heading":
+                if any(pending_block.kind != "heading" for pending_block in pending):
+                    flush()
+                while section_stack and section_stack[-1].level >= block.level:
+                    section_stack.pop()
+                section_stack.append(block)
+                pending.append(block)
+                continue
+            candidate = "\n\n".join(pending_block.text for pending_block in [*pending, block])
+            if pending and self._length_function(candidate) > self._chunk_size:
+                flush()
+            pending.append(block)
+        flush()
+        return chunks
+
+    def _create_chunks(
+        self, blocks: list[LayoutBlock], section_stack: list[LayoutBlock], base_metadata: dict[str, Any]
+    ) -> list[Document]:
+        """
+        Create one or more chunks out of a group of layout blocks.
+        """
+        metadata = {key: value for key, value in base_metadata.items() if key not in ("page", "page_end")}
+        pages = [page for block in blocks for page in (block.page_start, block.page_end) if page is not None]
+        if pages:
+            metadata["page"] = min(pages)
+            metadata["page_end"] = max(pages)
+        if section_stack:
+            metadata["section"] = section_stack[-1].label
+            metadata["section_path"] = " > ".join(heading.text for heading in section_stack)
+        text = "\n\n".join(block.text for block in blocks)
+        if self._length_function(text) <= self._chunk_size:
+            return [Document(page_content=text, metadata=metadata)]
+        return [
+            Document(page_content=piece, metadata=dict(metadata))
+            for piece in self._fallback_splitter.split_text(text)
+        ]
@@ -0,0 +1,158 @@
+"""
+Module defining in-memory upload buffers and the loaders that read from them
+"""
+import io
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Iterator, Protocol
+
+from langchain.schema import Document
+
+
+class Loader(Protocol):
+    """
+    The part of the langchain `BaseLoader` interface the document loader uses.
+
+    The buffered loaders implement it without subclassing `BaseLoader`, whose module imports
+    every langchain document loader.
+    """
+
+    def lazy_load(self) -> Iterator[Document]:
+        ...
+
+    def load(self) -> list[Document]:
+        ...
+
+
+class MemoryViewStream(io.RawIOBase):
+    """
+    A read-only, seekable binary stream over a memoryview that does not copy the underlying buffer.
+    """
+
+    def __init__(self, data: memoryview) -> None:
+        super().__init__()
+        self._data = data
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:  # type: ignore[override]
+        chunk = self._data[self._position : self._position + len(buffer)]
+        size = len(chunk)
+        buffer[:size] = chunk
+        self._position += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        match whence:
+            case io.SEEK_SET:
+                self._position = offset
+            case io.SEEK_CUR:
+                self._position += offset
+            case io.SEEK_END:
+                self._position = len(self._data) + offset
+            case _:
+                raise ValueError(f"Invalid whence value: {whence}")
+        if self._position < 0:
+            raise ValueError("Negative seek position")
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+@dataclass
+class UploadBuffer:
+    """
+    An uploaded file, held either in memory or, above the in-memory size threshold, on disk.
+
+    Attributes:
+        name (str): The unique file name of the upload, used as the source of its documents.
+        data (memoryview | None): The contents of the file when it is held in memory.
+        path (Path | None): The path of the file when it was spilled to disk.
+    """
+
+    name: str
+    data: memoryview | None = None
+    path: Path | None = None
+
+    @property
+    def suffix(self) -> str:
+        """
+        The file extension of the upload.
+        """
+        return Path(self.name).suffix
+
+    @property
+    def in_memory(self) -> bool:
+        """
+        Whether the upload is held in memory.
+        """
+        return self.data is not None
+
+    def open(self) -> BinaryIO:
+        """
+        Open the upload as a binary stream.
+
+        Returns:
+            BinaryIO: A stream over the in-memory contents, or the opened file on disk.
+        """
+        if self.data is not None:
+            return io.BufferedReader(MemoryViewStream(self.data))  # type: ignore[return-value]
+        if self.path is not None:
+            return open(self.path, "rb")  # pylint: disable=consider-using-with
+        raise ValueError(f"Upload buffer {self.name} holds no data")
+
+    def release(self) -> None:
+        """
+        Release the in-memory contents of the upload.
+        """
+        if self.data is not None:
+            self.data.release()
+            self.data = None
+
+
+class BufferedPDFLoader:
+    """
+    Load a PDF from an upload buffer, one document per page like PyPDFLoader.
+    """
+
+    def __init__(self, buffer: UploadBuffer) -> None:
+        self.buffer = buffer
+
+    def lazy_load(self) -> Iterator[Document]:
+        # pypdf is imported when the first PDF is loaded rather than when the app starts
+        from pypdf import PdfReader  # pylint: disable=import-outside-toplevel
+
+        with self.buffer.open() as stream:
+            reader = PdfReader(stream)
+            for page_number, page in enumerate(reader.pages):
+                yield Document(
+                    page_content=page.extract_text(),
+                    metadata={"source": self.buffer.name, "page": page_number},
+                )
+
+    def load(self) -> list[Document]:
+        return list(self.lazy_load())
+
+
+class BufferedDocxLoader:
+    """
+    Load a Word document from an upload buffer, as a single document like Docx2txtLoader.
+    """
+
+    def __init__(self, buffer: UploadBuffer) -> None:
+        self.buffer = buffer
+
+    def lazy_load(self) -> Iterator[Document]:
+        import docx2txt  # pylint: disable=import-outside-toplevel
+
+        with self.buffer.open() as stream:
+            yield Document(page_content=docx2txt.process(stream), metadata={"source": self.buffer.name})
+
+    def load(self) -> list[Document]:
+        return list(self.lazy_load())
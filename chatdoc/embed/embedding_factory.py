@@ -1,8 +1,8 @@
+import importlib
+import os
 from typing import Any
-from langchain.schema.embeddings import Embeddings
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.embeddings.huggingface import HuggingFaceEmbeddings
-from langchain.embeddings.huggingface import HuggingFaceInferenceAPIEmbeddings
+from langchain_core.embeddings import Embeddings
+from ..model_registry import get_model
 from ..utils import Utils
 
 
@@ -11,7 +11,8 @@ class EmbeddingFactory:
     Factory class for creating different types of embeddings.
 
     Attributes:
-        embedding_map (dict[str, type[Embeddings]]): A mapping of vendor names to embedding classes.
+        embedding_map (dict[str, str]): A mapping of vendor names to the import paths of embedding classes,
+            which are only imported when an embedding is created.
         api_key_map (dict[str, str]): A mapping of vendor names to API key environment variable names.
 
     Methods:
@@ -29,10 +30,11 @@ class EmbeddingFactory:
             embedding_model_name (str | None, optional): The name of the embedding model. Defaults to None.
 
         """
-        self.embedding_map: dict[str, type[Embeddings]] = {
-            "openai": OpenAIEmbeddings,
-            "huggingface": HuggingFaceInferenceAPIEmbeddings,
-            "huggingface_local": HuggingFaceEmbeddings,
+        self.embedding_map: dict[str, str] = {
+            "openai": "langchain_community.embeddings.openai:OpenAIEmbeddings",
+            "huggingface": "langchain_community.embeddings.huggingface:HuggingFaceInferenceAPIEmbeddings",
+            "huggingface_local": "langchain_community.embeddings.huggingface:HuggingFaceEmbeddings",
+            "fake": "chatdoc.fake_models:FakeEmbeddings",
         }
         self.api_key_map: dict[str, str] = {
             "openai": "OPENAI_API_KEY",
@@ -44,6 +46,8 @@ class EmbeddingFactory:
         )
 
     def _create_api_key_dict(self, api_key: str | None) -> dict[str, Any]:
+        if self.vendor_name == "fake":
+            return {}
         if api_key is None and "local" not in self.vendor_name:
             api_key_var = self.api_key_map.get(self.vendor_name)
             if api_key_var is None:
@@ -63,6 +67,10 @@ class EmbeddingFactory:
         match self.vendor_name:
             case "openai":
                 settings_dict["disallowed_special"] = ()
+            case "fake":
+                settings_dict["size"] = int(os.environ.get("FAKE_EMBEDDING_SIZE", 384))
+                settings_dict["latency"] = float(os.environ.get("FAKE_EMBEDDING_LATENCY", 0.05))
+                settings_dict["texts_per_second"] = float(os.environ.get("FAKE_EMBEDDING_TEXTS_PER_SECOND", 1000))
             case _:
                 pass
         return settings_dict
@@ -87,7 +95,8 @@ class EmbeddingFactory:
 
     def create(self, api_key: str | None = None) -> Embeddings:
         """
-        Creates an instance of the specified embedding class.
+        Creates an instance of the specified embedding class, or reuses the instance that this
+        process already created with the same vendor, model and API key.
 
         Args:
             api_key (str | None, optional): The API key to be used. Defaults to None.
@@ -99,9 +108,16 @@ class EmbeddingFactory:
             ValueError: If no embedding is available for the specified vendor name.
 
         """
-        embedding_class = self.embedding_map.get(self.vendor_name)
-        if embedding_class is None:
+        return get_model(
+            ("embedding", self.vendor_name, self.embedding_model_name, api_key), lambda: self._build(api_key)
+        )
+
+    def _build(self, api_key: str | None) -> Embeddings:
+        embedding_path = self.embedding_map.get(self.vendor_name)
+        if embedding_path is None:
             raise ValueError(f"No embedding available for vendor name {self.vendor_name}")
+        module_name, _, class_name = embedding_path.partition(":")
+        embedding_class: type[Embeddings] = getattr(importlib.import_module(module_name), class_name)
         api_key_dict = self._create_api_key_dict(api_key)
         settings_dict = self._create_settings_dict()
         model_name_dict = self._create_model_name_dict()
@@ -0,0 +1,148 @@
+"""
+Module defining fake embedding and chat models with configurable latency, for offline load tests
+
+Select them with EMBEDDING_MODEL_VENDOR_NAME=fake and CHAT_MODEL_VENDOR_NAME=fake. They never
+call an external service, but take about as long as the real models they stand in for.
+"""
+import asyncio
+import hashlib
+import math
+import re
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, get_buffer_string
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.pydantic_v1 import BaseModel
+
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+class FakeEmbeddings(Embeddings, BaseModel):
+    """
+    Embeds texts as hashed bags of words, so that texts sharing words are close, after a delay
+    of `latency` seconds per call plus one second per `texts_per_second` texts.
+    """
+
+    model_name: str = "fake"
+    size: int = 384
+    latency: float = 0.05
+    texts_per_second: float = 1000
+
+    def _embed(self, text: str) -> list[float]:
+        vector = [0.0] * self.size
+        for token in TOKEN_PATTERN.findall(text.lower()):
+            digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.size] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(self.latency + len(texts) / self.texts_per_second)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        time.sleep(self.latency)
+        return self._embed(text)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        await asyncio.sleep(self.latency + len(texts) / self.texts_per_second)
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        await asyncio.sleep(self.latency)
+        return self._embed(text)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Answers with `answer_tokens` words of the last message, streamed at `tokens_per_second`
+    after a time to first token of `latency` seconds. Tokens are counted as words and punctuation,
+    so that no tokenizer has to be installed.
+    """
+
+    model_name: str = "fake"
+    latency: float = 0.5
+    tokens_per_second: float = 50
+    answer_tokens: int = 64
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(TOKEN_PATTERN.findall(text))
+
+    def _answer(self, messages: List[BaseMessage]) -> list[str]:
+        words = re.findall(r"\w+", str(messages[-1].content)) or ["fake"]
+        return [f" {words[index % len(words)]}" for index in range(self.answer_tokens)]
+
+    def _result(self, messages: List[BaseMessage], text: str) -> ChatResult:
+        token_usage = {
+            "prompt_tokens": self.get_num_tokens(get_buffer_string(messages)),
+            "completion_tokens": self.answer_tokens,
+        }
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=text))], llm_output={"token_usage": token_usage}
+        )
+
+    def _combine_llm_outputs(self, llm_outputs: List[Optional[dict]]) -> dict:
+        token_usage = {"prompt_tokens": 0, "completion_tokens": 0}
+        for llm_output in llm_outputs:
+            for kind, tokens in (llm_output or {}).get("token_usage", {}).items():
+                token_usage[kind] += tokens
+        return {"token_usage": token_usage}
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency)
+        for token in self._answer(messages):
+            time.sleep(1 / self.tokens_per_second)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager is not None:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.latency)
+        for token in self._answer(messages):
+            await asyncio.sleep(1 / self.tokens_per_second)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        text = "".join(chunk.text for chunk in self._stream(messages, stop, run_manager, **kwargs))
+        return self._result(messages, text)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        text = "".join([chunk.text async for chunk in self._astream(messages, stop, run_manager, **kwargs)])
+        return self._result(messages, text)
@@ -5,16 +5,17 @@
 ==========================================================================
 """
 
-from langchain.llms import LlamaCpp
-from langchain.callbacks.base import BaseCallbackHandler
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
+import json
+import os
+import threading
+from collections import OrderedDict
+from langchain_core.callbacks import BaseCallbackHandler, StreamingStdOutCallbackHandler
+from langchain_core.callbacks.manager import CallbackManagerForLLMRun
 from langchain_core.language_models.chat_models import BaseChatModel
-from dotenv import find_dotenv, load_dotenv
-import yaml
-from typing import Any, Dict, List, Optional
-
-# Load environment variables from .env file
-load_dotenv(find_dotenv())
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, get_buffer_string
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+import requests
+from typing import Any, Dict, Iterator, List, Optional, Sequence, TypedDict
 
 DEFAULT_ANSWER_PREFIX_TOKENS = ["Final", "Answer", ":"]
 
@@ -85,21 +86,265 @@ class StreamDisplayHandler(BaseCallbackHandler):
         self.text = ""
 
 
-def build_llm(model_path: str, length: int, temp: float, gpu_layers: int, chat_box=None) -> BaseChatModel:
+class LocalLLMSettings(TypedDict):
+    """
+    The llama.cpp settings of the local chat model, read from the environment.
+    """
+
+    n_ctx: int
+    n_batch: int
+    n_threads: int | None
+    n_gpu_layers: int
+    max_tokens: int
+
+
+def load_local_llm_settings() -> LocalLLMSettings:
+    """
+    Load the llama.cpp settings of the local chat model from the LOCAL_LLM_* environment variables.
+    """
+    n_threads = os.environ.get("LOCAL_LLM_N_THREADS")
+    return {
+        "n_ctx": int(os.environ.get("LOCAL_LLM_N_CTX", 8192)),
+        "n_batch": int(os.environ.get("LOCAL_LLM_N_BATCH", 128)),
+        "n_threads": int(n_threads) if n_threads else None,
+        "n_gpu_layers": int(os.environ.get("LOCAL_LLM_N_GPU_LAYERS", 5)),
+        "max_tokens": int(os.environ.get("LOCAL_LLM_MAX_TOKENS", 128)),
+    }
+
+
+def build_llm(
+    model_path: str, length: int, temp: float, gpu_layers: int, chat_box=None, streaming: bool = False
+) -> BaseChatModel:
     # Local LlamaCpp model, automatically supports multiple model types
+    from langchain_community.llms.llamacpp import LlamaCpp  # pylint: disable=import-outside-toplevel
+
+    settings = load_local_llm_settings()
     llm = LlamaCpp(
         model_path=model_path,
         max_tokens=length,
         temperature=temp,
         n_gpu_layers=gpu_layers,
-        n_batch=128,  # ! arbitrary
+        n_batch=settings["n_batch"],
+        n_threads=settings["n_threads"],
         callbacks=[
             StreamingStdOutCallbackHandler()
             if not chat_box
             else StreamDisplayHandler(chat_box, display_method="write")  # streaming for main.py else main_st.py
         ],
         verbose=True,  # suppresses llama_model_loader output
-        streaming=False,
-        n_ctx=8192,  # ! arbitrary
+        streaming=streaming,
+        n_ctx=settings["n_ctx"],
     )
     return llm
+
+
+def common_prefix_length(tokens: Sequence[int], other_tokens: Sequence[int]) -> int:
+    """
+    Count the leading tokens two token sequences have in common.
+    """
+    length = 0
+    for token, other_token in zip(tokens, other_tokens):
+        if token != other_token:
+            break
+        length += 1
+    return length
+
+
+def state_size(state: Any) -> int:
+    """
+    The size of a llama.cpp state in bytes: besides the llama.cpp state itself, `LlamaState` holds
+    copies of the evaluated tokens and of their scores, see `trim_scores`.
+    """
+    return (
+        state.llama_state_size
+        + getattr(getattr(state, "input_ids", None), "nbytes", 0)
+        + getattr(getattr(state, "scores", None), "nbytes", 0)
+    )
+
+
+def trim_scores(state: Any) -> Any:
+    """
+    Keep only the last row of the scores that `Llama.save_state` copies, which are a row of n_vocab
+    floats per position (about 1 GB at n_ctx=8192 with a 32k vocabulary). The rows are never read:
+    llama.cpp evaluates at least the last prompt token again after a state is loaded, which
+    computes its scores anew. `Llama.load_state` broadcasts the single row over its positions.
+    """
+    scores = getattr(state, "scores", None)
+    if scores is not None and scores.ndim == 2 and len(scores) > 1:
+        state.scores = scores[-1:].copy()
+    return state
+
+
+class SessionStateCache:
+    """
+    Keeps the llama.cpp states (KV cache) of the most recently active chat sessions.
+
+    Consecutive turns of a session share a long prompt prefix (instructions, context and history),
+    so before a request is evaluated the cached state with the longest common token prefix is
+    loaded: preferably the state of the same session, otherwise that of any session (the prompt
+    template is shared). llama.cpp then only evaluates the tokens after the common prefix. The
+    scores in a state are trimmed to their last row when it is stored, so a state is about the
+    size of the KV cache of its tokens. The states are evicted least recently used first, by
+    number of sessions and by total size.
+
+    Attributes:
+        max_sessions (int): The maximum number of cached session states.
+        max_bytes (int): The maximum total size of the cached session states, see `state_size`.
+        stats (dict[str, int]): The number of hits, misses and reused and evaluated prompt tokens.
+    """
+
+    def __init__(self, max_sessions: int | None = None, max_bytes: int | None = None) -> None:
+        self.max_sessions = (
+            max_sessions if max_sessions is not None else int(os.environ.get("LOCAL_LLM_STATE_CACHE_SESSIONS", 8))
+        )
+        self.max_bytes = (
+            max_bytes if max_bytes is not None else int(os.environ.get("LOCAL_LLM_STATE_CACHE_MAX_BYTES", 2 << 30))
+        )
+        self.stats = {"hits": 0, "misses": 0, "reused_tokens": 0, "evaluated_tokens": 0}
+        self._states: OrderedDict[str, Any] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    @property
+    def size(self) -> int:
+        """
+        The total size of the cached states in bytes.
+        """
+        return self._size
+
+    def find(self, session_id: str | None, tokens: Sequence[int]) -> tuple[Any, int]:
+        """
+        Find the cached state that shares the longest token prefix with a prompt.
+
+        Args:
+            session_id (str | None): The session of the prompt, whose own state is preferred on a tie.
+            tokens (Sequence[int]): The tokens of the prompt.
+
+        Returns:
+            tuple[Any, int]: The state (None if no state shares a prefix) and the length of the common prefix.
+        """
+        with self._lock:
+            best_state, best_length = None, 0
+            candidates = list(self._states.items())
+            if session_id in self._states:
+                candidates.insert(0, (session_id, self._states[session_id]))
+            for _, state in candidates:
+                length = common_prefix_length(state.input_ids[: state.n_tokens], tokens)
+                if length > best_length:
+                    best_state, best_length = state, length
+            return best_state, best_length
+
+    def store(self, session_id: str, state: Any) -> None:
+        """
+        Cache the state of a session, evicting the least recently used states beyond the limits.
+
+        Args:
+            session_id (str): The session.
+            state (Any): The llama.cpp state, as returned by `Llama.save_state`.
+        """
+        trim_scores(state)
+        with self._lock:
+            if (previous_state := self._states.pop(session_id, None)) is not None:
+                self._size -= state_size(previous_state)
+            if state_size(state) > self.max_bytes:
+                return
+            self._states[session_id] = state
+            self._size += state_size(state)
+            while len(self._states) > self.max_sessions or self._size > self.max_bytes:
+                _, evicted_state = self._states.popitem(last=False)
+                self._size -= state_size(evicted_state)
+
+    def restore(self, llm: Any, session_id: str | None, tokens: Sequence[int]) -> int:
+        """
+        Load the best cached state into the model, unless the model already shares a longer prefix.
+
+        Args:
+            llm (Any): The llama.cpp model.
+            session_id (str | None): The session of the prompt.
+            tokens (Sequence[int]): The tokens of the prompt.
+
+        Returns:
+            int: The number of prompt tokens that do not have to be evaluated again.
+        """
+        current_length = common_prefix_length(llm.input_ids[: llm.n_tokens], tokens)
+        state, length = self.find(session_id, tokens)
+        if state is not None and length > current_length:
+            llm.load_state(state)
+            current_length = length
+        with self._lock:
+            self.stats["hits" if current_length else "misses"] += 1
+            self.stats["reused_tokens"] += current_length
+            self.stats["evaluated_tokens"] += len(tokens) - current_length
+            if session_id in self._states:
+                self._states.move_to_end(session_id)
+        return current_length
+
+
+class LocalServerChatModel(BaseChatModel):
+    """
+    A chat model that talks to the local inference server (`python -m chatdoc.local_llm_server`).
+
+    The server loads the llama.cpp model once for all server workers and streams the generated
+    tokens back, which are passed on to the callbacks as they arrive.
+    """
+
+    server_url: str
+    max_tokens: int = 128
+    temperature: float = 0
+    session_id: Optional[str] = None
+    request_timeout: float = 600
+
+    @property
+    def _llm_type(self) -> str:
+        return "llama-cpp-server"
+
+    @staticmethod
+    def format_prompt(messages: List[BaseMessage]) -> str:
+        """
+        Format the chat messages as a transcript that ends where the assistant should answer.
+        """
+        return f"{get_buffer_string(messages)}\nAI:"
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        payload = {
+            "prompt": self.format_prompt(messages),
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "stop": stop if stop is not None else ["\nHuman:"],
+            "session_id": self.session_id,
+        }
+        with requests.post(
+            f"{self.server_url}/generate", json=payload, stream=True, timeout=self.request_timeout
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if "error" in event:
+                    raise ValueError(f"Local inference server error: {event['error']}")
+                if event.get("done"):
+                    break
+                chunk = ChatGenerationChunk(message=AIMessageChunk(content=event["token"]))
+                if run_manager is not None:
+                    run_manager.on_llm_new_token(event["token"], chunk=chunk)
+                yield chunk
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        text = "".join(chunk.text for chunk in self._stream(messages, stop, run_manager, **kwargs))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
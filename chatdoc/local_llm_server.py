@@ -0,0 +1,216 @@
+"""
+Module defining the local inference server, which shares one llama.cpp model across all server workers
+
+Start it next to gunicorn with `python -m chatdoc.local_llm_server` (or let `gunicorn.conf.py` start
+it by setting LOCAL_LLM_SERVER_AUTOSTART=true) and point the workers at it with LOCAL_LLM_SERVER_URL.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any
+
+from dotenv import find_dotenv, load_dotenv
+
+from .local_llm import LocalLLMSettings, SessionStateCache, load_local_llm_settings
+from .utils import Utils
+
+
+logger = logging.getLogger("local_llm_server")
+
+
+@dataclass
+class GenerationRequest:
+    """
+    A request for the local model, whose generated tokens are put on its own token queue.
+
+    Attributes:
+        prompt (str): The full prompt.
+        max_tokens (int): The maximum number of tokens to generate.
+        temperature (float): The sampling temperature.
+        stop (list[str]): The stop sequences.
+        session_id (str | None): The chat session the request belongs to.
+        tokens (queue.Queue): The generated tokens, followed by None when done or an exception on failure.
+        cancelled (threading.Event): Set when the client went away.
+    """
+
+    prompt: str
+    max_tokens: int
+    temperature: float
+    stop: list[str]
+    session_id: str | None = None
+    tokens: queue.Queue = field(default_factory=queue.Queue)
+    cancelled: threading.Event = field(default_factory=threading.Event)
+
+
+class GenerationScheduler:
+    """
+    Owns the llama.cpp model and serves the requests of all server workers from a bounded queue.
+
+    There is no continuous batching: the llama.cpp binding evaluates one sequence at a time, so
+    a single scheduler thread serves the queued requests strictly one after another, and the
+    throughput does not rise with the number of concurrent requests. Concurrent requests only
+    wait in the queue (n_batch is the number of prompt tokens evaluated per llama.cpp call, not
+    a number of requests). Every token is streamed back as soon as it is sampled. The llama.cpp
+    state of every session is cached after its request, so the next turn of a session only
+    evaluates the part of its prompt after the common prefix. Requests without a session (such as
+    the rewrites of follow-up questions) are not cached.
+    """
+
+    def __init__(self, model_path: str, settings: LocalLLMSettings, queue_size: int) -> None:
+        from llama_cpp import Llama  # pylint: disable=import-outside-toplevel
+
+        self.settings = settings
+        self.llm = Llama(
+            model_path=model_path,
+            n_ctx=settings["n_ctx"],
+            n_batch=settings["n_batch"],
+            n_threads=settings["n_threads"],
+            n_gpu_layers=settings["n_gpu_layers"],
+            verbose=False,
+        )
+        self.state_cache = SessionStateCache()
+        self.requests: queue.Queue[GenerationRequest] = queue.Queue(maxsize=queue_size)
+        self._worker = threading.Thread(target=self._run, name="generation-scheduler", daemon=True)
+        self._worker.start()
+
+    def submit(self, request: GenerationRequest) -> None:
+        """
+        Queue a request for generation.
+
+        Raises:
+            queue.Full: If the queue is full.
+        """
+        self.requests.put_nowait(request)
+
+    def generate(self, request: GenerationRequest) -> None:
+        """
+        Generate the completion of a single request, streaming its tokens onto its token queue.
+        """
+        prompt_tokens = self.llm.tokenize(request.prompt.encode("utf-8"))
+        self.state_cache.restore(self.llm, request.session_id, prompt_tokens)
+        for completion_chunk in self.llm.create_completion(
+            request.prompt,
+            max_tokens=min(request.max_tokens, self.settings["max_tokens"]),
+            temperature=request.temperature,
+            stop=request.stop,
+            stream=True,
+        ):
+            if request.cancelled.is_set():
+                break
+            request.tokens.put(completion_chunk["choices"][0]["text"])  # type: ignore[index]
+        if request.session_id is not None:
+            self.state_cache.store(request.session_id, self.llm.save_state())
+
+    def _run(self) -> None:
+        while True:
+            request = self.requests.get()
+            if request.cancelled.is_set():
+                continue
+            try:
+                self.generate(request)
+                request.tokens.put(None)
+            except Exception as generation_error:  # pylint: disable=broad-except
+                logger.exception("Generation failed")
+                request.tokens.put(generation_error)
+
+
+class LocalLLMRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the HTTP requests of the local inference server.
+
+    POST /generate streams newline-delimited JSON events: {"token": ...} per token and a final
+    {"done": true}, or {"error": ...}. GET /health reports the queue depth and state cache statistics.
+    """
+
+    scheduler: GenerationScheduler
+
+    def _send_json(self, status: HTTPStatus, body: dict[str, Any], headers: dict[str, str] | None = None) -> None:
+        encoded_body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded_body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(encoded_body)
+
+    def _write_event(self, event: dict[str, Any]) -> None:
+        self.wfile.write(json.dumps(event).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        if self.path != "/health":
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown path {self.path}"})
+            return
+        state_cache = self.scheduler.state_cache
+        self._send_json(
+            HTTPStatus.OK,
+            {
+                "status": "ok",
+                "queued": self.scheduler.requests.qsize(),
+                "cached_sessions": len(state_cache),
+                "cached_bytes": state_cache.size,
+                **state_cache.stats,
+            },
+        )
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        if self.path != "/generate":
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown path {self.path}"})
+            return
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        request = GenerationRequest(
+            prompt=payload["prompt"],
+            max_tokens=int(payload.get("max_tokens", self.scheduler.settings["max_tokens"])),
+            temperature=float(payload.get("temperature", 0)),
+            stop=list(payload.get("stop") or []),
+            session_id=payload.get("session_id"),
+        )
+        try:
+            self.scheduler.submit(request)
+        except queue.Full:
+            self._send_json(HTTPStatus.SERVICE_UNAVAILABLE, {"error": "Generation queue is full"}, {"Retry-After": "1"})
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        try:
+            while (token := request.tokens.get()) is not None:
+                if isinstance(token, Exception):
+                    self._write_event({"error": str(token)})
+                    return
+                self._write_event({"token": token})
+            self._write_event({"done": True})
+        except (BrokenPipeError, ConnectionResetError):
+            request.cancelled.set()
+
+    def log_message(self, format: str, *args: Any) -> None:  # pylint: disable=redefined-builtin
+        logger.info(format, *args)
+
+
+def main() -> None:
+    """
+    Load the local chat model and serve it until interrupted.
+    """
+    load_dotenv(find_dotenv())
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s in %(module)s: %(message)s")
+    model_path = str(Path(Utils.get_env_variable("CHAT_MODEL_FOLDER_PATH")) / Utils.get_env_variable("CHAT_MODEL_NAME"))
+    settings = load_local_llm_settings()
+    LocalLLMRequestHandler.scheduler = GenerationScheduler(
+        model_path, settings, queue_size=int(os.environ.get("LOCAL_LLM_QUEUE_SIZE", 64))
+    )
+    host = os.environ.get("LOCAL_LLM_SERVER_HOST", "127.0.0.1")
+    port = int(os.environ.get("LOCAL_LLM_SERVER_PORT", 8081))
+    logger.info("Serving %s on %s:%s with %s", model_path, host, port, settings)
+    with ThreadingHTTPServer((host, port), LocalLLMRequestHandler) as server:
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Module defining the Prometheus metrics of the prompt and ingestion pipelines
+
+Every stage of a prompt and of an upload is timed in the dora_stage_duration_seconds histogram,
+labelled with the operation ("prompt", "ingest" or "session") and the stage. Under gunicorn the
+metrics of all workers are aggregated when PROMETHEUS_MULTIPROC_DIR is set (prometheus_client's
+multiprocess mode), which `gunicorn.conf.py` clears when the server starts.
+"""
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Iterator, Literal
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+from langchain_core.outputs import LLMResult
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+from .tracing import tracer
+
+
+Operation = Literal["prompt", "ingest", "session"]
+
+STAGE_SECONDS = Histogram(
+    "dora_stage_duration_seconds",
+    "Duration of a stage of a prompt, an upload or an experiment session update",
+    ["operation", "stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+STAGE_ERRORS = Counter(
+    "dora_stage_errors_total", "Number of stages that raised an exception", ["operation", "stage"]
+)
+LLM_TOKENS = Counter(
+    "dora_llm_tokens_total", "Number of tokens sent to and generated by the chat models", ["kind"]
+)
+CACHE_LOOKUPS = Counter("dora_cache_lookups_total", "Number of cache lookups", ["cache", "result"])
+DOCUMENTS = Counter(
+    "dora_ingested_documents_total", "Number of pages and chunks of uploaded files", ["kind"]
+)
+
+
+@contextmanager
+def stage_timer(operation: Operation, stage: str) -> Iterator[None]:
+    """
+    Time a stage, also when it raises, and count the stages that raised. The stage is traced as
+    a span named "<operation>.<stage>".
+    """
+    started_at = time.perf_counter()
+    try:
+        with tracer.start_as_current_span(f"{operation}.{stage}"):
+            yield
+    except BaseException:
+        STAGE_ERRORS.labels(operation, stage).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(operation, stage).observe(time.perf_counter() - started_at)
+
+
+def observe_stage(operation: Operation, stage: str, seconds: float) -> None:
+    """
+    Record the duration of a stage that was not timed with `stage_timer`.
+    """
+    STAGE_SECONDS.labels(operation, stage).observe(seconds)
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    """
+    Count a lookup of a cache, e.g. "condense", "coalesce" or "ocr".
+    """
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+class InstrumentedEmbeddings(Embeddings):
+    """
+    Times the calls of an embedding model as the "embed" stage of an operation.
+
+    Attributes:
+        embeddings (Embeddings): The embedding model.
+        operation (Operation): The operation the embedding calls are part of.
+        seconds (float): The total number of seconds spent embedding, e.g. to tell embedding and
+            persisting apart within a single vector store call.
+    """
+
+    def __init__(self, embeddings: Embeddings, operation: Operation) -> None:
+        self.embeddings = embeddings
+        self.operation = operation
+        self.seconds = 0.0
+
+    @contextmanager
+    def _timed(self) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            with stage_timer(self.operation, "embed"):
+                yield
+        finally:
+            self.seconds += time.perf_counter() - started_at
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        with self._timed():
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        with self._timed():
+            return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        with self._timed():
+            return await self.embeddings.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        with self._timed():
+            return await self.embeddings.aembed_query(text)
+
+
+class TokenUsageHandler(BaseCallbackHandler):
+    """
+    Counts the prompt and completion tokens of chat model calls.
+
+    The counts reported by the vendor (OpenAI's token_usage) are used when available; otherwise
+    the streamed tokens are counted as completion tokens.
+    """
+
+    def __init__(self) -> None:
+        self._streamed_tokens: defaultdict[UUID, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            self._streamed_tokens[run_id] += 1
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            streamed_tokens = self._streamed_tokens.pop(run_id, 0)
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        if token_usage.get("prompt_tokens"):
+            LLM_TOKENS.labels("prompt").inc(token_usage["prompt_tokens"])
+        if completion_tokens := token_usage.get("completion_tokens", streamed_tokens):
+            LLM_TOKENS.labels("completion").inc(completion_tokens)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            self._streamed_tokens.pop(run_id, None)
+
+
+token_usage_handler = TokenUsageHandler()
+
+
+def generate_metrics() -> tuple[bytes, str]:
+    """
+    Render the metrics in the Prometheus text format, of all workers in multiprocess mode.
+
+    Returns:
+        tuple[bytes, str]: The metrics and their content type.
+    """
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
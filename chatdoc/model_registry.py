@@ -0,0 +1,52 @@
+"""
+Module defining the model registry, which keeps the embedding and chat models that a worker has built
+"""
+import threading
+from typing import Any, Callable, Hashable, TypeVar
+
+from .single_flight import SingleFlight
+
+
+T = TypeVar("T")
+
+_models: dict[Hashable, Any] = {}
+_models_lock = threading.Lock()
+_builds = SingleFlight()
+
+
+def get_model(key: Hashable, build: Callable[[], T]) -> T:
+    """
+    Get the process-wide model with the given key, building it on first use.
+
+    Concurrent first uses of a key wait for a single build, e.g. a request that needs the model
+    the pre-warm step is still building. A build that fails is not kept, so the next use builds again.
+
+    Args:
+        key (Hashable): The key of the model, e.g. its kind, vendor, name and settings.
+        build (Callable[[], T]): Builds the model.
+
+    Returns:
+        T: The model, shared by all users of the key in this process.
+    """
+    with _models_lock:
+        if key in _models:
+            return _models[key]
+
+    def build_once() -> T:
+        with _models_lock:
+            if key in _models:  # built by the flight that finished just before this one started
+                return _models[key]
+        model = build()
+        with _models_lock:
+            _models[key] = model
+        return model
+
+    return _builds.do(key, build_once)
+
+
+def clear_models() -> None:
+    """
+    Forget all built models, so they are built again on their next use.
+    """
+    with _models_lock:
+        _models.clear()
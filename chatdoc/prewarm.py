@@ -0,0 +1,75 @@
+"""
+Module defining the pre-warm step, which builds the configured models in the background after a worker has started
+"""
+import importlib
+import logging
+import threading
+import time
+from typing import Any, Callable
+
+from .chat_model import ChatModel
+from .embed.embedding_factory import EmbeddingFactory
+
+
+logger = logging.getLogger("prewarm")
+
+
+def import_modules(*module_names: str) -> Callable[[], None]:
+    """
+    Make a warm-up stage that imports modules which are otherwise imported by the first request.
+    """
+
+    def stage() -> None:
+        for module_name in module_names:
+            importlib.import_module(module_name)
+
+    return stage
+
+
+# the models are built into the model registry, where the first request finds them
+DEFAULT_STAGES: dict[str, Callable[[], Any]] = {
+    "embedding_model": lambda: EmbeddingFactory().create(),
+    "chat_model": lambda: ChatModel().chat_model,
+    "vector_db": import_modules("chromadb", "langchain_community.vectorstores.chroma"),
+    "chains": import_modules("langchain.chains.question_answering"),
+    "document_loaders": import_modules(
+        "langchain_community.document_loaders.pdf", "langchain_community.document_loaders.word_document"
+    ),
+}
+
+
+def warm_up(stages: dict[str, Callable[[], Any]] | None = None) -> dict[str, float]:
+    """
+    Run the warm-up stages one after the other and log how long each took.
+
+    A stage that fails is logged and skipped, since the request that needs it will fail with a
+    better error of its own.
+
+    Args:
+        stages (dict[str, Callable[[], Any]] | None): The stages by name, the default stages if None.
+
+    Returns:
+        dict[str, float]: The duration in seconds of every stage that succeeded.
+    """
+    durations: dict[str, float] = {}
+    started_at = time.perf_counter()
+    for name, stage in (stages if stages is not None else DEFAULT_STAGES).items():
+        stage_started_at = time.perf_counter()
+        try:
+            stage()
+        except Exception:  # pylint: disable=broad-except
+            logger.warning("Pre-warm stage %s failed", name, exc_info=True)
+            continue
+        durations[name] = time.perf_counter() - stage_started_at
+        logger.info("Pre-warmed %s in %.2f seconds", name, durations[name])
+    logger.info("Pre-warm finished in %.2f seconds", time.perf_counter() - started_at)
+    return durations
+
+
+def prewarm(stages: dict[str, Callable[[], Any]] | None = None) -> threading.Thread:
+    """
+    Run the warm-up stages in a background thread, so the worker serves requests in the meantime.
+    """
+    thread = threading.Thread(target=warm_up, args=(stages,), name="prewarm", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,311 @@
+"""
+Module defining the on-demand sampling profiler of requests and ingestion jobs
+
+Profiling is off unless PROFILING_ENABLED is set, in which case the next N requests of a route or
+the next ingestion job of a session or upload can be armed through /profile (or PROFILING_ROUTES
+at start-up). An armed request or job is sampled by a background thread and written as collapsed
+stacks ("frame;frame;frame count" lines, the input of flamegraph.pl and speedscope) to
+PROFILING_DIR. Ingestion jobs also record their allocations with tracemalloc. While nothing is
+armed, requests and jobs only pay for a dictionary lookup; while profiling is off, not even that.
+"""
+import hmac
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from types import FrameType
+from typing import Any, Iterator
+
+
+logger = logging.getLogger("profiling")
+
+
+def format_stack(frame: FrameType | None) -> str:
+    """
+    Format a stack as the semicolon-separated functions from the outermost to the innermost call.
+    """
+    functions = []
+    while frame is not None:
+        code = frame.f_code
+        functions.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(functions))
+
+
+class Profile:
+    """
+    Samples the stack of one thread at a fixed interval from a background thread.
+
+    Attributes:
+        name (str): The name of the profile, which its files are named after.
+        thread_id (int): The identifier of the sampled thread.
+        interval (float): The number of seconds between samples.
+        allocations (bool): Whether to record the allocations with tracemalloc as well.
+        samples (Counter[str]): The number of samples per collapsed stack.
+    """
+
+    _tracemalloc_users = 0
+    _tracemalloc_lock = threading.Lock()
+
+    def __init__(self, name: str, thread_id: int, interval: float, allocations: bool = False) -> None:
+        self.name = name
+        self.thread_id = thread_id
+        self.interval = interval
+        self.allocations = allocations
+        self.samples: Counter[str] = Counter()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name=f"profile-{name}", daemon=True)
+        self._started_at = 0.0
+        self._duration = 0.0
+        self._snapshot: tracemalloc.Snapshot | None = None
+        self._peak_memory = 0
+
+    def _sample(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)  # pylint: disable=protected-access
+            if frame is None:
+                return
+            self.samples[format_stack(frame)] += 1
+
+    def start(self) -> None:
+        """
+        Start sampling, and tracing allocations if requested.
+        """
+        if self.allocations:
+            with Profile._tracemalloc_lock:
+                if Profile._tracemalloc_users == 0:
+                    tracemalloc.start(int(os.environ.get("PROFILING_TRACEMALLOC_FRAMES", 10)))
+                else:
+                    tracemalloc.reset_peak()
+                Profile._tracemalloc_users += 1
+        self._started_at = time.perf_counter()
+        self._sampler.start()
+
+    @contextmanager
+    def follow_current_thread(self) -> Iterator[None]:
+        """
+        Sample the current thread instead of the profiled one until the block ends, e.g. the event
+        loop thread that the coroutine of an async Flask view runs in.
+        """
+        thread_id, self.thread_id = self.thread_id, threading.get_ident()
+        try:
+            yield
+        finally:
+            self.thread_id = thread_id
+
+    def stop(self) -> None:
+        """
+        Stop sampling and take the allocation snapshot; tracing stops with the last profile using it.
+        """
+        self._stopped.set()
+        self._sampler.join()
+        self._duration = time.perf_counter() - self._started_at
+        if self.allocations:
+            with Profile._tracemalloc_lock:
+                self._snapshot = tracemalloc.take_snapshot()
+                self._peak_memory = tracemalloc.get_traced_memory()[1]
+                Profile._tracemalloc_users -= 1
+                if Profile._tracemalloc_users == 0:
+                    tracemalloc.stop()
+
+    def write(self, directory: Path, top_allocations: int = 50) -> list[Path]:
+        """
+        Write the collapsed stacks, and the allocations if they were traced, to a directory.
+
+        Returns:
+            list[Path]: The written files.
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        stacks_path = directory / f"{self.name}.collapsed"
+        stacks_path.write_text(
+            "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common()), encoding="utf-8"
+        )
+        paths = [stacks_path]
+        if self._snapshot is not None:
+            allocations_path = directory / f"{self.name}.allocations.txt"
+            statistics = self._snapshot.statistics("traceback")[:top_allocations]
+            lines = [f"peak traced memory: {self._peak_memory / 1024 / 1024:.1f} MiB", ""]
+            for statistic in statistics:
+                lines.append(f"{statistic.size / 1024:.1f} KiB in {statistic.count} blocks")
+                lines.extend(f"    {line}" for line in statistic.traceback.format(most_recent_first=True))
+            allocations_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+            paths.append(allocations_path)
+        logger.info(
+            "Wrote profile %s (%d samples in %.2f seconds) to %s",
+            self.name,
+            sum(self.samples.values()),
+            self._duration,
+            directory,
+        )
+        return paths
+
+
+class Profiler:
+    """
+    Keeps track of the armed routes and jobs of a worker and profiles them.
+
+    Arming is per worker: /profile arms the worker that serves it, PROFILING_ROUTES arms every
+    worker when it starts.
+
+    Attributes:
+        enabled (bool): Whether profiling is enabled (PROFILING_ENABLED).
+        directory (Path): The directory the profiles are written to (PROFILING_DIR).
+        interval (float): The number of seconds between samples (PROFILING_INTERVAL).
+        admin_token (str | None): The token that /profile requires (PROFILING_ADMIN_TOKEN); /profile
+            is refused without one.
+    """
+
+    def __init__(
+        self,
+        enabled: bool | None = None,
+        directory: Path | None = None,
+        interval: float | None = None,
+        admin_token: str | None = None,
+    ) -> None:
+        self.enabled = (
+            enabled if enabled is not None else os.environ.get("PROFILING_ENABLED", "false").lower() == "true"
+        )
+        self.directory = (
+            directory
+            if directory is not None
+            else Path(
+                os.environ.get(
+                    "PROFILING_DIR", Path(os.environ.get("LOGGING_FILE_PATH", "logs/log.txt")).parent / "profiles"
+                )
+            )
+        )
+        self.interval = interval if interval is not None else float(os.environ.get("PROFILING_INTERVAL", 0.005))
+        self.admin_token = (admin_token if admin_token is not None else os.environ.get("PROFILING_ADMIN_TOKEN")) or None
+        self._routes: dict[str, tuple[int, bool]] = {}
+        self._jobs: set[str] = set()
+        self._lock = threading.Lock()
+        if self.enabled:
+            for armed_route in filter(None, os.environ.get("PROFILING_ROUTES", "").split(",")):
+                route, _, count = armed_route.strip().partition(":")
+                self.arm_route(route, int(count or 1))
+
+    def is_admin(self, token: str | None) -> bool:
+        """
+        Whether a token is the admin token, compared in constant time; always False without an admin token.
+        """
+        if self.admin_token is None or token is None:
+            return False
+        return hmac.compare_digest(token.encode(), self.admin_token.encode())
+
+    def arm_route(self, route: str, count: int = 1, allocations: bool = False) -> None:
+        """
+        Profile the next `count` requests of a route, e.g. "/prompt".
+
+        Raises:
+            ValueError: If profiling is disabled or the count is not positive.
+        """
+        if not self.enabled:
+            raise ValueError("Profiling is disabled, set PROFILING_ENABLED=true to enable it")
+        if count < 1:
+            raise ValueError("The number of requests to profile must be positive")
+        with self._lock:
+            self._routes[route] = (count, allocations)
+        logger.info("Profiling the next %d requests of %s", count, route)
+
+    def arm_job(self, job_id: str) -> None:
+        """
+        Profile the next ingestion job of a session, or the job of an upload ID.
+
+        Raises:
+            ValueError: If profiling is disabled.
+        """
+        if not self.enabled:
+            raise ValueError("Profiling is disabled, set PROFILING_ENABLED=true to enable it")
+        with self._lock:
+            self._jobs.add(job_id)
+        logger.info("Profiling the next ingestion job of %s", job_id)
+
+    def disarm(self) -> None:
+        """
+        Forget all armed routes and jobs; profiles in progress still finish.
+        """
+        with self._lock:
+            self._routes.clear()
+            self._jobs.clear()
+
+    def status(self) -> dict[str, Any]:
+        """
+        The armed routes with the number of requests left, and the armed jobs.
+        """
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "directory": str(self.directory),
+                "routes": {route: count for route, (count, _) in self._routes.items()},
+                "jobs": sorted(self._jobs),
+            }
+
+    def start_request(self, route: str) -> Profile | None:
+        """
+        Start profiling the current thread if the route is armed, counting the request against it.
+
+        Returns:
+            Profile | None: The started profile, to pass to `finish`, or None if the route is not armed.
+        """
+        if route not in self._routes:
+            return None
+        with self._lock:
+            if route not in self._routes:
+                return None
+            count, allocations = self._routes.pop(route)
+            if count > 1:
+                self._routes[route] = (count - 1, allocations)
+        slug = re.sub(r"\W+", "_", route).strip("_") or "root"
+        profile = Profile(
+            f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}-{os.getpid()}-{count}",
+            threading.get_ident(),
+            self.interval,
+            allocations,
+        )
+        profile.start()
+        return profile
+
+    def finish(self, profile: Profile | None) -> None:
+        """
+        Stop a profile and write it; a profile that fails to be written is logged, never raised.
+        """
+        if profile is None:
+            return
+        profile.stop()
+        try:
+            profile.write(self.directory)
+        except OSError:
+            logger.exception("Failed to write profile %s", profile.name)
+
+    @contextmanager
+    def profile_job(self, *job_ids: str) -> Iterator[None]:
+        """
+        Profile an ingestion job, with its allocations, if one of its IDs (the session or upload ID) is armed.
+        """
+        if not self._jobs:
+            yield
+            return
+        with self._lock:
+            armed_id = next((job_id for job_id in job_ids if job_id in self._jobs), None)
+            if armed_id is not None:
+                self._jobs.discard(armed_id)
+        if armed_id is None:
+            yield
+            return
+        profile = Profile(
+            f"{time.strftime('%Y%m%d-%H%M%S')}-ingest-{job_ids[-1]}", threading.get_ident(), self.interval, True
+        )
+        profile.start()
+        try:
+            yield
+        finally:
+            self.finish(profile)
+
+
+profiler = Profiler()
@@ -0,0 +1,196 @@
+"""
+Module defining the QuestionCondenser class, which turns follow-up questions into standalone questions
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Literal
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage, get_buffer_string
+
+from .chat_model import ChatModel
+from .metrics import token_usage_handler
+from .tracing import tracing_handler
+
+if TYPE_CHECKING:
+    from langchain.chains import LLMChain
+
+
+CondenseOutcome = Literal["first_turn", "self_contained", "cache_hit", "rewritten"]
+
+WORD_PATTERN = re.compile(r"\w+")
+CONTINUATION_WORDS = {"and", "but", "also", "so", "en", "maar", "ook", "dus"}
+CONTINUATION_PHRASES = ("what about", "how about", "what if", "wat als", "wat dan", "hoe zit het", "en als")
+REFERRING_WORDS = {
+    # English
+    "it", "its", "this", "that", "these", "those", "they", "them", "their", "he", "she", "him", "her",
+    "same", "previous", "above", "former", "latter",
+    # Dutch
+    "dit", "deze", "hij", "zij", "hem", "haar", "hun", "hen", "daarvan", "daarover", "daarbij",
+    "daarmee", "ervan", "erover", "hiervan", "hierover", "hiermee", "dezelfde", "hetzelfde", "vorige",
+    "bovenstaande", "genoemde",
+}  # fmt: skip
+# "het" is also the Dutch article ("het beleid"), so it only refers back when it ends the question
+# or is followed by an adverb, as in "Geldt het ook voor stagiairs?" or "Hoe zit het dan?"
+PRONOUN_HET_FOLLOWERS = {
+    "ook", "dan", "nog", "wel", "niet", "al", "dus", "zo", "er", "daar", "hier", "eigenlijk", "precies",
+}  # fmt: skip
+# "die" and "dat" are also relative pronouns and conjunctions ("de regel die geldt", "klopt het dat"),
+# which never open a question or follow its first word. They refer back in those places, as in
+# "Is die regeling ook van toepassing?", and where "het" does, as in "Hoeveel dagen zijn dat dan?"
+DEMONSTRATIVE_WORDS = {"die", "dat"}
+
+
+class QuestionCondenser:
+    """
+    A question-condensation stage that only calls an LLM when a follow-up question needs it.
+
+    A question is passed through unchanged on the first turn of a conversation and when it looks
+    self-contained, i.e. it is long enough, does not start like a continuation and does not refer
+    back to earlier turns. Other questions are rewritten into a standalone question; rewrites are
+    cached per (chat history, question) in a cache shared by all condensers in the process. The
+    rewrite runs on the model set by CONDENSE_MODEL_VENDOR_NAME and CONDENSE_MODEL_NAME if
+    configured, e.g. a smaller and faster model, and on the chat model otherwise.
+
+    Attributes:
+        chat_model (BaseChatModel): The chat model to fall back on for rewrites.
+        min_words (int): The minimum number of words of a self-contained question.
+        last_outcome (CondenseOutcome | None): How the last question was condensed.
+    """
+
+    _cache: OrderedDict[tuple[str, str], str] = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    def __init__(self, chat_model: BaseChatModel, min_words: int | None = None, cache_size: int | None = None):
+        self.chat_model = chat_model
+        self.min_words = min_words if min_words is not None else int(os.environ.get("CONDENSE_MIN_WORDS", 5))
+        self.cache_size = cache_size if cache_size is not None else int(os.environ.get("CONDENSE_CACHE_SIZE", 1024))
+        self.last_outcome: CondenseOutcome | None = None
+        self._condense_model: BaseChatModel | None = None
+
+    @property
+    def condense_model(self) -> BaseChatModel:
+        """
+        The model used to rewrite questions, loaded on first use.
+        """
+        if self._condense_model is None:
+            if "CONDENSE_MODEL_NAME" in os.environ:
+                self._condense_model = ChatModel(
+                    chat_model_vendor_name=os.environ.get("CONDENSE_MODEL_VENDOR_NAME"),
+                    chat_model_name=os.environ["CONDENSE_MODEL_NAME"],
+                ).chat_model
+            else:
+                self._condense_model = self.chat_model
+        return self._condense_model
+
+    def is_self_contained(self, question: str) -> bool:
+        """
+        Check with a cheap heuristic whether a question can be understood without the chat history.
+
+        Args:
+            question (str): The question.
+
+        Returns:
+            bool: True if the question does not need to be rewritten.
+        """
+        words = WORD_PATTERN.findall(question.lower())
+        if len(words) < self.min_words:
+            return False
+        if words[0] in CONTINUATION_WORDS or " ".join(words).startswith(CONTINUATION_PHRASES):
+            return False
+        if any(word in REFERRING_WORDS for word in words):
+            return False
+        return not any(
+            (word == "het" or word in DEMONSTRATIVE_WORDS)
+            and (
+                index == len(words) - 1
+                or words[index + 1] in PRONOUN_HET_FOLLOWERS
+                or (word in DEMONSTRATIVE_WORDS and index <= 1)
+            )
+            for index, word in enumerate(words)
+        )
+
+    def _passes_through(self, question: str, chat_history: list[BaseMessage]) -> bool:
+        if not chat_history:
+            self.last_outcome = "first_turn"
+            return True
+        if self.is_self_contained(question):
+            self.last_outcome = "self_contained"
+            return True
+        return False
+
+    def _lookup(self, cache_key: tuple[str, str]) -> str | None:
+        with self._cache_lock:
+            if (cached_question := self._cache.get(cache_key)) is not None:
+                self._cache.move_to_end(cache_key)
+                self.last_outcome = "cache_hit"
+            return cached_question
+
+    def _store(self, cache_key: tuple[str, str], standalone_question: str) -> None:
+        with self._cache_lock:
+            self._cache[cache_key] = standalone_question
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        self.last_outcome = "rewritten"
+
+    def _condense_chain(self) -> "LLMChain":
+        # langchain.chains imports every chain, so it is only imported once a question needs condensing
+        from langchain.chains import LLMChain  # pylint: disable=import-outside-toplevel
+        from langchain.chains.conversational_retrieval.prompts import (  # pylint: disable=import-outside-toplevel
+            CONDENSE_QUESTION_PROMPT,
+        )
+
+        return LLMChain(llm=self.condense_model, prompt=CONDENSE_QUESTION_PROMPT)
+
+    def condense(self, question: str, chat_history: list[BaseMessage]) -> str:
+        """
+        Turn a question into a standalone question given the chat history.
+
+        Args:
+            question (str): The question of the user.
+            chat_history (list[BaseMessage]): The recent messages of the conversation.
+
+        Returns:
+            str: The standalone question.
+        """
+        if self._passes_through(question, chat_history):
+            return question
+        chat_history_str = get_buffer_string(chat_history)
+        cache_key = (hashlib.sha256(chat_history_str.encode("utf-8")).hexdigest(), question.strip())
+        if (cached_question := self._lookup(cache_key)) is not None:
+            return cached_question
+        condense_chain = self._condense_chain()
+        standalone_question = condense_chain.run(
+            question=question, chat_history=chat_history_str, callbacks=[token_usage_handler, tracing_handler]
+        ).strip()
+        self._store(cache_key, standalone_question)
+        return standalone_question
+
+    async def acondense(self, question: str, chat_history: list[BaseMessage]) -> str:
+        """
+        Turn a question into a standalone question given the chat history, without blocking the event loop.
+
+        Args:
+            question (str): The question of the user.
+            chat_history (list[BaseMessage]): The recent messages of the conversation.
+
+        Returns:
+            str: The standalone question.
+        """
+        if self._passes_through(question, chat_history):
+            return question
+        chat_history_str = get_buffer_string(chat_history)
+        cache_key = (hashlib.sha256(chat_history_str.encode("utf-8")).hexdigest(), question.strip())
+        if (cached_question := self._lookup(cache_key)) is not None:
+            return cached_question
+        condense_chain = self._condense_chain()
+        standalone_question = (
+            await condense_chain.arun(
+                question=question, chat_history=chat_history_str, callbacks=[token_usage_handler, tracing_handler]
+            )
+        ).strip()
+        self._store(cache_key, standalone_question)
+        return standalone_question
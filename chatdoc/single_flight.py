@@ -0,0 +1,121 @@
+"""
+Module defining the SingleFlight class, which coalesces identical concurrent computations into one
+"""
+import asyncio
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Hashable, TypeVar, cast
+
+
+T = TypeVar("T")
+
+
+@dataclass
+class _Call:
+    """
+    A computation in flight, whose outcome is shared with the callers that wait for it.
+    """
+
+    done: threading.Event = field(default_factory=threading.Event)
+    result: Any = None
+    error: BaseException | None = None
+
+
+@dataclass
+class _AsyncCall:
+    """
+    A computation in flight on an event loop, run as a task of its own so that a caller that is
+    cancelled does not cancel it for the others.
+    """
+
+    task: asyncio.Task | None = None
+    waiters: int = 0
+
+
+class SingleFlight:
+    """
+    Runs at most one computation per key at a time; callers that ask for a key whose computation
+    is in flight wait for it and share its outcome (or its exception) instead of computing it again.
+
+    Nothing is cached: once a computation has finished, the next call for its key computes again.
+    Threads and coroutines are coalesced separately, the latter per event loop. A coroutine
+    computation runs in a task of its own, which is only cancelled when all its callers are.
+
+    Attributes:
+        stats (dict[str, int]): The number of computations ("leaders") and of coalesced calls.
+    """
+
+    def __init__(self) -> None:
+        self.stats = {"leaders": 0, "coalesced": 0}
+        self._calls: dict[Hashable, _Call] = {}
+        self._async_calls: dict[tuple[int, Hashable], _AsyncCall] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, compute: Callable[[], T]) -> T:
+        """
+        Compute the value of a key, or wait for the computation of the key that is already in flight.
+
+        Args:
+            key (Hashable): The key of the computation.
+            compute (Callable[[], T]): Computes the value.
+
+        Returns:
+            T: The computed value, shared by all callers of the same flight.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self._calls[key] = _Call()
+            self.stats["leaders" if leader else "coalesced"] += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = compute()
+            return call.result
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def ado(self, key: Hashable, compute: Callable[[], Awaitable[T]]) -> T:
+        """
+        The async counterpart of `do`, for coroutines running on the same event loop.
+        """
+        loop = asyncio.get_running_loop()
+        loop_key = (id(loop), key)
+        with self._lock:
+            call = self._async_calls.get(loop_key)
+            leader = call is None
+            if call is None:
+                call = self._async_calls[loop_key] = _AsyncCall()
+                call.task = loop.create_task(self._compute(loop_key, call, compute))
+            call.waiters += 1
+            self.stats["leaders" if leader else "coalesced"] += 1
+        task = cast(asyncio.Task, call.task)
+        try:
+            return await asyncio.shield(task)
+        finally:
+            with self._lock:
+                call.waiters -= 1
+                abandoned = call.waiters == 0 and not task.done()
+                if abandoned and self._async_calls.get(loop_key) is call:
+                    del self._async_calls[loop_key]
+            if abandoned:
+                task.cancel()
+
+    async def _compute(
+        self, loop_key: tuple[int, Hashable], call: _AsyncCall, compute: Callable[[], Awaitable[T]]
+    ) -> T:
+        try:
+            return await compute()
+        finally:
+            with self._lock:
+                if self._async_calls.get(loop_key) is call:
+                    del self._async_calls[loop_key]
@@ -0,0 +1,256 @@
+"""
+Module defining the OpenTelemetry tracing of requests, ingestion jobs and langchain calls
+
+Tracing is off unless TRACING_EXPORTER is set to "file" (JSON lines in TRACING_FILE_PATH) or
+"otlp" (the collector at OTEL_EXPORTER_OTLP_ENDPOINT). While it is off the tracer is a no-op.
+"""
+import functools
+import inspect
+import os
+import threading
+from pathlib import Path
+from typing import Any, Callable, TypeVar
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import LLMResult
+from opentelemetry import context, propagate, trace
+from opentelemetry.trace import Span, SpanKind, Status, StatusCode
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+tracer = trace.get_tracer("dora")
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def configure_tracing(service_name: str = "dora-back") -> bool:
+    """
+    Install the tracer provider and exporter selected by TRACING_EXPORTER, once per process.
+
+    Spans are sampled with probability TRACING_SAMPLE_RATIO (default 1), following the sampling
+    decision of the caller when a request carries a traceparent header.
+
+    Returns:
+        bool: Whether tracing is enabled.
+
+    Raises:
+        ValueError: If TRACING_EXPORTER is not "none", "file" or "otlp".
+    """
+    global _configured  # pylint: disable=global-statement
+    exporter_name = os.environ.get("TRACING_EXPORTER", "none").lower()
+    if exporter_name == "none":
+        return False
+    with _configure_lock:
+        if _configured:
+            return True
+        # pylint: disable=import-outside-toplevel
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SpanExporter
+        from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+        exporter: SpanExporter
+        match exporter_name:
+            case "file":
+                trace_file_path = Path(
+                    os.environ.get(
+                        "TRACING_FILE_PATH",
+                        Path(os.environ.get("LOGGING_FILE_PATH", "logs/log.txt")).parent / "traces.jsonl",
+                    )
+                )
+                trace_file_path.parent.mkdir(parents=True, exist_ok=True)
+                # line buffered, so the spans of all workers are appended as whole lines
+                trace_file = open(  # pylint: disable=consider-using-with
+                    trace_file_path, "a", buffering=1, encoding="utf-8"
+                )
+                exporter = ConsoleSpanExporter(
+                    out=trace_file, formatter=lambda span: span.to_json(indent=None) + "\n"
+                )
+            case "otlp":
+                from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+                exporter = OTLPSpanExporter()
+            case _:
+                raise ValueError(f"Invalid tracing exporter {exporter_name}")
+        provider = TracerProvider(
+            resource=Resource.create({"service.name": service_name}),
+            sampler=ParentBased(TraceIdRatioBased(float(os.environ.get("TRACING_SAMPLE_RATIO", 1.0)))),
+        )
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+        trace.set_tracer_provider(provider)
+        _configured = True
+        return True
+
+
+def current_trace_id() -> str:
+    """
+    The ID of the current trace as a hex string, or an empty string if it is not sampled.
+    """
+    span_context = trace.get_current_span().get_span_context()
+    return trace.format_trace_id(span_context.trace_id) if span_context.is_valid else ""
+
+
+def start_request_span(name: str, headers: Any, **attributes: Any) -> tuple[Span, object]:
+    """
+    Start the span of a request and make it current, continuing the trace of the caller if the
+    headers carry a traceparent.
+
+    Returns:
+        tuple[Span, object]: The span and the token to pass to `end_request_span`.
+    """
+    span = tracer.start_span(
+        name, context=propagate.extract(headers), kind=SpanKind.SERVER, attributes=attributes
+    )
+    return span, context.attach(trace.set_span_in_context(span))
+
+
+def end_request_span(span: Span, token: object, error: BaseException | None = None) -> None:
+    """
+    End the span of a request and restore the context from before the request.
+    """
+    if error is not None:
+        span.record_exception(error)
+        span.set_status(Status(StatusCode.ERROR, str(error)))
+    span.end()
+    context.detach(token)  # type: ignore[arg-type]
+
+
+def with_trace_context(fn: F, span_name: str, **attributes: Any) -> F:
+    """
+    Wrap a job so that it runs in a span that is a child of the span current at submission.
+
+    Executor jobs run in other threads than the request that submitted them, which do not inherit
+    its trace context.
+
+    Args:
+        fn (F): The job, a function or a coroutine function.
+        span_name (str): The name of the span of the job.
+        **attributes: The attributes of the span, e.g. the upload ID.
+
+    Returns:
+        F: The wrapped job.
+    """
+    parent_context = context.get_current()
+    if inspect.iscoroutinefunction(fn):
+
+        @functools.wraps(fn)
+        async def async_job(*args: Any, **kwargs: Any) -> Any:
+            with tracer.start_as_current_span(span_name, context=parent_context, attributes=attributes):
+                return await fn(*args, **kwargs)
+
+        return async_job  # type: ignore[return-value]
+
+    @functools.wraps(fn)
+    def job(*args: Any, **kwargs: Any) -> Any:
+        with tracer.start_as_current_span(span_name, context=parent_context, attributes=attributes):
+            return fn(*args, **kwargs)
+
+    return job  # type: ignore[return-value]
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    Creates a span for every retriever and chat model call of a langchain run, with token counts.
+
+    The span of a call is a child of the span of its parent run if that was traced, and of the
+    span current when the call started otherwise. The handler runs inline, also for async runs,
+    so that the current span is that of the caller.
+    """
+
+    run_inline = True
+
+    def __init__(self) -> None:
+        self._spans: dict[UUID, Span] = {}
+        self._streamed_tokens: dict[UUID, int] = {}
+        self._lock = threading.Lock()
+
+    def _start_span(self, name: str, run_id: UUID, parent_run_id: UUID | None, **attributes: Any) -> None:
+        with self._lock:
+            parent_span = self._spans.get(parent_run_id) if parent_run_id is not None else None
+        parent_context = trace.set_span_in_context(parent_span) if parent_span is not None else None
+        span = tracer.start_span(name, context=parent_context, attributes=attributes)
+        with self._lock:
+            self._spans[run_id] = span
+            self._streamed_tokens[run_id] = 0
+
+    def _end_span(self, run_id: UUID, error: BaseException | None = None, **attributes: Any) -> None:
+        with self._lock:
+            span = self._spans.pop(run_id, None)
+            self._streamed_tokens.pop(run_id, None)
+        if span is None:
+            return
+        span.set_attributes(attributes)
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(Status(StatusCode.ERROR, str(error)))
+        span.end()
+
+    def on_chat_model_start(
+        self,
+        serialized: dict[str, Any],
+        messages: list[list[BaseMessage]],
+        *,
+        run_id: UUID,
+        parent_run_id: UUID | None = None,
+        **kwargs: Any,
+    ) -> None:
+        self._start_span(
+            "llm", run_id, parent_run_id, **{"llm.model": str(serialized.get("id", ["unknown"])[-1])}
+        )
+
+    def on_llm_start(
+        self,
+        serialized: dict[str, Any],
+        prompts: list[str],
+        *,
+        run_id: UUID,
+        parent_run_id: UUID | None = None,
+        **kwargs: Any,
+    ) -> None:
+        self._start_span(
+            "llm", run_id, parent_run_id, **{"llm.model": str(serialized.get("id", ["unknown"])[-1])}
+        )
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            if run_id in self._streamed_tokens:
+                self._streamed_tokens[run_id] += 1
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            streamed_tokens = self._streamed_tokens.get(run_id, 0)
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        self._end_span(
+            run_id,
+            **{
+                "llm.prompt_tokens": int(token_usage.get("prompt_tokens", 0)),
+                "llm.completion_tokens": int(token_usage.get("completion_tokens", streamed_tokens)),
+            },
+        )
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end_span(run_id, error)
+
+    def on_retriever_start(
+        self,
+        serialized: dict[str, Any],
+        query: str,
+        *,
+        run_id: UUID,
+        parent_run_id: UUID | None = None,
+        **kwargs: Any,
+    ) -> None:
+        self._start_span("retriever", run_id, parent_run_id, **{"retriever.query_length": len(query)})
+
+    def on_retriever_end(self, documents: list[Document], *, run_id: UUID, **kwargs: Any) -> None:
+        self._end_span(run_id, **{"retriever.documents": len(documents)})
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end_span(run_id, error)
+
+
+tracing_handler = TracingCallbackHandler()
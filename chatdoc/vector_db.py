@@ -1,15 +1,16 @@
 """
 Module definine the VectorDatabase class
 """
+import hashlib
 import os
-from typing import Literal, TypedDict
-from langchain.embeddings.base import Embeddings
+from typing import TYPE_CHECKING, Literal, TypedDict
+from langchain_core.embeddings import Embeddings
 from langchain.schema import Document
-from langchain.vectorstores.chroma import Chroma
 from langchain_core.vectorstores import VectorStoreRetriever
-from langchain_core.callbacks.manager import CallbackManagerForRetrieverRun
-from chromadb import PersistentClient
-from chromadb.api import ClientAPI
+from langchain_core.callbacks.manager import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+
+if TYPE_CHECKING:
+    from chromadb.api import ClientAPI
 
 
 class SearchArgs(TypedDict, total=True):
@@ -43,6 +44,15 @@ class RetrieverSettings(TypedDict, total=True):
 
 
 class CustomVectorStoreRetriever(VectorStoreRetriever):
+    @staticmethod
+    def _rank(docs: list[Document], similarities: list[float] | None = None) -> list[Document]:
+        if similarities is not None:
+            for doc, similarity in zip(docs, similarities):
+                doc.metadata["score"] = similarity
+        for i, doc in enumerate(docs):
+            doc.metadata["ranking"] = i + 1
+        return docs
+
     def _get_relevant_documents(
         self, query: str, *, run_manager: CallbackManagerForRetrieverRun
     ) -> list[Document]:
@@ -55,18 +65,39 @@ class CustomVectorStoreRetriever(VectorStoreRetriever):
                 )
             )
             docs_and_similarities.sort(key=lambda doc_sim: doc_sim[1], reverse=True)
-            for doc, similarity in docs_and_similarities:
-                doc.metadata["score"] = similarity
-            docs = [doc for doc, _ in docs_and_similarities]
+            return self._rank(
+                [doc for doc, _ in docs_and_similarities], [similarity for _, similarity in docs_and_similarities]
+            )
         elif self.search_type == "mmr":
             docs = self.vectorstore.max_marginal_relevance_search(
                 query, **self.search_kwargs
             )
         else:
             raise ValueError(f"search_type of {self.search_type} not allowed.")
-        for i, doc in enumerate(docs):
-            doc.metadata["ranking"] = i + 1
-        return docs
+        return self._rank(docs)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        if self.search_type == "similarity":
+            docs = await self.vectorstore.asimilarity_search(query, **self.search_kwargs)
+        elif self.search_type == "similarity_score_threshold":
+            docs_and_similarities = (
+                await self.vectorstore.asimilarity_search_with_relevance_scores(
+                    query, **self.search_kwargs
+                )
+            )
+            docs_and_similarities.sort(key=lambda doc_sim: doc_sim[1], reverse=True)
+            return self._rank(
+                [doc for doc, _ in docs_and_similarities], [similarity for _, similarity in docs_and_similarities]
+            )
+        elif self.search_type == "mmr":
+            docs = await self.vectorstore.amax_marginal_relevance_search(
+                query, **self.search_kwargs
+            )
+        else:
+            raise ValueError(f"search_type of {self.search_type} not allowed.")
+        return self._rank(docs)
 
 class VectorDatabase:
     """
@@ -77,8 +108,11 @@ class VectorDatabase:
 
     _chroma_db_client = None
 
+    # the content fingerprint of every collection, with the number of chunks it was computed for
+    _fingerprints: dict[str, tuple[int, str]] = {}
+
     @property
-    def chroma_client(self) -> ClientAPI:
+    def chroma_client(self) -> "ClientAPI":
         """
         ChromaDB client
         """
@@ -87,7 +121,9 @@ class VectorDatabase:
         dora_env = os.environ.get("CURRENT_ENV")
         match dora_env:
             case "DEV" | "TST":
-                self._chroma_db_client = PersistentClient()
+                from chromadb import PersistentClient  # pylint: disable=import-outside-toplevel
+
+                self._chroma_db_client = PersistentClient(path=os.environ.get("CHROMA_PATH", "./chroma"))
             case "PROD":
                 # Connect to ChromaDB in the cloud
                 # Add code here to connect to ChromaDB in the cloud
@@ -97,6 +133,9 @@ class VectorDatabase:
         return self._chroma_db_client
 
     def __init__(self, collection_name: str, embedding_fn: Embeddings) -> None:
+        # chromadb is imported on first use rather than when the app starts
+        from langchain_community.vectorstores.chroma import Chroma  # pylint: disable=import-outside-toplevel
+
         self.collection_name = collection_name
         self.chroma_instance = Chroma(
             collection_name=collection_name,
@@ -137,6 +176,25 @@ class VectorDatabase:
             "search_type": strategy,
         }
 
+    @property
+    def content_fingerprint(self) -> str:
+        """
+        A hash of the chunk texts in the collection, equal for the collections of sessions that
+        uploaded the same documents. It is computed again when the number of chunks has changed or
+        documents were added or deleted by this process.
+        """
+        collection = self.chroma_instance._collection  # pylint: disable=protected-access
+        count = collection.count()
+        cached = self._fingerprints.get(self.collection_name)
+        if cached is not None and cached[0] == count:
+            return cached[1]
+        digest = hashlib.sha256()
+        for text in sorted(collection.get(include=["documents"])["documents"] or []):
+            digest.update(hashlib.sha256(text.encode("utf-8")).digest())
+        fingerprint = digest.hexdigest()
+        self._fingerprints[self.collection_name] = (count, fingerprint)
+        return fingerprint
+
     def get_retriever_settings(self) -> RetrieverSettings:
         """
         Get the retriever settings
@@ -164,6 +222,7 @@ class VectorDatabase:
         """
         document_ids: list[str] = await self.chroma_instance.aadd_documents(documents)
         self.chroma_instance.persist()
+        self._fingerprints.pop(self.collection_name, None)
         return document_ids
 
     async def delete_documents(self, document_ids: list[str]) -> bool:
@@ -180,6 +239,7 @@ class VectorDatabase:
         try:
             self.chroma_instance.delete(document_ids)
             self.chroma_instance.persist()
+            self._fingerprints.pop(self.collection_name, None)
         except Exception as ChromaError:
             raise Exception(f"Error deleting document: {ChromaError}")
         return True
@@ -0,0 +1,275 @@
+"""
+Module defining the write-behind buffer, which takes database writes off the request path
+
+Writes are queued in the worker and a background thread runs them every WRITE_BEHIND_INTERVAL
+seconds, or as soon as WRITE_BEHIND_MAX_PENDING writes are queued. Writes run in the order they
+were queued, consecutive writes to the same database in one transaction, so a write sees the
+writes queued before it. While a database cannot be reached (or a SQLite database is locked), its
+writes and those queued after them are retried at the next flush, at most WRITE_BEHIND_MAX_RETRIES
+times; if a transaction fails otherwise, its writes are run one by one and those that fail are
+logged and dropped. The queue is flushed when the worker exits.
+
+Items that a write stores under a key (e.g. the messages of a chat session) stay readable
+through `snapshot` until they are committed, so a worker reads its own writes. Other workers see
+them once they are flushed.
+"""
+import atexit
+import logging
+import os
+import threading
+from collections import defaultdict
+from collections.abc import Callable, Hashable
+from dataclasses import dataclass, field
+from typing import Any
+
+from sqlalchemy import Connection, Engine, create_engine
+from sqlalchemy.exc import DBAPIError, DisconnectionError, OperationalError
+
+
+logger = logging.getLogger("write_behind")
+
+_engines: dict[str, Engine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(connection_string: str) -> Engine:
+    """
+    Get the engine of a connection string, shared by all writers and readers in the process.
+    """
+    with _engines_lock:
+        if connection_string not in _engines:
+            _engines[connection_string] = create_engine(connection_string, pool_pre_ping=True)
+        return _engines[connection_string]
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Whether a write failed because its database could not be reached or was locked, so that it may
+    succeed later, rather than because of the write itself (e.g. a missing table).
+    """
+    if isinstance(error, DisconnectionError):
+        return True
+    if isinstance(error, DBAPIError) and error.connection_invalidated:
+        return True
+    return isinstance(error, OperationalError) and "database is locked" in str(error.orig)
+
+
+@dataclass
+class PendingWrite:
+    """
+    A queued write.
+
+    Attributes:
+        connection_string (str): The database to write to.
+        write (Callable[[Connection], None]): Writes in the transaction of a flush.
+        key (Hashable | None): The key the items are readable under until they are committed.
+        items (list): The items the write stores.
+        attempts (int): The number of flushes that failed to reach the database of the write.
+    """
+
+    connection_string: str
+    write: Callable[[Connection], None]
+    key: Hashable | None = None
+    items: list[Any] = field(default_factory=list)
+    attempts: int = 0
+
+
+class WriteBehindBuffer:
+    """
+    Queues writes and runs them in batches from a background thread.
+
+    Attributes:
+        enabled (bool): Whether writes are queued (WRITE_BEHIND_ENABLED); if not, `submit` writes
+            right away.
+        interval (float): The number of seconds between flushes (WRITE_BEHIND_INTERVAL).
+        max_pending (int): The number of queued writes that triggers a flush (WRITE_BEHIND_MAX_PENDING).
+        max_retries (int): The number of flushes a write is retried at while its database cannot be
+            reached, before it is dropped (WRITE_BEHIND_MAX_RETRIES).
+    """
+
+    def __init__(
+        self,
+        enabled: bool | None = None,
+        interval: float | None = None,
+        max_pending: int | None = None,
+        max_retries: int | None = None,
+    ) -> None:
+        self.enabled = (
+            enabled if enabled is not None else os.environ.get("WRITE_BEHIND_ENABLED", "true").lower() == "true"
+        )
+        self.interval = interval if interval is not None else float(os.environ.get("WRITE_BEHIND_INTERVAL", 0.2))
+        self.max_pending = (
+            max_pending if max_pending is not None else int(os.environ.get("WRITE_BEHIND_MAX_PENDING", 100))
+        )
+        self.max_retries = (
+            max_retries if max_retries is not None else int(os.environ.get("WRITE_BEHIND_MAX_RETRIES", 300))
+        )
+        self._writes: list[PendingWrite] = []
+        self._items: dict[Hashable, list[Any]] = {}
+        # a key's generation changes when a flush of its items starts and when it ends
+        self._generations: defaultdict[Hashable, int] = defaultdict(int)
+        self._in_flight: set[Hashable] = set()
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._thread_pid = 0
+        self._stopped = False
+
+    def _ensure_thread(self) -> None:
+        # the thread is started in the worker that queues the first write, not in the process it was forked from
+        if self._thread is not None and self._thread_pid == os.getpid() and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread_pid = os.getpid()
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                if not self._writes and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                if len(self._writes) < self.max_pending:
+                    self._condition.wait(self.interval)
+            self.flush()
+
+    def submit(
+        self,
+        connection_string: str,
+        write: Callable[[Connection], None],
+        key: Hashable | None = None,
+        items: list[Any] | None = None,
+    ) -> None:
+        """
+        Queue a write, which runs in the transaction of the next flush of its database.
+
+        Args:
+            connection_string (str): The database to write to.
+            write (Callable[[Connection], None]): Writes with the connection of the flush.
+            key (Hashable | None): The key to read the items under until they are committed.
+            items (list | None): The items the write stores, e.g. chat messages.
+        """
+        if not self.enabled:
+            with get_engine(connection_string).begin() as connection:
+                write(connection)
+            return
+        with self._condition:
+            self._writes.append(PendingWrite(connection_string, write, key, list(items or [])))
+            if key is not None:
+                self._items.setdefault(key, []).extend(items or [])
+            # the thread waits for the first write, and then for the interval or a full queue
+            if len(self._writes) == 1 or len(self._writes) >= self.max_pending:
+                self._condition.notify_all()
+        self._ensure_thread()
+
+    def snapshot(self, key: Hashable) -> tuple[int, list[Any]] | None:
+        """
+        The generation and the uncommitted items of a key, or None while its items are being
+        committed. Read the committed items after taking the snapshot, and take a new snapshot if
+        `generation(key)` changed in the meantime.
+        """
+        with self._condition:
+            if key in self._in_flight:
+                return None
+            return self._generations[key], list(self._items.get(key, []))
+
+    def generation(self, key: Hashable) -> int:
+        """
+        The generation of a key, see `snapshot`.
+        """
+        with self._condition:
+            return self._generations[key]
+
+    def _flush_writes(self, writes: list[PendingWrite]) -> list[PendingWrite]:
+        """
+        Run writes in order, consecutive writes to the same database in one transaction.
+
+        Returns:
+            list[PendingWrite]: The writes from the first one to an unavailable database on, to retry,
+            without those that have run out of retries.
+        """
+        start = 0
+        while start < len(writes):
+            end = start + 1
+            while end < len(writes) and writes[end].connection_string == writes[start].connection_string:
+                end += 1
+            group = writes[start:end]
+            engine = get_engine(group[0].connection_string)
+            try:
+                with engine.begin() as connection:
+                    for pending in group:
+                        pending.write(connection)
+            except Exception as error:  # pylint: disable=broad-except
+                if is_transient(error):
+                    return self._retry(writes[start:], group)
+                logger.exception("Failed to write %d queued writes, writing them one by one", len(group))
+                self._write_one_by_one(engine, group)
+            start = end
+        return []
+
+    def _retry(self, writes: list[PendingWrite], group: list[PendingWrite]) -> list[PendingWrite]:
+        for pending in group:
+            pending.attempts += 1
+        retried = [pending for pending in writes if pending.attempts <= self.max_retries]
+        logger.exception("Failed to write %d queued writes, retrying at the next flush", len(retried))
+        if dropped := len(writes) - len(retried):
+            logger.error("Dropped %d queued writes after %d failed attempts", dropped, self.max_retries + 1)
+        return retried
+
+    @staticmethod
+    def _write_one_by_one(engine: Engine, group: list[PendingWrite]) -> None:
+        for pending in group:
+            try:
+                with engine.begin() as connection:
+                    pending.write(connection)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Dropped a queued write of %d items for %s", len(pending.items), pending.key)
+
+    def flush(self) -> int:
+        """
+        Run the queued writes now.
+
+        Returns:
+            int: The number of writes that were run, i.e. committed or dropped.
+        """
+        with self._flush_lock:
+            with self._condition:
+                writes, self._writes = self._writes, []
+                keys = {pending.key for pending in writes if pending.key is not None}
+                for key in keys:
+                    self._generations[key] += 1
+                self._in_flight |= keys
+            failed = self._flush_writes(writes) if writes else []
+            with self._condition:
+                self._writes[:0] = failed
+                failed_ids = {id(pending) for pending in failed}
+                for pending in writes:
+                    if pending.key is not None and id(pending) not in failed_ids:
+                        del self._items[pending.key][: len(pending.items)]
+                for key in keys:
+                    if not self._items[key]:
+                        del self._items[key]
+                    self._generations[key] += 1
+                self._in_flight -= keys
+            return len(writes) - len(failed)
+
+    def close(self) -> None:
+        """
+        Stop the background thread and run the queued writes.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None and self._thread_pid == os.getpid():
+            self._thread.join()
+        flushed = self.flush()
+        if flushed or self._writes:
+            logger.info("Flushed %d queued writes at exit, %d failed", flushed, len(self._writes))
+        with self._condition:
+            self._stopped = False
+            self._thread = None
+
+
+write_behind = WriteBehindBuffer()
+atexit.register(write_behind.close)
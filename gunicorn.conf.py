@@ -0,0 +1,60 @@
+"""
+Gunicorn server hooks, picked up automatically from the working directory
+
+With LOCAL_LLM_SERVER_AUTOSTART=true the local inference server is started once in the
+arbiter, before the workers are forked, so all workers share a single llama.cpp model.
+With PREWARM_ENABLED=true every worker builds the configured models in the background once it
+has loaded the app, instead of on its first request. With PROMETHEUS_MULTIPROC_DIR set, the
+metrics files of the previous run are removed when the server starts and the metrics of exited workers are
+marked dead, so /metrics aggregates the live workers.
+"""
+import glob
+import os
+import subprocess
+import sys
+
+
+local_llm_server: subprocess.Popen | None = None
+
+
+def on_starting(server) -> None:
+    global local_llm_server  # pylint: disable=global-statement
+    from dotenv import find_dotenv, load_dotenv  # pylint: disable=import-outside-toplevel
+
+    load_dotenv(find_dotenv())
+    if metrics_dir := os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        os.makedirs(metrics_dir, exist_ok=True)
+        for metrics_file in glob.glob(os.path.join(metrics_dir, "*.db")):
+            os.remove(metrics_file)
+    if os.environ.get("LOCAL_LLM_SERVER_AUTOSTART", "false").lower() != "true":
+        return
+    server.log.info("Starting the local inference server")
+    local_llm_server = subprocess.Popen([sys.executable, "-m", "chatdoc.local_llm_server"])  # pylint: disable=consider-using-with
+
+
+def post_worker_init(worker) -> None:
+    if os.environ.get("PREWARM_ENABLED", "false").lower() != "true":
+        return
+    from chatdoc.prewarm import prewarm  # pylint: disable=import-outside-toplevel
+
+    worker.log.info("Pre-warming worker %s", worker.pid)
+    prewarm()
+
+
+def child_exit(server, worker) -> None:
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return
+    from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def on_exit(server) -> None:
+    if local_llm_server is None or local_llm_server.poll() is not None:
+        return
+    server.log.info("Stopping the local inference server")
+    local_llm_server.terminate()
+    try:
+        local_llm_server.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        local_llm_server.kill()
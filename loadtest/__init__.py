@@ -0,0 +1,3 @@
+"""
+Offline load tests: replay experiment sessions against a server that runs on fake models and SQLite
+"""
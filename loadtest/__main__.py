@@ -0,0 +1,5 @@
+from loadtest.driver import main
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""
+Module defining the load-test driver, which replays experiment sessions against a running server
+"""
+import argparse
+import contextlib
+import io
+import json
+import random
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any
+
+import requests
+
+from chatdoc.chat_router import LatencyTracker
+
+
+QUESTIONS = [
+    "What is the main conclusion of the report?",
+    "Which measures does the report recommend?",
+    "Who is responsible for carrying out these measures?",
+    "What are the costs of the proposed measures?",
+    "How does this compare to last year?",
+    "What are the risks mentioned in the document?",
+]
+PARAGRAPHS = [
+    "The report concludes that the pilot reduced processing times by a third.",
+    "It recommends extending the pilot to all regional offices within two years.",
+    "The regional managers are responsible for the roll-out, supported by the central IT department.",
+    "The measures are expected to cost 2.4 million euros, most of which is spent on training.",
+    "Compared to last year, the number of complaints dropped from 420 to 310.",
+    "The main risks are a shortage of trained staff and delays in the delivery of new hardware.",
+]
+
+
+def make_docx(paragraphs: list[str]) -> bytes:
+    """
+    Make a minimal Word document with the given paragraphs, without depending on python-docx.
+    """
+    body = "".join(f"<w:p><w:r><w:t>{paragraph}</w:t></w:r></w:p>" for paragraph in paragraphs)
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+        f"<w:body>{body}</w:body></w:document>"
+    )
+    content_types = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/word/document.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+        "</Types>"
+    )
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr("[Content_Types].xml", content_types)
+        docx.writestr("word/document.xml", document)
+    return buffer.getvalue()
+
+
+@dataclass
+class RouteStats:
+    """
+    The latencies, errors and status codes of the requests of a route.
+    """
+
+    latencies: LatencyTracker = field(default_factory=lambda: LatencyTracker(window=1_000_000))
+    errors: int = 0
+    status_codes: dict[int, int] = field(default_factory=dict)
+
+
+class LoadTestDriver:
+    """
+    Replays experiment sessions (identify, upload, poll for the file IDs, N prompts and the final
+    answer) against a server, with `concurrency` sessions in flight at a time.
+
+    Attributes:
+        url (str): The base URL of the server.
+        sessions (int): The number of sessions to replay.
+        concurrency (int): The number of sessions in flight at a time.
+        prompts (int): The number of prompts per session.
+        think_time (float): The mean number of seconds a user waits between requests.
+        poll_interval (float): The number of seconds between polls for the file IDs.
+        poll_timeout (float): The number of seconds after which polling is given up.
+        serialize_uploads (bool): Whether to upload and poll for one session at a time. A server
+            worker keeps a single upload job for /get_file_id_mappings, so concurrent uploads are
+            rejected with "future_key process_files already exists".
+    """
+
+    def __init__(
+        self,
+        url: str,
+        sessions: int = 20,
+        concurrency: int = 4,
+        prompts: int = 3,
+        think_time: float = 0.0,
+        poll_interval: float = 0.5,
+        poll_timeout: float = 120.0,
+        serialize_uploads: bool = True,
+    ) -> None:
+        self.url = url.rstrip("/")
+        self.sessions = sessions
+        self.concurrency = concurrency
+        self.prompts = prompts
+        self.think_time = think_time
+        self.poll_interval = poll_interval
+        self.poll_timeout = poll_timeout
+        self.serialize_uploads = serialize_uploads
+        self.stats: dict[str, RouteStats] = {}
+        self.failed_sessions = 0
+        self._lock = threading.Lock()
+        self._upload_lock = threading.Lock()
+
+    def _request(self, http: requests.Session, method: str, route: str, **kwargs: Any) -> requests.Response | None:
+        started_at = time.perf_counter()
+        try:
+            response = http.request(method, f"{self.url}{route}", timeout=600, **kwargs)
+        except requests.RequestException:
+            response = None
+        latency = time.perf_counter() - started_at
+        with self._lock:
+            stats = self.stats.setdefault(route, RouteStats())
+            status_code = response.status_code if response is not None else 0
+            stats.status_codes[status_code] = stats.status_codes.get(status_code, 0) + 1
+            if response is None or response.status_code >= 400:
+                stats.errors += 1
+            else:
+                stats.latencies.record(latency)
+        return response if response is not None and response.status_code < 400 else None
+
+    def _think(self) -> None:
+        if self.think_time > 0:
+            time.sleep(random.expovariate(1 / self.think_time))
+
+    def upload(self, http: requests.Session, session_id: str, session_number: int) -> bool:
+        """
+        Upload a document and poll until it has been processed.
+
+        Returns:
+            bool: Whether the document was processed in time.
+        """
+        paragraphs = random.sample(PARAGRAPHS, k=len(PARAGRAPHS))
+        # the route strips the prefix characters from the field name to get the file name
+        files = {f"upload-report-{session_number}.docx": (f"report-{session_number}.docx", make_docx(paragraphs))}
+        upload = self._request(
+            http, "POST", "/upload_files", data={"sessionId": session_id, "prefix": "upload-"}, files=files
+        )
+        if upload is None:
+            return False
+        deadline = time.monotonic() + self.poll_timeout
+        while (mapping := self._request(http, "GET", "/get_file_id_mappings")) is not None:
+            if mapping.status_code == 200 or time.monotonic() > deadline:
+                break
+            time.sleep(self.poll_interval)
+        return mapping is not None and mapping.status_code == 200
+
+    def run_session(self, session_number: int) -> bool:
+        """
+        Replay one session.
+
+        Returns:
+            bool: Whether every request of the session succeeded.
+        """
+        with requests.Session() as http:
+            if (identity := self._request(http, "POST", "/identify", json={})) is None:
+                return False
+            session_id = identity.json()["sessionId"]
+            self._think()
+            with self._upload_lock if self.serialize_uploads else contextlib.nullcontext():
+                if not self.upload(http, session_id, session_number):
+                    return False
+            answer = ""
+            for question in random.sample(QUESTIONS, k=min(self.prompts, len(QUESTIONS))):
+                self._think()
+                prompt = self._request(http, "POST", "/prompt", json={"sessionId": session_id, "prompt": question})
+                if prompt is None:
+                    return False
+                answer = prompt.json()["result"]["answer"]
+            self._think()
+            final_answer = {
+                "sessionId": session_id,
+                "originalAnswer": {"answer": answer},
+                "editedAnswer": {"answer": f"{answer} (edited)"},
+            }
+            return self._request(http, "POST", "/submit_final_answer", json=final_answer) is not None
+
+    def run(self) -> dict[str, Any]:
+        """
+        Replay all sessions and summarise the requests per route.
+
+        Returns:
+            dict[str, Any]: The duration, the number of (failed) sessions and the statistics per route.
+        """
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            succeeded = list(executor.map(self.run_session, range(self.sessions)))
+        duration = time.perf_counter() - started_at
+        self.failed_sessions = succeeded.count(False)
+        return self.report(duration)
+
+    def report(self, duration: float) -> dict[str, Any]:
+        """
+        Summarise the throughput and latency percentiles of every route over a run.
+        """
+        routes = {}
+        for route, stats in self.stats.items():
+            requests_count = len(stats.latencies) + stats.errors
+            routes[route] = {
+                "requests": requests_count,
+                "errors": stats.errors,
+                "status_codes": stats.status_codes,
+                "throughput": requests_count / duration if duration else 0.0,
+                **{
+                    f"p{int(percentile * 100)}": stats.latencies.percentile(percentile)
+                    for percentile in (0.5, 0.95, 0.99)
+                },
+                "max": stats.latencies.percentile(1.0),
+            }
+        return {
+            "duration": duration,
+            "sessions": self.sessions,
+            "failed_sessions": self.failed_sessions,
+            "concurrency": self.concurrency,
+            "routes": routes,
+        }
+
+
+def format_report(report: dict[str, Any]) -> str:
+    """
+    Format a report as a table with one row per route.
+    """
+
+    def milliseconds(seconds: float | None) -> str:
+        return f"{seconds * 1000:.0f}" if seconds is not None else "-"
+
+    lines = [
+        f"{report['sessions']} sessions ({report['failed_sessions']} failed) at concurrency "
+        f"{report['concurrency']} in {report['duration']:.1f} s",
+        f"{'route':<24}{'requests':>9}{'errors':>8}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}",
+    ]
+    for route, stats in sorted(report["routes"].items()):
+        lines.append(
+            f"{route:<24}{stats['requests']:>9}{stats['errors']:>8}{stats['throughput']:>8.2f}"
+            f"{milliseconds(stats['p50']):>9}{milliseconds(stats['p95']):>9}"
+            f"{milliseconds(stats['p99']):>9}{milliseconds(stats['max']):>9}"
+        )
+    return "\n".join(lines)
+
+
+def main() -> None:
+    """
+    Run a load test from the command line.
+    """
+    parser = argparse.ArgumentParser(description="Replay experiment sessions against a Dora server")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="the base URL of the server")
+    parser.add_argument("--sessions", type=int, default=20, help="the number of sessions to replay")
+    parser.add_argument("--concurrency", type=int, default=4, help="the number of sessions in flight")
+    parser.add_argument("--prompts", type=int, default=3, help="the number of prompts per session")
+    parser.add_argument("--think-time", type=float, default=0.0, help="the mean seconds between requests")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="the seconds between polls for file IDs")
+    parser.add_argument(
+        "--concurrent-uploads", action="store_true", help="do not serialize the uploads of concurrent sessions"
+    )
+    parser.add_argument("--json", help="also write the report as JSON to this file")
+    args = parser.parse_args()
+    driver = LoadTestDriver(
+        args.url,
+        sessions=args.sessions,
+        concurrency=args.concurrency,
+        prompts=args.prompts,
+        think_time=args.think_time,
+        poll_interval=args.poll_interval,
+        serialize_uploads=not args.concurrent_uploads,
+    )
+    report = driver.run()
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2)
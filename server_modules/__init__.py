@@ -1,32 +1,39 @@
-from logging.config import dictConfig
+import logging
+import logging.handlers
 import os
+import sys
+
+from .structured_logging import JsonFormatter, start_logging_pipeline
 
 def set_logging_config(filename: str, max_bytes: int = 1_000_000, backup_count: int = 5):
+    """
+    Log to stdout and a rotating log file through a queue that a background thread writes out,
+    as JSON lines (LOGGING_FORMAT=json, the default) or as text (LOGGING_FORMAT=text).
+
+    The level is LOGGING_LEVEL (default INFO); of the debug records, those of a share of
+    LOGGING_DEBUG_SAMPLE_RATIO (default 0.01) of the requests are kept. At most LOGGING_QUEUE_SIZE
+    (default 10000) records wait to be written, records beyond that are dropped.
+    """
     if filename == "":
         raise ValueError("Filename cannot be empty.")
     os.makedirs(os.path.dirname(filename), exist_ok=True)
-    dictConfig(
-    {
-        "version": 1,
-        "formatters": {
-            "default": {
-                "format": "[%(asctime)s] %(levelname)s in %(module)s: %(message)s",
-            }
-        },
-        "handlers": {
-            "console": {
-                "class": "logging.StreamHandler",
-                "stream": "ext://sys.stdout",
-                "formatter": "default",
-            },
-            "file": {
-                "class": "logging.handlers.RotatingFileHandler",
-                "filename": filename,
-                "maxBytes": max_bytes,
-                "backupCount": backup_count,
-                "formatter": "default",
-            },
-        },
-        "root": {"level": "INFO", "handlers": ["console", "file"]},
-    }
-)
\ No newline at end of file
+    formatter: logging.Formatter
+    match os.environ.get("LOGGING_FORMAT", "json").lower():
+        case "json":
+            formatter = JsonFormatter()
+        case "text":
+            formatter = logging.Formatter("[%(asctime)s] %(levelname)s in %(module)s: %(message)s")
+        case logging_format:
+            raise ValueError(f"Invalid logging format {logging_format}")
+    console_handler = logging.StreamHandler(sys.stdout)
+    file_handler = logging.handlers.RotatingFileHandler(
+        filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+    )
+    for handler in (console_handler, file_handler):
+        handler.setFormatter(formatter)
+    return start_logging_pipeline(
+        [console_handler, file_handler],
+        level=os.environ.get("LOGGING_LEVEL", "INFO"),
+        queue_size=int(os.environ.get("LOGGING_QUEUE_SIZE", 10_000)),
+        debug_sample_ratio=float(os.environ.get("LOGGING_DEBUG_SAMPLE_RATIO", 0.01)),
+    )
@@ -0,0 +1,331 @@
+"""
+Module defining the AdmissionController class, which rate-limits sessions and sheds load before routes run
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Literal, cast
+
+
+PoolName = Literal["heavy", "light", "async"]
+
+HEAVY_ROUTES = {"/upload_files", "/upload_files_json", "/prompt"}
+EXEMPT_ROUTES = {"/", "/get_admission_stats", "/get_chat_model_stats", "/metrics", "/profile"}
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is not admitted.
+
+    Attributes:
+        reason (str): Why the request was rejected: "rate_limited", "queue_full" or "queue_timeout".
+        retry_after (int): The number of seconds after which the client may retry.
+    """
+
+    def __init__(self, reason: str, retry_after: int) -> None:
+        super().__init__(f"Too many requests ({reason}), retry after {retry_after} seconds")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    A token bucket that refills at a constant rate up to its capacity.
+
+    Attributes:
+        rate (float): The number of tokens added per second.
+        capacity (float): The maximum number of tokens, i.e. the allowed burst.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def take(self, cost: float = 1) -> float:
+        """
+        Take tokens from the bucket if it holds enough.
+
+        Returns:
+            float: 0 if the tokens were taken, else the number of seconds until the bucket holds enough.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+
+class ConcurrencyPool:
+    """
+    A pool of concurrency slots with a bounded queue of waiting requests.
+
+    A request waits for a slot for at most max_queue_wait seconds, and is rejected straight away
+    when max_queue requests are already waiting.
+
+    Attributes:
+        name (PoolName): The name of the pool.
+        max_concurrency (int): The number of requests that run at the same time.
+        max_queue (int): The maximum number of waiting requests.
+        max_queue_wait (float): The maximum number of seconds a request waits for a slot.
+    """
+
+    def __init__(self, name: PoolName, max_concurrency: int, max_queue: int, max_queue_wait: float) -> None:
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_wait = max_queue_wait
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.counters = {"admitted": 0, "queue_full": 0, "queue_timeout": 0}
+        self._average_service_time = 1.0
+        self._condition = threading.Condition()
+
+    def retry_after(self) -> int:
+        """
+        Estimate the number of seconds until the queue has drained, from the average service time.
+        """
+        return max(1, math.ceil(self._average_service_time * (self.queue_depth + 1) / self.max_concurrency))
+
+    def acquire(self) -> float:
+        """
+        Wait for a slot.
+
+        Returns:
+            float: The start time of the request, to pass to `release`.
+
+        Raises:
+            AdmissionRejected: If the queue is full or no slot came free in time.
+        """
+        with self._condition:
+            if self.in_flight >= self.max_concurrency:
+                if self.queue_depth >= self.max_queue:
+                    self.counters["queue_full"] += 1
+                    raise AdmissionRejected("queue_full", self.retry_after())
+                self.queue_depth += 1
+                try:
+                    admitted = self._condition.wait_for(
+                        lambda: self.in_flight < self.max_concurrency, timeout=self.max_queue_wait
+                    )
+                finally:
+                    self.queue_depth -= 1
+                if not admitted:
+                    self.counters["queue_timeout"] += 1
+                    raise AdmissionRejected("queue_timeout", self.retry_after())
+            self.in_flight += 1
+            self.counters["admitted"] += 1
+        return time.monotonic()
+
+    def release(self, start_time: float) -> None:
+        """
+        Free the slot of a finished request.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            self._average_service_time = 0.9 * self._average_service_time + 0.1 * (time.monotonic() - start_time)
+            self._condition.notify()
+
+    def stats(self) -> dict[str, Any]:
+        """
+        The counters, queue depth and number of requests in flight of the pool.
+        """
+        with self._condition:
+            return {
+                **self.counters,
+                "in_flight": self.in_flight,
+                "queue_depth": self.queue_depth,
+                "max_concurrency": self.max_concurrency,
+                "average_service_time": round(self._average_service_time, 3),
+            }
+
+
+class AsyncConcurrencyPool(ConcurrencyPool):
+    """
+    A concurrency pool for requests served on the event loop: a request waits for a slot on an
+    asyncio semaphore instead of blocking a thread. Its slots are acquired and released on the
+    event loop thread only.
+    """
+
+    def __init__(self, name: PoolName, max_concurrency: int, max_queue: int, max_queue_wait: float) -> None:
+        super().__init__(name, max_concurrency, max_queue, max_queue_wait)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def aacquire(self) -> float:
+        """
+        Wait for a slot without blocking the event loop.
+
+        Returns:
+            float: The start time of the request, to pass to `release`.
+
+        Raises:
+            AdmissionRejected: If the queue is full or no slot came free in time.
+        """
+        if self._semaphore.locked():
+            if self.queue_depth >= self.max_queue:
+                self.counters["queue_full"] += 1
+                raise AdmissionRejected("queue_full", self.retry_after())
+            self.queue_depth += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.max_queue_wait)
+            except asyncio.TimeoutError as error:
+                self.counters["queue_timeout"] += 1
+                raise AdmissionRejected("queue_timeout", self.retry_after()) from error
+            finally:
+                self.queue_depth -= 1
+        else:
+            await self._semaphore.acquire()
+        self.in_flight += 1
+        self.counters["admitted"] += 1
+        return time.monotonic()
+
+    def acquire(self) -> float:
+        raise TypeError("The slots of an async pool are acquired with aacquire")
+
+    def release(self, start_time: float) -> None:
+        self.in_flight -= 1
+        self._average_service_time = 0.9 * self._average_service_time + 0.1 * (time.monotonic() - start_time)
+        self._semaphore.release()
+
+
+@dataclass
+class AdmissionTicket:
+    """
+    The slot of an admitted request, to release when the request has finished.
+    """
+
+    pool: ConcurrencyPool
+    start_time: float
+
+
+class AdmissionController:
+    """
+    Decides per request whether it runs now, waits in a queue or is rejected with 429.
+
+    Heavy routes (ingestion and prompts) cost a token from the token bucket of their session and
+    run in the heavy pool; all other routes run in the light pool, so identification and history
+    requests keep being served when the heavy pool is saturated. Requests served on the event
+    loop (the async /prompt and the Socket.IO chat) are admitted with `aadmit` into the async
+    pool, which waits without holding a thread and is larger, since a waiting prompt costs no
+    thread. Settings are read from the ADMISSION_* environment variables.
+
+    Attributes:
+        enabled (bool): Whether requests are admission-controlled at all.
+        rate (float): The number of heavy requests per second a session may make on average.
+        burst (float): The number of heavy requests a session may make at once.
+        pools (dict[PoolName, ConcurrencyPool]): The concurrency pools.
+        rate_limited (int): The number of requests rejected by a token bucket.
+    """
+
+    def __init__(self, max_sessions: int = 10_000) -> None:
+        self.enabled = os.environ.get("ADMISSION_ENABLED", "true").lower() == "true"
+        self.rate = float(os.environ.get("ADMISSION_SESSION_RATE", 0.5))
+        self.burst = float(os.environ.get("ADMISSION_SESSION_BURST", 5))
+        max_queue = int(os.environ.get("ADMISSION_MAX_QUEUE", 32))
+        max_queue_wait = float(os.environ.get("ADMISSION_MAX_QUEUE_WAIT", 5))
+        self.pools: dict[PoolName, ConcurrencyPool] = {
+            "heavy": ConcurrencyPool(
+                "heavy", int(os.environ.get("ADMISSION_HEAVY_CONCURRENCY", 4)), max_queue, max_queue_wait
+            ),
+            "light": ConcurrencyPool(
+                "light", int(os.environ.get("ADMISSION_LIGHT_CONCURRENCY", 16)), max_queue, max_queue_wait
+            ),
+            "async": AsyncConcurrencyPool(
+                "async", int(os.environ.get("ADMISSION_ASYNC_CONCURRENCY", 64)), max_queue, max_queue_wait
+            ),
+        }
+        self.rate_limited = 0
+        self.max_sessions = max_sessions
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def classify(path: str) -> PoolName | None:
+        """
+        Get the pool of a route, or None if the route is not admission-controlled.
+        """
+        if path in EXEMPT_ROUTES or path.startswith(("/static", "/socket.io")):
+            return None
+        return "heavy" if path in HEAVY_ROUTES else "light"
+
+    def _take_token(self, session_id: str) -> None:
+        with self._lock:
+            if (bucket := self._buckets.get(session_id)) is None:
+                bucket = self._buckets[session_id] = TokenBucket(self.rate, self.burst)
+                while len(self._buckets) > self.max_sessions:
+                    self._buckets.popitem(last=False)
+            self._buckets.move_to_end(session_id)
+            if (wait_time := bucket.take()) > 0:
+                self.rate_limited += 1
+                raise AdmissionRejected("rate_limited", max(1, math.ceil(wait_time)))
+
+    def admit(self, path: str, session_id: str) -> AdmissionTicket | None:
+        """
+        Admit a request, waiting in the queue of its pool if needed.
+
+        Args:
+            path (str): The route of the request.
+            session_id (str): The session of the request (or the client address if it has none).
+
+        Returns:
+            AdmissionTicket | None: The ticket to release when the request has finished, or None
+            if the route is not admission-controlled.
+
+        Raises:
+            AdmissionRejected: If the request is rate-limited or shed.
+        """
+        if not self.enabled or (pool_name := self.classify(path)) is None:
+            return None
+        if pool_name == "heavy":
+            self._take_token(session_id)
+        pool = self.pools[pool_name]
+        return AdmissionTicket(pool, pool.acquire())
+
+    async def aadmit(self, path: str, session_id: str) -> AdmissionTicket | None:
+        """
+        Admit a request served on the event loop, waiting in the queue of the async pool if needed.
+
+        Args:
+            path (str): The route of the request.
+            session_id (str): The session of the request (or the client address if it has none).
+
+        Returns:
+            AdmissionTicket | None: The ticket to release on the event loop when the request has
+            finished, or None if the route is not admission-controlled.
+
+        Raises:
+            AdmissionRejected: If the request is rate-limited or shed.
+        """
+        if not self.enabled or (pool_name := self.classify(path)) is None:
+            return None
+        if pool_name == "heavy":
+            self._take_token(session_id)
+        pool = cast(AsyncConcurrencyPool, self.pools["async"])
+        return AdmissionTicket(pool, await pool.aacquire())
+
+    @staticmethod
+    def release(ticket: AdmissionTicket | None) -> None:
+        """
+        Release the slot of a finished request.
+        """
+        if ticket is not None:
+            ticket.pool.release(ticket.start_time)
+
+    def stats(self) -> dict[str, Any]:
+        """
+        The statistics of the pools, the number of rate-limited requests and tracked sessions.
+        """
+        with self._lock:
+            sessions = len(self._buckets)
+        return {
+            "enabled": self.enabled,
+            "rate_limited": self.rate_limited,
+            "sessions": sessions,
+            "pools": {name: pool.stats() for name, pool in self.pools.items()},
+        }
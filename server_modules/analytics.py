@@ -0,0 +1,211 @@
+"""
+Module defining the experiment analytics: the aggregates of the experiment sessions in
+final_answer, kept in experiment_summary and updated as sessions start and end, so reading
+them does not scan final_answer
+
+The writes of ExperimentSessionMethods call `ensure_summary`, read the session before and after
+their change with `read_session` and apply the difference with `record_session_change`, in the
+same transaction. The summary is computed from final_answer when it does not exist yet, and
+recomputed with `python -m server_modules.analytics`, e.g. after sessions were changed by hand.
+"""
+import json
+import logging
+from datetime import datetime
+from typing import Any
+
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import Connection, Row, func, select, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from chatdoc.utils import Utils
+from chatdoc.write_behind import get_engine
+from server_modules.models import ExperimentSummaryModel, FinalAnswerModel
+
+SUMMARY_ID = 1
+TOTALS = ("finished_sessions", "total_duration", "total_messages", "total_edit_distance")
+SESSION_COLUMNS = (
+    FinalAnswerModel.start_time,
+    FinalAnswerModel.end_time,
+    FinalAnswerModel.number_of_messages,
+    FinalAnswerModel.original_answer,
+    FinalAnswerModel.edited_answer,
+)
+
+logger = logging.getLogger("analytics")
+
+
+def answer_text(answer: dict[str, Any] | None) -> str:
+    """
+    The text of an original or edited answer: its "answer", or the whole answer as JSON if it has none.
+    """
+    if not answer:
+        return ""
+    if isinstance(answer.get("answer"), str):
+        return answer["answer"]
+    return json.dumps(answer, sort_keys=True)
+
+
+def edit_distance(original: str, edited: str) -> int:
+    """
+    The number of words inserted, deleted or replaced to edit the original text into the edited one
+    (the Levenshtein distance between their words).
+    """
+    original_words, edited_words = original.split(), edited.split()
+    # edits are mostly local, so the words both texts start and end with are skipped
+    start = 0
+    while start < min(len(original_words), len(edited_words)) and original_words[start] == edited_words[start]:
+        start += 1
+    end = 0
+    while (
+        end < min(len(original_words), len(edited_words)) - start
+        and original_words[-1 - end] == edited_words[-1 - end]
+    ):
+        end += 1
+    original_words = original_words[start : len(original_words) - end]
+    edited_words = edited_words[start : len(edited_words) - end]
+    if len(original_words) < len(edited_words):
+        original_words, edited_words = edited_words, original_words
+    previous = list(range(len(edited_words) + 1))
+    for i, original_word in enumerate(original_words, 1):
+        current = [i]
+        for j, edited_word in enumerate(edited_words, 1):
+            current.append(
+                min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (original_word != edited_word))
+            )
+        previous = current
+    return previous[-1]
+
+
+def session_totals(session: Row | None) -> dict[str, float]:
+    """
+    What a session adds to the totals of the summary; only finished sessions add to them.
+    """
+    if session is None or session.end_time is None or session.start_time is None:
+        return dict.fromkeys(TOTALS, 0)
+    return {
+        "finished_sessions": 1,
+        "total_duration": max((session.end_time - session.start_time).total_seconds(), 0.0),
+        "total_messages": max(session.number_of_messages or 0, 0),
+        "total_edit_distance": edit_distance(
+            answer_text(session.original_answer), answer_text(session.edited_answer)
+        ),
+    }
+
+
+def read_session(connection: Connection, session_id: str) -> Row | None:
+    """
+    Read the columns of a session that the summary is computed from.
+    """
+    return connection.execute(select(*SESSION_COLUMNS).where(FinalAnswerModel.session_id == session_id)).first()
+
+
+def compute_summary(connection: Connection) -> dict[str, float]:
+    """
+    Compute the totals of the summary from all sessions in final_answer.
+    """
+    summary = dict.fromkeys(("number_of_sessions",) + TOTALS, 0)
+    for session in connection.execute(select(*SESSION_COLUMNS)):
+        summary["number_of_sessions"] += 1
+        for total, value in session_totals(session).items():
+            summary[total] += value
+    return summary
+
+
+def ensure_summary(connection: Connection) -> None:
+    """
+    Create the summary from final_answer if it does not exist yet. Call it before changing a
+    session, so that the change is not counted twice.
+    """
+    if connection.execute(select(ExperimentSummaryModel.id).where(ExperimentSummaryModel.id == SUMMARY_ID)).first():
+        return
+    summary_table = ExperimentSummaryModel.__table__
+    values = {"id": SUMMARY_ID, "version": 1, **compute_summary(connection)}
+    match connection.dialect.name:
+        case "sqlite":
+            create_summary = sqlite_insert(summary_table).values(values).on_conflict_do_nothing()
+        case "postgresql":
+            create_summary = postgresql_insert(summary_table).values(values).on_conflict_do_nothing()
+        case _:
+            create_summary = (
+                mysql_insert(summary_table).values(values).on_duplicate_key_update(id=summary_table.c.id)
+            )
+    connection.execute(create_summary)
+
+
+def record_session_change(connection: Connection, before: Row | None, after: Row | None) -> None:
+    """
+    Apply the change of a session, read with `read_session` before and after it, to the summary.
+    """
+    summary_table = ExperimentSummaryModel.__table__
+    totals_before, totals_after = session_totals(before), session_totals(after)
+    changes = {
+        total: summary_table.c[total] + (totals_after[total] - totals_before[total])
+        for total in TOTALS
+        if totals_after[total] != totals_before[total]
+    }
+    connection.execute(
+        update(summary_table)
+        .where(summary_table.c.id == SUMMARY_ID)
+        .values(
+            number_of_sessions=summary_table.c.number_of_sessions + ((after is not None) - (before is not None)),
+            version=summary_table.c.version + 1,
+            updated_at=func.now(),  # pylint: disable=not-callable
+            **changes,
+        )
+    )
+
+
+def read_summary(connection: Connection) -> dict[str, Any]:
+    """
+    Read the summary, with the averages per finished session.
+    """
+    ensure_summary(connection)
+    summary = (
+        connection.execute(select(ExperimentSummaryModel).where(ExperimentSummaryModel.id == SUMMARY_ID))
+        .one()
+        ._asdict()
+    )
+    del summary["id"]
+    finished_sessions = summary["finished_sessions"]
+    for total in ("duration", "messages", "edit_distance"):
+        summary[f"average_{total}"] = summary[f"total_{total}"] / finished_sessions if finished_sessions else None
+    if isinstance(summary["updated_at"], datetime):
+        summary["updated_at"] = summary["updated_at"].strftime("%Y-%m-%d %H:%M:%S")
+    return summary
+
+
+def rebuild_summary(connection_string: str) -> dict[str, float]:
+    """
+    Recompute the summary from all sessions in final_answer, e.g. after they were changed by hand.
+    """
+    ExperimentSummaryModel.metadata.create_all(get_engine(connection_string))
+    summary_table = ExperimentSummaryModel.__table__
+    with get_engine(connection_string).begin() as connection:
+        ensure_summary(connection)
+        summary = compute_summary(connection)
+        connection.execute(
+            update(summary_table)
+            .where(summary_table.c.id == SUMMARY_ID)
+            .values(
+                version=summary_table.c.version + 1,
+                updated_at=func.now(),  # pylint: disable=not-callable
+                **summary,
+            )
+        )
+    logger.info("Recomputed the summary of %d sessions", summary["number_of_sessions"])
+    return summary
+
+
+def main() -> None:
+    """
+    Recompute the experiment summary from final_answer.
+    """
+    load_dotenv(find_dotenv())
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s in %(module)s: %(message)s")
+    rebuild_summary(Utils.get_env_variable("FINAL_ANSWER_CONNECTION_STRING"))
+
+
+if __name__ == "__main__":
+    main()
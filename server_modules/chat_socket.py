@@ -0,0 +1,153 @@
+"""
+Module defining the ChatSocketServer class, the Socket.IO chat backed by the chatbot
+"""
+import asyncio
+import logging
+from typing import Any, Callable
+from urllib.parse import parse_qs
+
+import socketio
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+
+from chatdoc.chat_history import NormalizedChatMessageHistory
+from chatdoc.chatbot import Chatbot
+from chatdoc.tracing import tracer
+from chatdoc.utils import Utils
+from server_modules.admission import AdmissionController, AdmissionRejected
+
+
+TYPING_CONTENT = "INTERNAL_TYPING"
+AUTHORS = {"human": "user", "ai": "assistant"}
+
+
+class TokenQueueHandler(BaseCallbackHandler):
+    """
+    Puts the tokens of the chat model on an asyncio queue, from whichever thread the chat model runs in.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue[str | None]) -> None:
+        self.loop = loop
+        self.queue = queue
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, token)
+
+
+def to_chat_message(message: BaseMessage) -> dict[str, Any]:
+    """
+    Convert a stored message into the message format of the chat client.
+    """
+    return {
+        "author": AUTHORS.get(message.type, message.type),
+        "content": str(message.content),
+        "attachments": [],
+        "citations": message.additional_kwargs.get("citations", []),
+    }
+
+
+class ChatSocketServer:
+    """
+    A Socket.IO chat in which every session has its own room.
+
+    A client connects with its session ID (`io({auth: {sessionId}})` or `?sessionId=`) and joins
+    the room of its session, so all its tabs see the same conversation. The history is read from
+    the chat history database, and answers are streamed to the room as `chat_token` events before
+    the complete message is sent as a `chat_recieve` event.
+
+    Attributes:
+        server (socketio.AsyncServer): The Socket.IO server, served by `socketio.ASGIApp`.
+        admission (AdmissionController): The admission control that chat messages pass like prompts.
+    """
+
+    def __init__(
+        self,
+        admission: AdmissionController,
+        logger: logging.Logger,
+        create_chatbot: Callable[[str], Chatbot] = lambda session_id: Chatbot(user_id=session_id, streaming=True),
+        cors_allowed_origins: str | list[str] = "*",
+    ) -> None:
+        self.admission = admission
+        self.logger = logger
+        self.create_chatbot = create_chatbot
+        self.server = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins=cors_allowed_origins)
+        self.server.on("connect", self.connect)
+        self.server.on("get_history", self.get_history)
+        self.server.on("chat_send", self.chat_send)
+
+    async def connect(self, sid: str, environ: dict[str, Any], auth: dict[str, Any] | None = None) -> None:
+        """
+        Accept a client with a session ID and let it join the room of its session.
+
+        Raises:
+            socketio.exceptions.ConnectionRefusedError: If the client has no session ID.
+        """
+        session_id = (auth or {}).get("sessionId")
+        if not session_id:
+            session_id = next(iter(parse_qs(environ.get("QUERY_STRING", "")).get("sessionId", [])), None)
+        if not session_id:
+            raise socketio.exceptions.ConnectionRefusedError("No sessionId given")
+        await self.server.save_session(sid, {"session_id": str(session_id)})
+        await self.server.enter_room(sid, str(session_id))
+
+    async def _session_id(self, sid: str) -> str:
+        return (await self.server.get_session(sid))["session_id"]
+
+    async def get_history(self, sid: str, _data: Any = None) -> None:
+        """
+        Send the chat history of the session to the client.
+        """
+        chat_history = NormalizedChatMessageHistory(
+            await self._session_id(sid), Utils.get_env_variable("CHAT_HISTORY_CONNECTION_STRING")
+        )
+        messages = await chat_history.aget_messages()
+        await self.server.emit("get_history", [to_chat_message(message) for message in messages], to=sid)
+
+    async def _emit_tokens(self, queue: asyncio.Queue[str | None], room: str) -> None:
+        while (token := await queue.get()) is not None:
+            await self.server.emit("chat_token", {"author": "assistant", "content": token}, room=room)
+
+    async def chat_send(self, sid: str, message: dict[str, Any]) -> None:
+        """
+        Answer a chat message of the client, streaming the answer to the room of its session.
+        """
+        session_id = await self._session_id(sid)
+        content = str(message.get("content", "")).strip()
+        if not content:
+            await self.server.emit("chat_error", {"error": "Empty message"}, to=sid)
+            return
+        await self.server.emit("chat_recieve", message, room=session_id, skip_sid=sid)
+        try:
+            admission_ticket = await self.admission.aadmit("/prompt", session_id)
+        except AdmissionRejected as rejection:
+            await self.server.emit(
+                "chat_error", {"error": str(rejection), "retryAfter": rejection.retry_after}, to=sid
+            )
+            return
+        await self.server.emit(
+            "chat_recieve", {"author": "assistant", "content": TYPING_CONTENT, "attachments": []}, room=session_id
+        )
+        tokens: asyncio.Queue[str | None] = asyncio.Queue()
+        token_emitter = asyncio.create_task(self._emit_tokens(tokens, session_id))
+        try:
+            with tracer.start_as_current_span("chat_send", attributes={"session.id": session_id}):
+                chatbot = await asyncio.to_thread(self.create_chatbot, session_id)
+                result = await chatbot.asend_prompt(
+                    content, callbacks=[TokenQueueHandler(asyncio.get_running_loop(), tokens)]
+                )
+        except Exception as error:  # pylint: disable=broad-except
+            self.logger.exception("Chat message of session %s failed", session_id)
+            await self.server.emit("chat_error", {"error": str(error)}, room=session_id)
+            return
+        finally:
+            # queued behind the token callbacks that chat model threads have scheduled
+            asyncio.get_running_loop().call_soon_threadsafe(tokens.put_nowait, None)
+            await token_emitter
+            self.admission.release(admission_ticket)
+        answer = {
+            "author": "assistant",
+            "content": result["answer"],
+            "attachments": [],
+            "citations": result["citations"],
+        }
+        await self.server.emit("chat_recieve", answer, room=session_id)
@@ -39,7 +39,14 @@ class WEMUploadResponse(ResponseMessage):
     Represents a response for uploading files from WEM.
     """
 
-    fileIdMapping: list[dict[str, str | list[str]]]
+    fileIdMapping: list[dict[str, str | list[str] | int]]
+
+class UploadStatusResponse(WEMUploadResponse):
+    """
+    Represents a response for an upload that is still being processed, with the progress of the
+    ingestion jobs of the worker.
+    """
+    progress: list[dict[str, Any]]
 
 class UploadResponse(ResponseMessage):
     """
@@ -68,3 +75,27 @@ class SessionQueryResponse(ResponseMessage):
     """
     result: list[dict[str, Any]]
 
+class SessionStatsResponse(ResponseMessage):
+    """
+    Represents a response for the aggregates of the experiment sessions.
+    """
+    result: dict[str, Any]
+
+
+class ChatModelStatsResponse(ResponseMessage):
+    """
+    Represents a response for the chat model router statistics.
+    """
+    result: dict[str, dict[str, Any]]
+
+class AdmissionStatsResponse(ResponseMessage):
+    """
+    Represents a response for the admission control statistics.
+    """
+    result: dict[str, Any]
+
+class ProfilingStatusResponse(ResponseMessage):
+    """
+    Represents a response for the armed routes and jobs of the profiler.
+    """
+    result: dict[str, Any]
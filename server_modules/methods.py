@@ -1,50 +1,61 @@
 import os
 from pathlib import Path
 import tempfile
+import time
 import shutil
+import threading
 import logging
 from datetime import datetime
 from typing import Any
-from tqdm.auto import tqdm
 
 from flask import Flask
 import sqlalchemy
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.datastructures import FileStorage
 
+from chatdoc.doc_loader.dedup import MinHashDeduplicator
 from chatdoc.doc_loader.document_loader import DocumentLoader
 from chatdoc.doc_loader.document_loader_factory import DocumentLoaderFactory
+from chatdoc.doc_loader.upload_buffer import UploadBuffer
 from chatdoc.vector_db import VectorDatabase
 from chatdoc.embed.embedding_factory import EmbeddingFactory
+from chatdoc.metrics import DOCUMENTS, InstrumentedEmbeddings, observe_stage, stage_timer
 from chatdoc.utils import Utils
-from server_modules.models import FinalAnswerModel, ChatHistoryModel
+from chatdoc.chat_history import NormalizedChatMessageHistory
+from chatdoc.write_behind import get_engine, write_behind
+from server_modules import analytics
+from server_modules.models import FinalAnswerModel, ChatMessageModel
+from server_modules.structured_logging import job_progress
 
 
-def create_tmp_dir(session_id: str) -> Path:
+def create_tmp_dir(session_id: str, upload_id: str) -> Path:
     """
-    Create a temporary directory to store the files of the session ID in before processing them asynchronously
+    Create a temporary directory to store the files of a single upload of the session ID in before processing them asynchronously
     Return: a Path object with the path to the new directory
     """
-    if session_id == "":
-        raise ValueError("Session ID cannot be empty")
-    dir_path: Path = Path(tempfile.gettempdir()) / Path(session_id)
+    if session_id == "" or upload_id == "":
+        raise ValueError("Session ID and upload ID cannot be empty")
+    dir_path: Path = Path(tempfile.gettempdir()) / Path(session_id) / Path(upload_id)
     os.makedirs(dir_path, exist_ok=True)
     return dir_path
 
 
-def delete_tmp_dir(session_id: str) -> bool:
+def delete_tmp_dir(session_id: str, upload_id: str) -> bool:
     """
-    Delete the temporary directory coupled with the session ID when processing has finished
+    Delete the temporary directory coupled with a single upload of the session ID when processing has finished,
+    leaving the directories of concurrent uploads of the same session untouched
     Return: a bool to indicate if it succeeded
     """
-    if session_id == "":
-        raise ValueError("Session ID cannot be empty")
-    dir_path: Path = Path(tempfile.gettempdir()) / Path(session_id)
+    if session_id == "" or upload_id == "":
+        raise ValueError("Session ID and upload ID cannot be empty")
+    session_dir_path: Path = Path(tempfile.gettempdir()) / Path(session_id)
+    upload_dir_path: Path = session_dir_path / Path(upload_id)
+    shutil.rmtree(upload_dir_path, ignore_errors=True)
     try:
-        shutil.rmtree(dir_path, ignore_errors=True)
-        return True
-    except FileNotFoundError:
-        return False
+        session_dir_path.rmdir()
+    except OSError:
+        pass  # the session directory is absent or still holds concurrent uploads
+    return not upload_dir_path.exists()
 
 
 class ServerMethods:
@@ -55,66 +66,118 @@ class ServerMethods:
     def __init__(self, app: Flask):
         self.app = app
 
-    FileToPathMapping = dict[str, Path]
+    FileToBufferMapping = dict[str, UploadBuffer]
     OriginalFileMapping = dict[str, str]
 
-    async def save_files_to_tmp(
-        self, files: dict[str, FileStorage], session_id: str
-    ) -> tuple[OriginalFileMapping, FileToPathMapping]:
+    def buffer_files(
+        self, files: dict[str, FileStorage], session_id: str, upload_id: str
+    ) -> tuple[OriginalFileMapping, FileToBufferMapping]:
         """
-        Save the files to a temporary directory.
+        Buffer the uploaded files in memory, spilling files above the in-memory threshold to a
+        temporary directory of this upload.
+
+        The buffers are read by the document loaders directly, so files below the threshold are
+        never written to and read back from disk.
 
         Args:
-            files (dict[str, FileStorage]): A dictionary containing the files to be saved.
+            files (dict[str, FileStorage]): A dictionary containing the files to be buffered.
             session_id (str): The ID of the session.
+            upload_id (str): The ID of this upload.
 
         Returns:
-            A tuple containing the original file names and the full file paths.
+            A tuple containing the original file names and the upload buffers.
         """
-        dir_path = create_tmp_dir(session_id=session_id)
-        self.app.logger.info(f"Created temporary directory for session {session_id}")
+        in_memory_max_bytes = int(os.environ.get("INGEST_IN_MEMORY_MAX_BYTES", 50_000_000))
         original_name_dict: dict[str, str] = {}
-        full_document_dict: dict[str, Path] = {}
-        for filename, file in tqdm(files.items(), desc="Saving files"):
+        buffer_dict: dict[str, UploadBuffer] = {}
+        for filename, file in files.items():
             unique_file_name = Utils.get_unique_filename(filename)
             original_name_dict[unique_file_name] = filename
+            stream = file.stream
+            file_size = stream.seek(0, os.SEEK_END)
+            stream.seek(0)
+            if file_size <= in_memory_max_bytes:
+                # this copies the upload out of werkzeug's SpooledTemporaryFile once; a view of the
+                # stream's own buffer is not possible, as werkzeug closes the stream when the request
+                # ends, before the ingestion job has read it
+                buffer_dict[unique_file_name] = UploadBuffer(unique_file_name, data=memoryview(stream.read()))
+                continue
+            dir_path = create_tmp_dir(session_id=session_id, upload_id=upload_id)
             unique_file_path = dir_path / Path(unique_file_name)
-            full_document_dict[unique_file_name] = unique_file_path
             file.save(unique_file_path)
-        return original_name_dict, full_document_dict
+            buffer_dict[unique_file_name] = UploadBuffer(unique_file_name, path=unique_file_path)
+            self.app.logger.info(f"Spilled {unique_file_name} ({file_size} bytes) to disk for session {session_id}")
+        return original_name_dict, buffer_dict
 
     async def save_files_to_vector_db(
-        self, file_dict: dict[str, Path], user_id: str
-    ) -> dict[str, list[str]]:
+        self, file_dict: FileToBufferMapping, user_id: str, upload_id: str
+    ) -> tuple[dict[str, list[str]], dict[str, int]]:
         """
         Process the files in the given document dictionary and add them to the vector database.
 
+        Chunks that are near-duplicates of another chunk of the same file are dropped before they
+        are embedded (unless DEDUP_ENABLED is false). Chunks are not compared across files, so
+        deleting a file never removes content of another file.
+        The progress of the upload is reported per file and stage under its upload ID.
+
         Args:
-            document_dict (dict[str, Path]): A dictionary mapping document names to their file paths.
+            file_dict (dict[str, UploadBuffer]): A dictionary mapping document names to their upload buffers.
             user_id (str): The ID of the user.
+            upload_id (str): The ID of the upload the files belong to.
 
         Returns:
-            A dictionary of file names and their corresponding document IDs.
+            A dictionary of file names and their corresponding document IDs, and a dictionary of
+            file names and the number of duplicate chunks removed from them.
         """
-        embedding_fn = EmbeddingFactory().create()
+        embedding_fn = InstrumentedEmbeddings(EmbeddingFactory().create(), "ingest")
         vector_db = VectorDatabase(user_id, embedding_fn)
         loader_factory = DocumentLoaderFactory()
-        document_loader = DocumentLoader(file_dict, loader_factory, self.app.logger)
+        document_loader = DocumentLoader(dict(file_dict), loader_factory, self.app.logger)
+        dedup_enabled = os.environ.get("DEDUP_ENABLED", "true").lower() != "false"
         file_id_mapping = {}
-        for filename in tqdm(file_dict.keys(), desc="Processing files"):
-            document_iterator = document_loader.document_iterators_dict[filename]
-            documents = document_loader.text_splitter.split_documents(document_iterator)
-            document_ids = await vector_db.add_documents(documents)
-            file_id_mapping[filename] = document_ids
-        if delete_tmp_dir(user_id):
-            self.app.logger.info(
-                f"Cleaned up temporary directory for session {user_id}"
-            )
-        else:
-            self.app.logger.error(
-                f"Failed to clean up temporary directory for session {user_id}"
-            )
-        return file_id_mapping
+        duplicates_removed_mapping = {}
+        try:
+            for files_done, filename in enumerate(file_dict.keys()):
+                job_progress.update(upload_id, "parse", files_done, len(file_dict), file=filename)
+                with stage_timer("ingest", "parse"):
+                    pages = list(document_loader.document_iterators_dict[filename])
+                with stage_timer("ingest", "split"):
+                    documents = document_loader.text_splitter.split_documents(pages)
+                DOCUMENTS.labels("page").inc(len(pages))
+                duplicates_removed = 0
+                if dedup_enabled:
+                    with stage_timer("ingest", "dedup"):
+                        documents, duplicates_removed = MinHashDeduplicator().deduplicate(documents)
+                    self.app.logger.info(
+                        f"Removed {duplicates_removed} near-duplicate chunks from {filename}"
+                    )
+                DOCUMENTS.labels("chunk").inc(len(documents))
+                job_progress.update(
+                    upload_id, "embed", files_done, len(file_dict), file=filename, chunks=len(documents)
+                )
+                # the vector store embeds and persists in one call, so the embedding time is subtracted
+                embedding_seconds, started_at = embedding_fn.seconds, time.perf_counter()
+                document_ids = await vector_db.add_documents(documents)
+                observe_stage(
+                    "ingest",
+                    "persist",
+                    time.perf_counter() - started_at - (embedding_fn.seconds - embedding_seconds),
+                )
+                file_id_mapping[filename] = document_ids
+                duplicates_removed_mapping[filename] = duplicates_removed
+            job_progress.update(upload_id, "done", len(file_dict), len(file_dict))
+        finally:
+            for buffer in file_dict.values():
+                buffer.release()
+            if delete_tmp_dir(user_id, upload_id):
+                self.app.logger.info(
+                    f"Cleaned up temporary directory of upload {upload_id} for session {user_id}"
+                )
+            else:
+                self.app.logger.error(
+                    f"Failed to clean up temporary directory of upload {upload_id} for session {user_id}"
+                )
+        return file_id_mapping, duplicates_removed_mapping
 
     async def delete_docs_from_vector_db(
         self, document_ids: list[str], session_id: str
@@ -140,6 +203,10 @@ class ExperimentSessionMethods:
     Method class for handling the creation and updating of experiment sessions.
     """
 
+    __created_tables: set[str] = set()
+    __tables_lock = threading.Lock()
+    __sessions_cache: tuple[tuple[str, int], list[dict[str, Any]]] | None = None
+
     @staticmethod
     def __parse_dates(rows: list[dict[str, Any]]) -> list[dict[str, Any]]:
         """
@@ -158,8 +225,7 @@ class ExperimentSessionMethods:
         """
         Get all the rows from the given table
         """
-        db_engine = sqlalchemy.create_engine(connection_string)
-        with db_engine.connect() as connection:
+        with get_engine(connection_string).connect() as connection:
             query = sqlalchemy.select(table_model)
             result = connection.execute(query)
             rows = [dict(row._asdict()) for row in result]
@@ -167,21 +233,30 @@ class ExperimentSessionMethods:
             return formatted_rows
 
 
+    @staticmethod
+    def __create_table(connection_string: str) -> None:
+        """
+        Create the final_answer and experiment_summary tables if they do not exist, once per worker
+        """
+        if connection_string in ExperimentSessionMethods.__created_tables:
+            return
+        with ExperimentSessionMethods.__tables_lock:
+            if connection_string not in ExperimentSessionMethods.__created_tables:
+                FinalAnswerModel.metadata.create_all(
+                    get_engine(connection_string)
+                )  # CREATE TABLE IF NOT EXISTS final_answer, experiment_summary
+                ExperimentSessionMethods.__created_tables.add(connection_string)
+
     @staticmethod
     def add_new_session(session_id: str, logger: logging.Logger) -> None:
         """
         Add a new record to the final_answer table when the user starts a new session
+
+        The record is written by the write-behind buffer of the worker, after the response.
         """
         logger.info(f"Adding new record for session id: {session_id}")
-        db_engine = sqlalchemy.create_engine(
-            Utils.get_env_variable("FINAL_ANSWER_CONNECTION_STRING")
-        )
-        FinalAnswerModel.metadata.create_all(
-            db_engine
-        )  # CREATE TABLE IF NOT EXISTS final_answer
-        answer_model_record_query = sqlalchemy.select(FinalAnswerModel).where(
-            FinalAnswerModel.session_id == session_id
-        )  # SELECT * FROM final_answer WHERE session_id = session_id
+        connection_string = Utils.get_env_variable("FINAL_ANSWER_CONNECTION_STRING")
+        ExperimentSessionMethods.__create_table(connection_string)
         insertion_stmt = sqlalchemy.insert(FinalAnswerModel).values(
             session_id=session_id,
             start_time=sqlalchemy.func.now(),  # pylint: disable=not-callable
@@ -197,13 +272,47 @@ class ExperimentSessionMethods:
                 number_of_messages=-1,
             )
         )  # INSERT INTO final_answer (session_id, original_answer, edited_answer) VALUES (session_id, original_answer, edited_answer)
-        with db_engine.connect() as connection:
-            answer_model_record = connection.execute(answer_model_record_query)
-            if not answer_model_record.fetchone():
-                connection.execute(insertion_stmt)
-            else:
-                connection.execute(update_stmt)
-            connection.commit()
+
+        def write(connection: sqlalchemy.Connection) -> None:
+            with stage_timer("session", "db_write"):
+                analytics.ensure_summary(connection)
+                session_before = analytics.read_session(connection, session_id)
+                if session_before is None:
+                    connection.execute(insertion_stmt)
+                else:
+                    connection.execute(update_stmt)
+                analytics.record_session_change(
+                    connection, session_before, analytics.read_session(connection, session_id)
+                )
+
+        session_key = ExperimentSessionMethods.__session_key(connection_string, session_id)
+        write_behind.submit(connection_string, write, key=session_key, items=[session_id])
+
+    @staticmethod
+    def __session_key(connection_string: str, session_id: str) -> tuple[str, str, str]:
+        """
+        The key that a new session is readable under in the write-behind buffer until it is written
+        """
+        return ("final_answer", connection_string, session_id)
+
+    @staticmethod
+    def __session_exists(connection_string: str, session_id: str) -> bool:
+        """
+        Whether the final_answer table has a record of the session, or this worker has queued one
+        """
+        key = ExperimentSessionMethods.__session_key(connection_string, session_id)
+        query = sqlalchemy.select(FinalAnswerModel.session_id).where(FinalAnswerModel.session_id == session_id)
+        while True:
+            if (snapshot := write_behind.snapshot(key)) is None:
+                time.sleep(0.001)  # the queued record of the session is being written
+                continue
+            generation, pending = snapshot
+            if pending:
+                return True
+            with get_engine(connection_string).connect() as connection:
+                exists = connection.execute(query).first() is not None
+            if write_behind.generation(key) == generation:
+                return exists
 
     @staticmethod
     def update_session(
@@ -214,70 +323,91 @@ class ExperimentSessionMethods:
     ) -> None:
         """
         Update the final_answer table with the original and edited answers
+
+        The record is written by the write-behind buffer of the worker, after the response and
+        after the chat messages queued before it, whose number is read from chat_session.
+
+        Raises:
+            ValueError: If there is no record of the session.
         """
-        db_final_answer_engine = sqlalchemy.create_engine(
-            Utils.get_env_variable("FINAL_ANSWER_CONNECTION_STRING")
-        )
         logger.info(f"Updating final answer for session_id: {session_id}")
-        answer_model_record_query = sqlalchemy.select(FinalAnswerModel).where(
-            FinalAnswerModel.session_id == session_id
-        )  # SELECT * FROM final_answer WHERE session_id = session_id
-        update_stmt = (
-            sqlalchemy.update(FinalAnswerModel)
-            .where(FinalAnswerModel.session_id == session_id)
-            .values(
-                original_answer=original_answer,
-                edited_answer=edited_answer,
-                end_time=sqlalchemy.func.now(),  # pylint: disable=not-callable
-            )
-        )  # UPDATE final_answer SET original_answer = original_answer, edited_answer = edited_answer, end_time = NOW() WHERE session_id = session_id
-        with db_final_answer_engine.connect() as connection:
-            answer_model_record = connection.execute(answer_model_record_query)
-            if not answer_model_record.fetchone():
-                raise ValueError(f"No record found for session_id: {session_id}")
-            connection.execute(update_stmt)
-            connection.commit()
-        db_chat_history_engine = sqlalchemy.create_engine(
-            Utils.get_env_variable("CHAT_HISTORY_CONNECTION_STRING")
-        )
-        count_stmt = sqlalchemy.select(
-            sqlalchemy.func.count(ChatHistoryModel.id)  # pylint: disable=not-callable
-        ).where(ChatHistoryModel.session_id == session_id)
-        with db_chat_history_engine.connect() as connection:
-            number_of_messages = connection.execute(count_stmt).scalar()
-            if number_of_messages is None:
-                raise ValueError(f"No chat history found for session_id: {session_id}")
-        update_message_count = (
-            sqlalchemy.update(FinalAnswerModel)
-            .where(FinalAnswerModel.session_id == session_id)
-            .values(number_of_messages=number_of_messages)
-        )
-        with db_final_answer_engine.connect() as connection:
-            connection.execute(update_message_count)
-            connection.commit()
+        connection_string = Utils.get_env_variable("FINAL_ANSWER_CONNECTION_STRING")
+        chat_history_connection_string = Utils.get_env_variable("CHAT_HISTORY_CONNECTION_STRING")
+        chat_history = NormalizedChatMessageHistory(session_id, chat_history_connection_string)
+        chat_history._create_tables()  # pylint: disable=protected-access
+        ExperimentSessionMethods.__create_table(connection_string)
+        if not ExperimentSessionMethods.__session_exists(connection_string, session_id):
+            raise ValueError(f"No record found for session_id: {session_id}")
+
+        def write(connection: sqlalchemy.Connection) -> None:
+            with stage_timer("session", "db_write"):
+                if chat_history_connection_string == connection_string:
+                    number_of_messages = chat_history.count_messages(connection)
+                else:
+                    with get_engine(chat_history_connection_string).connect() as chat_connection:
+                        number_of_messages = chat_history.count_messages(chat_connection)
+                update_stmt = (
+                    sqlalchemy.update(FinalAnswerModel)
+                    .where(FinalAnswerModel.session_id == session_id)
+                    .values(
+                        original_answer=original_answer,
+                        edited_answer=edited_answer,
+                        end_time=sqlalchemy.func.now(),  # pylint: disable=not-callable
+                        number_of_messages=number_of_messages,
+                    )
+                )  # UPDATE final_answer SET original_answer = original_answer, edited_answer = edited_answer, end_time = NOW() WHERE session_id = session_id
+                analytics.ensure_summary(connection)
+                session_before = analytics.read_session(connection, session_id)
+                if session_before is None:
+                    logger.warning(f"No record found for session_id: {session_id}")
+                    return
+                connection.execute(update_stmt)
+                analytics.record_session_change(
+                    connection, session_before, analytics.read_session(connection, session_id)
+                )
+
+        write_behind.submit(connection_string, write)
 
     @staticmethod
-    def retrieve_sessions(logger: logging.Logger) -> list[dict[str, Any]]:
+    def retrieve_summary() -> dict[str, Any]:
+        """
+        Get the aggregates of the sessions from the experiment_summary table, see server_modules.analytics
+        """
+        connection_string = Utils.get_env_variable("FINAL_ANSWER_CONNECTION_STRING")
+        ExperimentSessionMethods.__create_table(connection_string)
+        with get_engine(connection_string).begin() as connection:
+            return analytics.read_summary(connection)
+
+    @staticmethod
+    def retrieve_sessions(logger: logging.Logger, version: int | None = None) -> list[dict[str, Any]]:
         """
         Get all the sessions from the final_answer table
+
+        With the version of the summary, the sessions are read once per version and worker.
         """
+        connection_string = Utils.get_env_variable("FINAL_ANSWER_CONNECTION_STRING")
+        cached_sessions = ExperimentSessionMethods.__sessions_cache
+        if version is not None and cached_sessions is not None and cached_sessions[0] == (connection_string, version):
+            return cached_sessions[1]
         sessions = ExperimentSessionMethods.__get_rows(
-            connection_string=Utils.get_env_variable("FINAL_ANSWER_CONNECTION_STRING"),
+            connection_string=connection_string,
             table_model=FinalAnswerModel,
         )
         logger.info(f"Retrieved {len(sessions)} sessions from the final_answer table")
+        if version is not None:
+            ExperimentSessionMethods.__sessions_cache = ((connection_string, version), sessions)
         return sessions
 
     @staticmethod
     def retrieve_chat_history(logger: logging.Logger) -> list[dict[str, Any]]:
         """
-        Get all the chat history from the chat_history table
+        Get all the chat messages from the chat_message table
         """
         chat_history = ExperimentSessionMethods.__get_rows(
             connection_string=Utils.get_env_variable("CHAT_HISTORY_CONNECTION_STRING"),
-            table_model=ChatHistoryModel,
+            table_model=ChatMessageModel,
         )
         logger.info(
-            f"Retrieved {len(chat_history)} chat history from the chat_history table"
+            f"Retrieved {len(chat_history)} chat messages from the chat_message table"
         )
         return chat_history
@@ -1,5 +1,5 @@
 import json
-from sqlalchemy import JSON, Column, Integer, String, DateTime
+from sqlalchemy import JSON, Boolean, Column, Float, ForeignKey, Index, Integer, String, DateTime, Text, func
 from sqlalchemy.orm import DeclarativeBase
 
 
@@ -12,12 +12,87 @@ class SecondBase(DeclarativeBase):
 
 
 class ChatHistoryModel(SecondBase):
+    """
+    The chat history as langchain's SQLChatMessageHistory stores it, one JSON blob per message.
+    Only read to copy it to the normalized tables below.
+    """
     __tablename__ = "message_store"
     id = Column(Integer, primary_key=True)
     session_id = Column(String(36))
     message = Column(JSON)
 
 
+class ChatMigrationModel(SecondBase):
+    """
+    The ID of the last message_store row that was copied to the normalized tables, in a single
+    row. message_store itself is left as it is.
+    """
+    __tablename__ = "message_store_migration"
+    id = Column(Integer, primary_key=True)
+    last_message_id = Column(Integer, nullable=False)
+
+
+class ChatSessionModel(SecondBase):
+    """
+    A chat session, with the number of messages kept up to date as they are added.
+    """
+    __tablename__ = "chat_session"
+    session_id = Column(String(36), primary_key=True)
+    created_at = Column(DateTime, server_default=func.now())  # pylint: disable=not-callable
+    updated_at = Column(DateTime, server_default=func.now())  # pylint: disable=not-callable
+    number_of_messages = Column(Integer, nullable=False, default=0)
+
+
+class ChatMessageModel(SecondBase):
+    """
+    A message of a chat session; the citations of an answer are stored in chat_citation.
+    citations_with_proof is NULL for messages without citations.
+    """
+    __tablename__ = "chat_message"
+    id = Column(Integer, primary_key=True)
+    session_id = Column(String(36), ForeignKey("chat_session.session_id"), nullable=False)
+    type = Column(String(16), nullable=False)
+    content = Column(Text, nullable=False)
+    additional_kwargs = Column(JSON)
+    citations_with_proof = Column(Boolean)
+    created_at = Column(DateTime, server_default=func.now())  # pylint: disable=not-callable
+    __table_args__ = (Index("ix_chat_message_session_id_id", "session_id", "id"),)
+
+
+class ChatCitationModel(SecondBase):
+    """
+    A citation of an answer, in the order of the citations of the answer.
+    """
+    __tablename__ = "chat_citation"
+    id = Column(Integer, primary_key=True)
+    message_id = Column(Integer, ForeignKey("chat_message.id"), nullable=False, index=True)
+    position = Column(Integer, nullable=False)
+    source = Column(Text, nullable=False)
+    page = Column(Integer, nullable=False)
+    page_end = Column(Integer)
+    section = Column(Text)
+    ranking = Column(Integer, nullable=False)
+    score = Column(Float, nullable=False)
+
+
+class ChatCitationSpanModel(SecondBase):
+    """
+    A sentence quoted as proof by a citation, referring to the chunk it is taken from; the proof
+    of a citation is its spans joined together.
+    """
+    __tablename__ = "chat_citation_span"
+    id = Column(Integer, primary_key=True)
+    message_id = Column(Integer, ForeignKey("chat_message.id"), nullable=False, index=True)
+    citation_position = Column(Integer, nullable=False)
+    position = Column(Integer, nullable=False)
+    chunk_id = Column(String(64), index=True)
+    text = Column(Text, nullable=False)
+    start_offset = Column(Integer, nullable=False)
+    end_offset = Column(Integer, nullable=False)
+    ranking = Column(Integer, nullable=False)
+    score = Column(Float, nullable=False)
+
+
 class FinalAnswerModel(Base):
     __tablename__ = "final_answer"
     session_id = Column(String(36), primary_key=True)
@@ -28,4 +103,20 @@ class FinalAnswerModel(Base):
     edited_answer = Column(JSON)
 
     def __repr__(self) -> str:
-        return f"FinalAnswer(session_id={self.session_id}, original_answer={json.dumps(self.original_answer)}, edited_answer={json.dumps(self.edited_answer)}, start_time={self.start_time}, end_time={self.end_time})"
\ No newline at end of file
+        return f"FinalAnswer(session_id={self.session_id}, original_answer={json.dumps(self.original_answer)}, edited_answer={json.dumps(self.edited_answer)}, start_time={self.start_time}, end_time={self.end_time})"
+
+
+class ExperimentSummaryModel(Base):
+    """
+    The aggregates of the experiment sessions in final_answer, in a single row that is updated
+    with every change of a session. version is incremented with every change.
+    """
+    __tablename__ = "experiment_summary"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    number_of_sessions = Column(Integer, nullable=False, default=0)
+    finished_sessions = Column(Integer, nullable=False, default=0)
+    total_duration = Column(Float, nullable=False, default=0)
+    total_messages = Column(Integer, nullable=False, default=0)
+    total_edit_distance = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, server_default=func.now())  # pylint: disable=not-callable
@@ -0,0 +1,141 @@
+"""
+Module defining the compact serialisation and the compression of responses
+
+Responses are serialised with orjson, which is several times faster than the json module and
+writes bytes without a detour through str. Bodies above COMPRESSION_MIN_BYTES are compressed with
+brotli (if the optional `compression` extra is installed) or gzip, whichever the client accepts.
+"""
+import gzip
+import os
+from decimal import Decimal
+from typing import Any
+
+import orjson
+from flask import Flask, Response, request
+from flask.json.provider import JSONProvider
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+
+COMPRESSIBLE_MIMETYPES = frozenset(
+    {"application/json", "text/html", "text/plain", "text/css", "text/javascript", "application/javascript"}
+)
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if hasattr(obj, "__html__"):
+        return str(obj.__html__())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Serialise an object to JSON; datetimes, UUIDs and dataclasses are serialised natively.
+    """
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class OrjsonProvider(JSONProvider):
+    """
+    The JSON provider of the Flask app, which serialises with orjson.
+    """
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return dumps(obj).decode("utf-8")
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        return self._app.response_class(dumps(self._prepare_response_obj(args, kwargs)), mimetype="application/json")
+
+
+class Compression:
+    """
+    Negotiates the content encoding of responses.
+
+    Attributes:
+        enabled (bool): Whether responses are compressed (COMPRESSION_ENABLED).
+        min_bytes (int): The size from which a body is compressed (COMPRESSION_MIN_BYTES).
+        level (int): The gzip level, of which the brotli quality is derived (COMPRESSION_LEVEL).
+    """
+
+    def __init__(self, enabled: bool | None = None, min_bytes: int | None = None, level: int | None = None) -> None:
+        self.enabled = (
+            enabled if enabled is not None else os.environ.get("COMPRESSION_ENABLED", "true").lower() != "false"
+        )
+        self.min_bytes = min_bytes if min_bytes is not None else int(os.environ.get("COMPRESSION_MIN_BYTES", 1024))
+        self.level = level if level is not None else int(os.environ.get("COMPRESSION_LEVEL", 5))
+
+    @staticmethod
+    def choose_encoding(accept_encoding: str) -> str | None:
+        """
+        Choose brotli or gzip from an Accept-Encoding header, following its quality values.
+
+        Returns:
+            str | None: "br", "gzip" or None if the client accepts neither.
+        """
+        qualities: dict[str, float] = {}
+        for coding in accept_encoding.split(","):
+            name, _, parameters = coding.strip().partition(";")
+            quality = 1.0
+            if parameters.strip().startswith("q="):
+                try:
+                    quality = float(parameters.strip()[2:])
+                except ValueError:
+                    quality = 0.0
+            qualities[name.strip().lower()] = quality
+        candidates = (["br"] if brotli is not None else []) + ["gzip"]
+        accepted = [(qualities.get(name, qualities.get("*", 0.0)), name) for name in candidates]
+        quality, encoding = max(accepted, key=lambda item: item[0])
+        return encoding if quality > 0 else None
+
+    def compress(self, body: bytes, mimetype: str, accept_encoding: str) -> tuple[bytes, str | None]:
+        """
+        Compress a body if it is large enough, of a compressible type and the client accepts it.
+
+        Returns:
+            tuple[bytes, str | None]: The (compressed) body and its content encoding, if any.
+        """
+        if not self.enabled or len(body) < self.min_bytes or mimetype not in COMPRESSIBLE_MIMETYPES:
+            return body, None
+        match self.choose_encoding(accept_encoding):
+            case "br":
+                # brotli quality 4 is about as fast as gzip level 5 and compresses JSON better
+                return brotli.compress(body, quality=min(11, max(0, self.level - 1))), "br"
+            case "gzip":
+                return gzip.compress(body, compresslevel=self.level, mtime=0), "gzip"
+            case _:
+                return body, None
+
+    def init_app(self, app: Flask) -> None:
+        """
+        Compress the responses of a Flask app, except streamed responses and files.
+        """
+
+        @app.after_request
+        def compress_response(response: Response) -> Response:
+            if (
+                response.direct_passthrough
+                or response.is_streamed
+                or response.status_code < 200
+                or response.status_code in (204, 304)
+                or "Content-Encoding" in response.headers
+            ):
+                return response
+            response.vary.add("Accept-Encoding")
+            body, encoding = self.compress(
+                response.get_data(), response.mimetype or "", request.headers.get("Accept-Encoding", "")
+            )
+            if encoding is not None:
+                response.set_data(body)
+                response.headers["Content-Encoding"] = encoding
+            return response
+
+
+compression = Compression()
@@ -0,0 +1,233 @@
+"""
+Module defining the non-blocking, structured logging pipeline and the progress of ingestion jobs
+
+Log records are put on a bounded queue by the thread that logs them, and formatted and written to
+stdout and the log file by a single background thread, so a request never waits on file I/O or on
+a handler lock. Every record carries the request, session and upload ID bound to the context it
+was logged in, and the ID of the current trace. Debug records are only kept for a sample of the
+requests, so LOGGING_LEVEL=DEBUG can be used under load.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Iterator
+
+from chatdoc.tracing import current_trace_id
+
+
+# the attributes every LogRecord has, anything else was passed with `extra`
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+log_context: contextvars.ContextVar[dict[str, Any]] = contextvars.ContextVar("log_context", default={})
+_debug_sampled: contextvars.ContextVar[bool | None] = contextvars.ContextVar("debug_sampled", default=None)
+
+
+@contextmanager
+def bind_log_context(**fields: Any) -> Iterator[None]:
+    """
+    Add fields, e.g. the request or upload ID, to every record logged in this context.
+    """
+    token = log_context.set({**log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        log_context.reset(token)
+
+
+def start_request_context(request_id: str, session_id: str, debug_sample_ratio: float) -> tuple[object, object]:
+    """
+    Bind the request and session ID, and decide whether the debug records of the request are kept.
+
+    Returns:
+        tuple[object, object]: The tokens to pass to `end_request_context`.
+    """
+    return (
+        log_context.set({**log_context.get(), "request_id": request_id, "session_id": session_id}),
+        _debug_sampled.set(random.random() < debug_sample_ratio),
+    )
+
+
+def update_log_context(**fields: Any) -> None:
+    """
+    Add fields to the log context of the current request, e.g. once its session ID is known; they
+    are unbound with the rest of the context by `end_request_context`.
+    """
+    log_context.set({**log_context.get(), **fields})
+
+
+def end_request_context(tokens: tuple[object, object]) -> None:
+    """
+    Restore the log context from before the request.
+    """
+    context_token, sampled_token = tokens
+    log_context.reset(context_token)  # type: ignore[arg-type]
+    _debug_sampled.reset(sampled_token)  # type: ignore[arg-type]
+
+
+class ContextFilter(logging.Filter):
+    """
+    Adds the bound log context and the trace ID to records, and keeps only a sample of the debug
+    records: all or none of those of a request, and `debug_sample_ratio` of the others.
+    """
+
+    def __init__(self, debug_sample_ratio: float = 1.0) -> None:
+        super().__init__()
+        self.debug_sample_ratio = debug_sample_ratio
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.INFO:
+            sampled = _debug_sampled.get()
+            if not (sampled if sampled is not None else random.random() < self.debug_sample_ratio):
+                return False
+        record.context = log_context.get()
+        record.trace_id = current_trace_id()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as a single line of JSON with its context and the fields passed with `extra`.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict[str, Any] = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "context", {}))
+        if trace_id := getattr(record, "trace_id", ""):
+            entry["trace_id"] = trace_id
+        entry.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in RECORD_ATTRIBUTES and key not in ("context", "trace_id")
+        )
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on a bounded queue without waiting; records that do not fit are dropped and counted.
+
+    The message and traceback are rendered before the record is queued, since its arguments may
+    change once the logging thread continues; the traceback is kept apart from the message.
+
+    Attributes:
+        dropped (int): The number of records dropped because the queue was full.
+    """
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JobProgress:
+    """
+    The progress of the ingestion jobs running in this worker, reported as log events and shown
+    in the job status.
+    """
+
+    def __init__(self) -> None:
+        self._jobs: dict[str, dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger("progress")
+
+    def update(self, job_id: str, stage: str, done: int, total: int, **fields: Any) -> None:
+        """
+        Record that a job has finished `done` of its `total` steps and is now in `stage`.
+        """
+        with self._lock:
+            progress = self._jobs.setdefault(job_id, {"jobId": job_id, "startedAt": time.time()})
+            progress.update(stage=stage, done=done, total=total, **fields)
+        self._logger.info(
+            "Job %s: %s (%d/%d)", job_id, stage, done, total, extra={"event": "progress", "job_id": job_id, **fields}
+        )
+
+    def finish(self, job_id: str) -> None:
+        """
+        Forget a finished job.
+        """
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def snapshot(self) -> list[dict[str, Any]]:
+        """
+        The progress of every running job.
+        """
+        with self._lock:
+            return [dict(progress) for progress in self._jobs.values()]
+
+
+job_progress = JobProgress()
+_listener: logging.handlers.QueueListener | None = None
+
+
+@atexit.register
+def stop_logging_pipeline() -> None:
+    """
+    Write the queued records and stop the background thread of the pipeline, if it is running.
+    """
+    global _listener  # pylint: disable=global-statement
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def start_logging_pipeline(
+    handlers: list[logging.Handler], level: str, queue_size: int, debug_sample_ratio: float
+) -> NonBlockingQueueHandler:
+    """
+    Route the records of the root logger through a queue to the handlers, which run on a
+    background thread that is flushed at exit. A running pipeline is stopped first.
+
+    Returns:
+        NonBlockingQueueHandler: The handler of the root logger.
+    """
+    global _listener  # pylint: disable=global-statement
+    stop_logging_pipeline()
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter(debug_sample_ratio))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, NonBlockingQueueHandler):
+            root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper())
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return queue_handler
@@ -0,0 +1,142 @@
+import asyncio
+import threading
+
+import pytest
+
+from server_modules.admission import (
+    AdmissionController,
+    AdmissionRejected,
+    AsyncConcurrencyPool,
+    ConcurrencyPool,
+    TokenBucket,
+)
+
+
+@pytest.fixture(name="controller")
+def controller_fixture(monkeypatch):
+    """
+    An admission controller with small pools and a small burst.
+    """
+    monkeypatch.setenv("ADMISSION_SESSION_RATE", "0.001")
+    monkeypatch.setenv("ADMISSION_SESSION_BURST", "2")
+    monkeypatch.setenv("ADMISSION_HEAVY_CONCURRENCY", "1")
+    monkeypatch.setenv("ADMISSION_MAX_QUEUE", "1")
+    monkeypatch.setenv("ADMISSION_MAX_QUEUE_WAIT", "0.05")
+    yield AdmissionController()
+
+
+def test_token_bucket_burst():
+    """
+    Test case to verify that a token bucket allows a burst and then reports the wait time.
+    """
+    bucket = TokenBucket(rate=1, capacity=2)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert 0 < bucket.take() <= 1
+
+
+def test_classify_routes():
+    """
+    Test case to verify that routes are assigned to the heavy and light pools.
+    """
+    assert AdmissionController.classify("/prompt") == "heavy"
+    assert AdmissionController.classify("/upload_files") == "heavy"
+    assert AdmissionController.classify("/identify") == "light"
+    assert AdmissionController.classify("/get_admission_stats") is None
+
+
+def test_session_is_rate_limited(controller):
+    """
+    Test case to verify that a session is rate-limited after its burst, without affecting other sessions.
+    """
+    for _ in range(2):
+        controller.release(controller.admit("/prompt", "session-a"))
+    with pytest.raises(AdmissionRejected) as rejection:
+        controller.admit("/prompt", "session-a")
+    assert rejection.value.reason == "rate_limited"
+    assert rejection.value.retry_after >= 1
+    controller.release(controller.admit("/prompt", "session-b"))
+    controller.release(controller.admit("/identify", "session-a"))
+    assert controller.stats()["rate_limited"] == 1
+
+
+def test_heavy_pool_sheds_when_queue_is_full(controller):
+    """
+    Test case to verify that heavy requests time out in the queue or are shed when the queue is full,
+    while light requests are still admitted.
+    """
+    ticket = controller.admit("/prompt", "session-a")
+    with pytest.raises(AdmissionRejected) as rejection:
+        controller.admit("/prompt", "session-b")
+    assert rejection.value.reason == "queue_timeout"
+    controller.release(controller.admit("/identify", "session-c"))
+    controller.release(ticket)
+    heavy_stats = controller.stats()["pools"]["heavy"]
+    assert heavy_stats["queue_timeout"] == 1 and heavy_stats["in_flight"] == 0
+
+
+def test_pool_admits_waiting_request_when_slot_frees():
+    """
+    Test case to verify that a waiting request is admitted as soon as a slot comes free,
+    and that requests beyond the queue are rejected straight away.
+    """
+    pool = ConcurrencyPool("heavy", max_concurrency=1, max_queue=1, max_queue_wait=5)
+    start_time = pool.acquire()
+    waiter_admitted = threading.Event()
+
+    def wait_for_slot() -> None:
+        pool.release(pool.acquire())
+        waiter_admitted.set()
+
+    waiter = threading.Thread(target=wait_for_slot)
+    waiter.start()
+    while pool.stats()["queue_depth"] == 0:
+        pass
+    with pytest.raises(AdmissionRejected) as rejection:
+        pool.acquire()
+    assert rejection.value.reason == "queue_full"
+    pool.release(start_time)
+    waiter.join(timeout=5)
+    assert waiter_admitted.is_set()
+
+
+def test_async_pool_waits_on_event_loop():
+    """
+    Test case to verify that requests on the event loop wait for a slot of the async pool without
+    a thread, and time out or are shed like in the threaded pools.
+    """
+
+    async def admit_requests() -> list[str]:
+        pool = AsyncConcurrencyPool("async", max_concurrency=1, max_queue=1, max_queue_wait=0.2)
+        start_time = await pool.aacquire()
+        waiter = asyncio.create_task(pool.aacquire())
+        await asyncio.sleep(0)
+        reasons = []
+        for attempt in range(2):
+            try:
+                await pool.aacquire()
+            except AdmissionRejected as rejection:
+                reasons.append(rejection.reason)
+            if attempt == 0:
+                pool.release(start_time)
+                start_time = await waiter
+        return reasons
+
+    assert asyncio.run(admit_requests()) == ["queue_full", "queue_timeout"]
+
+
+def test_async_admission_uses_async_pool(controller, monkeypatch):
+    """
+    Test case to verify that requests on the event loop are admitted into the async pool, not the heavy pool.
+    """
+
+    async def admit_prompts() -> None:
+        tickets = [await controller.aadmit("/prompt", f"session-{i}") for i in range(2)]
+        assert controller.stats()["pools"]["async"]["in_flight"] == 2
+        for ticket in tickets:
+            controller.release(ticket)
+
+    asyncio.run(admit_prompts())
+    stats = controller.stats()["pools"]
+    assert stats["async"]["admitted"] == 2 and stats["async"]["in_flight"] == 0
+    assert stats["heavy"]["admitted"] == 0
@@ -0,0 +1,91 @@
+"""
+Tests for the experiment analytics, kept up to date as sessions start and end
+"""
+import logging
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from chatdoc.chat_history import NormalizedChatMessageHistory
+from chatdoc.write_behind import get_engine, write_behind
+from server_modules import analytics
+from server_modules.methods import ExperimentSessionMethods
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.parametrize(
+    "original, edited, expected",
+    [
+        ("the pilot was a success", "the pilot was a success", 0),
+        ("the pilot was a success", "the pilot was a big success", 1),
+        ("the pilot was a success", "the trial was not a success", 2),
+        ("", "three new words", 3),
+        ("kitten sitting on a mat", "sitting on the mat", 2),
+    ],
+)
+def test_edit_distance_counts_words(original, edited, expected):
+    assert analytics.edit_distance(original, edited) == expected
+    assert analytics.edit_distance(edited, original) == expected
+
+
+def test_answer_text():
+    assert analytics.answer_text({"answer": "Yes."}) == "Yes."
+    assert analytics.answer_text({}) == analytics.answer_text(None) == ""
+    assert analytics.answer_text({"text": "Yes."}) == '{"text": "Yes."}'
+
+
+def test_summary_is_updated_as_sessions_start_and_end(tmp_path, monkeypatch):
+    connection_string = f"sqlite:///{tmp_path / 'experiment.db'}"
+    monkeypatch.setenv("FINAL_ANSWER_CONNECTION_STRING", connection_string)
+    monkeypatch.setenv("CHAT_HISTORY_CONNECTION_STRING", connection_string)
+
+    for session_id in ("session-a", "session-b", "session-c"):
+        ExperimentSessionMethods.add_new_session(session_id, logger)
+    NormalizedChatMessageHistory("session-a", connection_string).add_messages(
+        [HumanMessage(content="Did it work?"), AIMessage(content="The pilot was a success.")]
+    )
+    ExperimentSessionMethods.update_session(
+        "session-a", {"answer": "The pilot was a success."}, {"answer": "The pilot was a big success."}, logger
+    )
+    ExperimentSessionMethods.update_session("session-b", {"answer": "No."}, {"answer": "No."}, logger)
+    with pytest.raises(ValueError, match="No record found"):
+        ExperimentSessionMethods.update_session("unknown", {"answer": "No."}, {"answer": "Yes."}, logger)
+    write_behind.flush()
+
+    summary = ExperimentSessionMethods.retrieve_summary()
+    assert summary["number_of_sessions"] == 3 and summary["finished_sessions"] == 2
+    assert summary["total_messages"] == 2 and summary["average_messages"] == 1
+    assert summary["total_edit_distance"] == 1 and summary["average_edit_distance"] == 0.5
+
+    # restarting a session takes its answers out of the summary again
+    ExperimentSessionMethods.add_new_session("session-a", logger)
+    write_behind.flush()
+    restarted_summary = ExperimentSessionMethods.retrieve_summary()
+    assert restarted_summary["version"] > summary["version"]
+    assert restarted_summary["number_of_sessions"] == 3 and restarted_summary["finished_sessions"] == 1
+    assert restarted_summary["total_messages"] == 0 and restarted_summary["total_edit_distance"] == 0
+
+    with get_engine(connection_string).connect() as connection:
+        recomputed = analytics.compute_summary(connection)
+    assert recomputed == {
+        total: restarted_summary[total] for total in ("number_of_sessions",) + analytics.TOTALS
+    }
+
+
+def test_sessions_are_read_once_per_version(tmp_path, monkeypatch):
+    connection_string = f"sqlite:///{tmp_path / 'experiment.db'}"
+    monkeypatch.setenv("FINAL_ANSWER_CONNECTION_STRING", connection_string)
+    ExperimentSessionMethods.add_new_session("session-a", logger)
+    write_behind.flush()
+
+    version = ExperimentSessionMethods.retrieve_summary()["version"]
+    sessions = ExperimentSessionMethods.retrieve_sessions(logger, version)
+    assert [session["session_id"] for session in sessions] == ["session-a"]
+    assert ExperimentSessionMethods.retrieve_sessions(logger, version) is sessions
+
+    ExperimentSessionMethods.add_new_session("session-b", logger)
+    write_behind.flush()
+    new_version = ExperimentSessionMethods.retrieve_summary()["version"]
+    assert new_version > version
+    assert len(ExperimentSessionMethods.retrieve_sessions(logger, new_version)) == 2
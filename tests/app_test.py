@@ -0,0 +1,34 @@
+"""
+Tests for the start-up of the app
+"""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def test_importing_app_does_not_import_document_parsers(tmp_path):
+    """
+    Test case to verify that pypdf and docx2txt are only imported once a document is loaded.
+    """
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(ROOT),
+        "CURRENT_ENV": "DEV",
+        "LOGGING_FILE_PATH": str(tmp_path / "log.txt"),
+        "CHAT_HISTORY_CONNECTION_STRING": f"sqlite:///{tmp_path / 'chat_history.db'}",
+        "FINAL_ANSWER_CONNECTION_STRING": f"sqlite:///{tmp_path / 'final_answer.db'}",
+    }
+    completed = subprocess.run(
+        [sys.executable, "-c", "import sys, app; print(sorted({'pypdf', 'docx2txt'} & set(sys.modules)))"],
+        cwd=tmp_path,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=120,
+        check=True,
+    )
+    assert completed.stdout.strip().splitlines()[-1] == "[]"
@@ -0,0 +1,32 @@
+from langchain.schema.document import Document
+
+from chatdoc.doc_loader.boilerplate import BoilerplateStripper
+
+
+def test_running_header_and_page_number_are_stripped():
+    """
+    Test that lines repeated at the edges of most pages are removed and recorded in the metadata.
+    """
+    topics = ["verlof", "thuiswerken", "reiskosten", "opleidingen"]
+    pages = [
+        Document(
+            page_content=(
+                f"Personeelshandboek 2024\n\nRegels over {topic}\nDe regels voor {topic} gelden voor iedereen.\n"
+                f"Uitzonderingen op {topic} worden vastgelegd.\nVragen over {topic} gaan naar HR.\n\nPagina {page} van 4"
+            ),
+            metadata={"page": page - 1},
+        )
+        for page, topic in enumerate(topics, start=1)
+    ]
+    stripped_pages = list(BoilerplateStripper().process(pages))
+    assert stripped_pages[0].page_content.startswith("Regels over verlof\n")
+    assert stripped_pages[3].page_content.endswith("Vragen over opleidingen gaan naar HR.")
+    assert stripped_pages[0].metadata["boilerplate"] == "Personeelshandboek 2024 | Pagina 1 van 4"
+
+
+def test_short_documents_are_untouched():
+    """
+    Test that documents with fewer pages than the minimum are yielded unchanged.
+    """
+    pages = [Document(page_content="Kop\nTekst", metadata={"page": 0}), Document(page_content="Kop\nMeer", metadata={"page": 1})]
+    assert [page.page_content for page in BoilerplateStripper().process(pages)] == ["Kop\nTekst", "Kop\nMeer"]
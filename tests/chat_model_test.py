@@ -2,6 +2,7 @@ import os
 import pytest
 from langchain.chat_models.openai import ChatOpenAI
 from chatdoc.chat_model import ChatModel
+from chatdoc.local_llm import LocalServerChatModel
 
 
 @pytest.fixture(name="openai_chat_model")
@@ -93,3 +94,27 @@ def test_missing_huggingface_api_key():
     """
     with pytest.raises(ValueError):
         ChatModel(chat_model_vendor_name="huggingface", chat_model_name="BloombergGPT")
+
+
+def test_load_chat_model_local_server(monkeypatch):
+    """
+    Test case to ensure that a local chat model is served by the local inference server when its URL is set.
+    """
+    monkeypatch.setenv("LOCAL_LLM_SERVER_URL", "http://127.0.0.1:8081")
+    monkeypatch.setenv("LOCAL_LLM_MAX_TOKENS", "256")
+    chat_model = ChatModel(chat_model_vendor_name="local", chat_model_name="mistral-7b.gguf").chat_model
+    assert isinstance(chat_model, LocalServerChatModel)
+    assert chat_model.server_url == "http://127.0.0.1:8081"
+    assert chat_model.max_tokens == 256
+
+
+def test_router_backends_keep_streaming(monkeypatch):
+    """
+    Test case to verify that the backends of a streaming router stream, and are not shared with a non-streaming router.
+    """
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    streaming_router = ChatModel(chat_model_vendor_name="router", chat_model_name="openai:gpt-3", streaming=True).chat_model
+    router = ChatModel(chat_model_vendor_name="router", chat_model_name="openai:gpt-3").chat_model
+    assert streaming_router.backends[0].chat_model.streaming
+    assert not router.backends[0].chat_model.streaming
+    assert streaming_router.backends[0].name != router.backends[0].name
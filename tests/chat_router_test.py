@@ -0,0 +1,212 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+
+import pytest
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_community.llms.fake import FakeListLLM
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from chatdoc.chat_model import ChatModel
+from chatdoc.chat_router import ChatModelRouter, LatencyTracker, RouterBackend, get_router_backend
+
+
+class StubChatModel(BaseChatModel):
+    """
+    A chat model that answers with a fixed text after a delay, or fails.
+    """
+
+    answer: str
+    delay: float = 0
+    fail: bool = False
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.delay)
+        if self.fail:
+            raise ConnectionError("backend unavailable")
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer))])
+
+
+def make_backend(name: str, max_concurrency: int = 4, timeout: float = 5, **kwargs: Any) -> RouterBackend:
+    """
+    Make a router backend around a stub chat model.
+    """
+    return RouterBackend(name, StubChatModel(answer=name, **kwargs), max_concurrency=max_concurrency, timeout=timeout)
+
+
+def ask(router: ChatModelRouter) -> str:
+    """
+    Ask the router a question and return the answer.
+    """
+    return str(router.invoke([HumanMessage(content="Hello?")]).content)
+
+
+def test_latency_percentiles():
+    """
+    Test case to verify the latency percentiles.
+    """
+    tracker = LatencyTracker()
+    assert tracker.percentile(0.95) is None
+    for latency in range(1, 101):
+        tracker.record(latency)
+    assert tracker.percentile(0.5) == 50
+    assert tracker.percentile(0.95) == 95
+
+
+def test_router_uses_first_backend():
+    """
+    Test case to verify that the first backend answers when it is healthy.
+    """
+    primary, backup = make_backend("primary"), make_backend("backup")
+    assert ask(ChatModelRouter(backends=[primary, backup])) == "primary"
+    assert primary.stats()["requests"] == 1 and backup.stats()["requests"] == 0
+    assert primary.stats()["samples"] == 1
+
+
+def test_router_falls_back_on_error():
+    """
+    Test case to verify that a failing backend is replaced by the next backend.
+    """
+    primary, backup = make_backend("primary", fail=True), make_backend("backup")
+    assert ask(ChatModelRouter(backends=[primary, backup])) == "backup"
+    assert primary.stats()["errors"] == 1
+
+
+def test_router_falls_back_on_timeout():
+    """
+    Test case to verify that a backend that times out is replaced by the next backend.
+    """
+    primary, backup = make_backend("primary", timeout=0.05, delay=0.5), make_backend("backup")
+    assert ask(ChatModelRouter(backends=[primary, backup])) == "backup"
+    assert primary.stats()["timeouts"] == 1
+
+
+def test_router_skips_backend_without_free_slot():
+    """
+    Test case to verify that a backend whose concurrency slots are taken is skipped.
+    """
+    primary, backup = make_backend("primary", max_concurrency=1), make_backend("backup")
+    assert primary.try_acquire()
+    assert ask(ChatModelRouter(backends=[primary, backup])) == "backup"
+    assert primary.stats()["rejected"] == 1
+
+
+def test_router_hedges_slow_request():
+    """
+    Test case to verify that a request slower than the hedge percentile is also sent to the next backend.
+    """
+    primary, backup = make_backend("primary", delay=0.5), make_backend("backup")
+    for _ in range(5):
+        primary.latencies.record(0.01)
+    router = ChatModelRouter(backends=[primary, backup], min_samples=5, min_hedge_delay=0.05)
+    assert ask(router) == "backup"
+    assert backup.stats()["hedges"] == 1
+
+
+def test_router_raises_when_all_backends_fail():
+    """
+    Test case to verify that an error is raised when all backends fail.
+    """
+    router = ChatModelRouter(backends=[make_backend("primary", fail=True), make_backend("backup", fail=True)])
+    with pytest.raises(RuntimeError, match="All chat model backends failed"):
+        ask(router)
+
+
+def test_load_chat_model_router_invalid_backend():
+    """
+    Test case to ensure that a router backend without a model name raises a ValueError.
+    """
+    with pytest.raises(ValueError):
+        ChatModel(chat_model_vendor_name="router", chat_model_name="openai")
+
+
+class StreamingStubChatModel(StubChatModel):
+    """
+    A stub chat model that streams its answer word by word to the callbacks.
+    """
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        for word in self.answer.split():
+            time.sleep(self.delay)
+            if run_manager:
+                run_manager.on_llm_new_token(word)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer))])
+
+
+class RecordingHandler(BaseCallbackHandler):
+    """
+    Records the chat model runs and tokens it is called back for.
+    """
+
+    def __init__(self) -> None:
+        self.runs: list[str] = []
+        self.tokens: list[str] = []
+
+    def on_chat_model_start(self, serialized, messages, **kwargs: Any) -> None:
+        self.runs.append(serialized["id"][-1])
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.tokens.append(token)
+
+
+def test_router_reports_backend_runs_to_callbacks():
+    """
+    Test case to verify that the backend requests are child runs that the callbacks see, including their tokens.
+    """
+    backend = RouterBackend("primary", StreamingStubChatModel(answer="hello world"), max_concurrency=1, timeout=5)
+    handler = RecordingHandler()
+    ChatModelRouter(backends=[backend]).invoke([HumanMessage(content="Hello?")], config={"callbacks": [handler]})
+    assert handler.runs == ["ChatModelRouter", "StreamingStubChatModel"]
+    assert handler.tokens == ["hello", "world"]
+
+
+def test_router_streams_tokens_of_one_backend():
+    """
+    Test case to verify that only the backend that streams first streams the answer of a hedged request.
+    """
+    primary = RouterBackend("primary", StreamingStubChatModel(answer="one two three", delay=0.2), max_concurrency=1, timeout=5)
+    backup = RouterBackend("backup", StreamingStubChatModel(answer="four five six", delay=0.01), max_concurrency=1, timeout=5)
+    for _ in range(5):
+        primary.latencies.record(0.01)
+    handler = RecordingHandler()
+    router = ChatModelRouter(backends=[primary, backup], min_samples=5, min_hedge_delay=0.05)
+    answer = router.invoke([HumanMessage(content="Hello?")], config={"callbacks": [handler]}).content
+    assert answer == "four five six"
+    assert handler.tokens == ["four", "five", "six"]
+    assert backup.stats()["hedges"] == 1
+
+
+def test_router_waits_for_free_slot():
+    """
+    Test case to verify that a request waits for a slot when all backends are busy.
+    """
+    backend = make_backend("primary", max_concurrency=1, delay=0.1)
+    router = ChatModelRouter(backends=[backend], queue_timeout=5)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        answers = list(executor.map(lambda _: ask(router), range(2)))
+    assert answers == ["primary", "primary"]
+    assert backend.stats()["requests"] == 2
+
+
+def test_router_rejects_when_no_slot_frees():
+    """
+    Test case to verify that a request fails when no slot frees within the queue timeout.
+    """
+    backend = make_backend("primary", max_concurrency=1)
+    assert backend.try_acquire()
+    with pytest.raises(RuntimeError, match="no free slot"):
+        ask(ChatModelRouter(backends=[backend], queue_timeout=0.05))
+
+
+def test_router_backend_must_be_chat_model():
+    """
+    Test case to ensure that a backend that is not a chat model raises a ValueError.
+    """
+    with pytest.raises(ValueError, match="not a chat model"):
+        get_router_backend("local:model.gguf", lambda: FakeListLLM(responses=["answer"]))
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+from typing import Any
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from server_modules.admission import AdmissionController
+from server_modules.chat_socket import ChatSocketServer, to_chat_message
+
+
+class StubChatbot:
+    """
+    A chatbot that streams a fixed answer token by token.
+    """
+
+    async def asend_prompt(self, prompt: str, callbacks: list[Any] | None = None) -> dict[str, Any]:
+        for token in ["Hello", " there"]:
+            for callback in callbacks or []:
+                callback.on_llm_new_token(token)
+        return {"answer": "Hello there", "citations": [{"source": "report.pdf"}]}
+
+
+@pytest.fixture(name="chat_socket")
+def chat_socket_fixture(monkeypatch):
+    """
+    A chat socket server whose emitted events are recorded instead of sent.
+    """
+    monkeypatch.setenv("ADMISSION_ENABLED", "false")
+    chat_socket = ChatSocketServer(AdmissionController(), logging.getLogger("test"), lambda session_id: StubChatbot())
+    chat_socket.emitted = []
+
+    async def emit(event: str, data: Any, **kwargs: Any) -> None:
+        chat_socket.emitted.append((event, data, kwargs))
+
+    async def get_session(sid: str) -> dict[str, str]:
+        return {"session_id": "session-a"}
+
+    monkeypatch.setattr(chat_socket.server, "emit", emit)
+    monkeypatch.setattr(chat_socket.server, "get_session", get_session)
+    yield chat_socket
+
+
+def test_to_chat_message():
+    """
+    Test case to verify that stored messages are converted into chat client messages.
+    """
+    assert to_chat_message(HumanMessage(content="Hi"))["author"] == "user"
+    message = to_chat_message(AIMessage(content="Hello", additional_kwargs={"citations": [{"source": "a.pdf"}]}))
+    assert message["author"] == "assistant" and message["citations"] == [{"source": "a.pdf"}]
+
+
+def test_chat_send_streams_answer_to_session_room(chat_socket):
+    """
+    Test case to verify that the answer is streamed as tokens to the room of the session before the full message.
+    """
+    asyncio.run(chat_socket.chat_send("sid-1", {"author": "user", "content": "Hi DoRA", "attachments": []}))
+    events = [(event, data["content"]) for event, data, _ in chat_socket.emitted]
+    assert events == [
+        ("chat_recieve", "Hi DoRA"),
+        ("chat_recieve", "INTERNAL_TYPING"),
+        ("chat_token", "Hello"),
+        ("chat_token", " there"),
+        ("chat_recieve", "Hello there"),
+    ]
+    assert chat_socket.emitted[0][2] == {"room": "session-a", "skip_sid": "sid-1"}
+    assert all(kwargs.get("room") == "session-a" for _, _, kwargs in chat_socket.emitted)
+    assert chat_socket.emitted[-1][1]["citations"] == [{"source": "report.pdf"}]
+
+
+def test_chat_send_rejects_empty_message(chat_socket):
+    """
+    Test case to verify that an empty message is answered with an error for the sender only.
+    """
+    asyncio.run(chat_socket.chat_send("sid-1", {"author": "user", "content": "  "}))
+    assert chat_socket.emitted == [("chat_error", {"error": "Empty message"}, {"to": "sid-1"})]
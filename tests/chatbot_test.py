@@ -0,0 +1,84 @@
+"""
+Tests for the Chatbot class with the fake models
+"""
+import asyncio
+import threading
+
+import pytest
+from langchain.schema import Document
+
+from chatdoc.chatbot import Chatbot
+
+
+@pytest.fixture
+def fake_environment(monkeypatch, tmp_path):
+    """
+    The settings of a chatbot with the fake models, a Chroma database and a chat history in tmp_path.
+    """
+    monkeypatch.setenv("CURRENT_ENV", "DEV")
+    monkeypatch.setenv("CHROMA_PATH", str(tmp_path / "chroma"))
+    monkeypatch.setenv("CHAT_HISTORY_CONNECTION_STRING", f"sqlite:///{tmp_path / 'chat_history.db'}")
+    for kind in ("EMBEDDING", "CHAT"):
+        monkeypatch.setenv(f"{kind}_MODEL_VENDOR_NAME", "fake")
+        monkeypatch.setenv(f"{kind}_MODEL_NAME", "fake")
+    monkeypatch.setenv("COALESCE_ENABLED", "true")
+    monkeypatch.setattr(Chatbot, "single_flight", type(Chatbot.single_flight)())
+
+
+def create_chatbot(session_id: str, texts: list[str]) -> Chatbot:
+    chatbot = Chatbot(session_id)
+    asyncio.run(chatbot.vector_db.add_documents([Document(page_content=text, metadata={"source": "doc.docx"}) for text in texts]))
+    return chatbot
+
+
+def test_sessions_with_the_same_documents_coalesce(fake_environment):
+    """
+    Test case to verify that the same first prompt in two sessions that uploaded the same documents is answered once.
+    """
+    texts = ["The library opens at nine.", "Books are lent for three weeks."]
+    chatbots = [create_chatbot("session-a", texts), create_chatbot("session-b", list(reversed(texts)))]
+    assert chatbots[0].vector_db.content_fingerprint == chatbots[1].vector_db.content_fingerprint
+    results = []
+    threads = [
+        threading.Thread(target=lambda chatbot=chatbot: results.append(chatbot.send_prompt("When does the library open?")))
+        for chatbot in chatbots
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 2
+    assert Chatbot.single_flight.stats == {"leaders": 1, "coalesced": 1}
+    assert results[0]["answer"] == results[1]["answer"]
+
+
+def test_sessions_with_other_documents_do_not_coalesce(fake_environment):
+    """
+    Test case to verify that the same first prompt in sessions with different documents is answered per session.
+    """
+    chatbots = [
+        create_chatbot("session-c", ["The library opens at nine."]),
+        create_chatbot("session-d", ["The library opens at ten."]),
+    ]
+    assert chatbots[0].vector_db.content_fingerprint != chatbots[1].vector_db.content_fingerprint
+    results = []
+    threads = [
+        threading.Thread(target=lambda chatbot=chatbot: results.append(chatbot.send_prompt("When does the library open?")))
+        for chatbot in chatbots
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 2
+    assert Chatbot.single_flight.stats == {"leaders": 2, "coalesced": 0}
+
+
+def test_async_prompt_is_answered_with_packed_context(fake_environment):
+    """
+    Test case to verify that the async path packs the context and answers the prompt.
+    """
+    chatbot = create_chatbot("session-e", ["The library opens at nine."])
+    result = asyncio.run(chatbot.asend_prompt("When does the library open?"))
+    assert result["answer"]
+    assert result["citations"]["citations"][0]["source"] == "doc.docx"
@@ -1,5 +1,7 @@
 import pytest  # pylint: disable=unused-import
-from chatdoc.citation import BaseCitation, ProofCitation
+from langchain_core.documents import Document
+
+from chatdoc.citation import BaseCitation, Citations, ProofCitation, find_proof_spans
 
 
 def test_base_citation():
@@ -26,3 +28,65 @@ def test_proof_citation():
     assert proof_citation.page == 1
     # Assuming ProofCitation implements format_citation_text method
     assert proof_citation.format_citation_text() == " - Source on page 1; PROOF: Just because"
+
+
+def test_citation_page_range_and_section():
+    """
+    Test case for a citation that spans multiple pages within a section.
+
+    This test verifies that the page range and section are included in the formatted citation text.
+    """
+    base_citation = BaseCitation("Source", 12, 1, -1, page_end=13, section="§3.2")
+    assert base_citation.format_citation_text() == " - Source on pages 12–13, §3.2"
+    assert base_citation.__dict__()["page_end"] == 13
+
+
+def make_chunk(text: str, page: int, ranking: int, score: float, **metadata) -> Document:
+    return Document(
+        page_content=text,
+        metadata={"source": "/tmp/report.pdf", "page": page, "ranking": ranking, "score": score, **metadata},
+    )
+
+
+def test_proof_spans_match_the_answer():
+    """
+    Test case for extracting the sentences of a chunk that share words with the answer.
+
+    This test verifies that only matching sentences are returned, with their offsets in the chunk.
+    """
+    text = "The weather was fine. Costs rose to 2.4 million euros!\nNothing else happened."
+    spans = find_proof_spans(text, {"costs", "million", "euros"}, ranking=3)
+    assert [span.text for span in spans] == ["Costs rose to 2.4 million euros!"]
+    assert text[spans[0].start:spans[0].end] == spans[0].text
+    assert spans[0].ranking == 3 and spans[0].score > 0
+
+
+def test_citations_merge_chunks_of_a_page():
+    """
+    Test case for merging the chunks of the same source and page into one citation.
+
+    This test verifies that the merged citation keeps the best ranking and score, cites the best
+    matching sentences instead of the whole chunks, and that citations are ordered by ranking.
+    """
+    chunks = [
+        make_chunk("Introduction. The pilot reduced processing times by a third.", 0, 1, 0.9),
+        make_chunk("Other findings. Complaints dropped from 420 to 310.", 4, 2, 0.8),
+        make_chunk("The pilot ran for a year. Processing times were measured weekly.", 0, 3, 0.95, page_end=1),
+    ]
+    citations = Citations(chunks, answer="The pilot reduced processing times by a third.", max_spans=2)
+    first, second = citations.citations
+    assert (first.page, first.page_end, first.ranking, first.score) == (1, 2, 1, 0.95)
+    assert [span.ranking for span in first.spans] == [1, 3]
+    assert first.proof == "The pilot reduced processing times by a third. … Processing times were measured weekly."
+    assert second.page == 5 and second.proof == "Other findings."
+    assert citations.__dict__()["citations"][0]["spans"][0]["start"] == len("Introduction. ")
+
+
+def test_citations_without_proof():
+    """
+    Test case for citations without proof, which are merged but carry no sentences.
+    """
+    chunks = [make_chunk("A.", 0, 1, 0.5), make_chunk("B.", 0, 2, 0.6)]
+    citations = Citations(chunks, with_proof=False)
+    assert len(citations.citations) == 1
+    assert "proof" not in citations.__dict__()["citations"][0]
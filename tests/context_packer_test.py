@@ -0,0 +1,78 @@
+from langchain.schema.document import Document
+from langchain_community.chat_models.fake import FakeListChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.prompts import PromptTemplate
+
+from chatdoc.context_packer import DEFAULT_TOKEN_BUDGET, ContextPacker
+from chatdoc.local_llm import LocalServerChatModel
+
+
+def make_document(text: str, ranking: int) -> Document:
+    """
+    Create a retrieved chunk with the given ranking.
+    """
+    return Document(page_content=text, metadata={"ranking": ranking})
+
+
+def test_documents_are_taken_by_rank_within_budget():
+    """
+    Test that chunks are taken in order of ranking until the budget is used up.
+    """
+    packer = ContextPacker(FakeListChatModel(responses=[""]), token_budget=60, history_ratio=0)
+    documents = [make_document("b " * 80, 2), make_document("a " * 80, 1), make_document("c " * 40, 3)]
+    packed_context = packer.pack("Vraag?", documents, [])
+    assert [document.metadata["ranking"] for document in packed_context.documents] == [1]
+    assert packed_context.token_usage["dropped_over_budget_documents"] == 2
+    assert packed_context.token_usage["total"] <= 60
+
+
+def test_redundant_documents_are_dropped():
+    """
+    Test that a chunk that is a near-duplicate of a higher-ranked chunk is dropped.
+    """
+    packer = ContextPacker(FakeListChatModel(responses=[""]), token_budget=1000)
+    text = "Medewerkers hebben recht op vijfentwintig vakantiedagen per jaar bij een volledig dienstverband."
+    packed_context = packer.pack("Vraag?", [make_document(text, 1), make_document(text, 2)], [])
+    assert len(packed_context.documents) == 1
+    assert packed_context.token_usage["dropped_redundant_documents"] == 1
+
+
+def test_newest_history_is_kept_and_oldest_trimmed():
+    """
+    Test that the newest messages are kept and the oldest message that does not fit is trimmed.
+    """
+    packer = ContextPacker(FakeListChatModel(responses=[""]), token_budget=1000, history_ratio=0.1)
+    chat_history = [HumanMessage(content="x" * 800), AIMessage(content="kort antwoord")]
+    packed_context = packer.pack("Vraag?", [], chat_history)
+    assert packed_context.chat_history[-1].content == "kort antwoord"
+    assert packed_context.chat_history[0].content.startswith("…")
+    assert packed_context.token_usage["chat_history"] <= 100
+
+
+def test_budget_is_derived_from_local_model_settings(monkeypatch):
+    """
+    Test that the budget of a local chat model is its context size minus the tokens it may generate.
+    """
+    monkeypatch.delenv("CONTEXT_TOKEN_BUDGET", raising=False)
+    monkeypatch.setenv("LOCAL_LLM_N_CTX", "4096")
+    chat_model = LocalServerChatModel(server_url="http://127.0.0.1:8081", max_tokens=256)
+    assert ContextPacker(chat_model).token_budget == 4096 - 256
+    assert ContextPacker(FakeListChatModel(responses=[""])).token_budget == DEFAULT_TOKEN_BUDGET
+
+
+def test_template_tokens_are_taken_off_the_budget():
+    """
+    Test that the tokens of the rendered prompt template count towards the budget.
+    """
+    template = PromptTemplate.from_template("Context:\n{context}\n\nQuestion: {question}\nAnswer:")
+    text = "Medewerkers hebben recht op vijfentwintig vakantiedagen per jaar."
+    packer = ContextPacker(FakeListChatModel(responses=[""]), token_budget=40, history_ratio=0)
+    template_packer = ContextPacker(
+        FakeListChatModel(responses=[""]), token_budget=40, history_ratio=0, prompt_template=template
+    )
+    documents = [make_document(text, 1), make_document(text.replace("vijfentwintig", "dertig"), 2)]
+    packed_context = template_packer.pack("Vraag?", documents, [])
+    assert template_packer.template_tokens > 0
+    assert packed_context.token_usage["template"] == template_packer.template_tokens
+    assert packed_context.token_usage["total"] <= 40
+    assert len(packed_context.documents) < len(packer.pack("Vraag?", documents, []).documents)
@@ -0,0 +1,36 @@
+from langchain.schema.document import Document
+
+from chatdoc.doc_loader.dedup import MinHashDeduplicator
+
+DISCLAIMER = (
+    "Aan deze tekst kunnen geen rechten worden ontleend. Raadpleeg altijd de meest recente versie "
+    "van het beleid op het intranet voordat u een besluit neemt over verlof of thuiswerken."
+)
+
+
+def test_near_duplicates_are_removed_and_merged():
+    """
+    Test that repeated boilerplate is removed and counted on the chunk that is kept.
+    """
+    documents = [
+        Document(page_content=f"{DISCLAIMER} Pagina 1", metadata={"page": 0}),
+        Document(page_content="Medewerkers hebben recht op vijfentwintig vakantiedagen per jaar.", metadata={"page": 0}),
+        Document(page_content=f"{DISCLAIMER} Pagina 2", metadata={"page": 1}),
+    ]
+    kept_documents, removed = MinHashDeduplicator().deduplicate(documents)
+    assert removed == 1
+    assert len(kept_documents) == 2
+    assert kept_documents[0].metadata["duplicate_count"] == 1
+
+
+def test_files_are_deduplicated_separately():
+    """
+    Test that a chunk repeated in another file is kept there, since every file has its own deduplicator.
+    """
+    first_file, _ = MinHashDeduplicator().deduplicate([Document(page_content=DISCLAIMER)])
+    second_file, removed = MinHashDeduplicator().deduplicate(
+        [Document(page_content=f"{DISCLAIMER} Pagina 1"), Document(page_content=f"{DISCLAIMER} Pagina 2")]
+    )
+    assert len(first_file) == 1
+    assert removed == 1 and len(second_file) == 1
+    assert "minhash" not in second_file[0].metadata
@@ -1,12 +1,13 @@
 from itertools import chain
 from pathlib import Path
 from unittest.mock import MagicMock
+from langchain.document_loaders.base import BaseLoader
 from langchain.schema.document import Document
 
 import pytest
 
 from chatdoc.doc_loader.document_loader import DocumentLoader
-from chatdoc.doc_loader.document_loader_factory import DocumentLoaderFactory, BaseLoader
+from chatdoc.doc_loader.document_loader_factory import DocumentLoaderFactory
 
 
 @pytest.fixture(name="mock_loader_factory")
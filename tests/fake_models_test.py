@@ -0,0 +1,65 @@
+"""
+Tests for the fake models and the load-test driver
+"""
+import asyncio
+import io
+import zipfile
+
+from langchain_core.messages import HumanMessage
+
+from chatdoc.fake_models import FakeChatModel, FakeEmbeddings
+from loadtest.driver import LoadTestDriver, RouteStats, format_report, make_docx
+
+
+def test_fake_embeddings_are_similar_for_shared_words():
+    """
+    Texts that share words are closer than texts that do not.
+    """
+    embeddings = FakeEmbeddings(size=64, latency=0)
+    query = embeddings.embed_query("costs of the measures")
+    related, unrelated = embeddings.embed_documents(["the measures cost a lot", "weather forecast"])
+
+    def similarity(a: list[float], b: list[float]) -> float:
+        return sum(x * y for x, y in zip(a, b))
+
+    assert len(query) == 64
+    assert similarity(query, related) > similarity(query, unrelated)
+    assert asyncio.run(embeddings.aembed_query("costs of the measures")) == query
+
+
+def test_fake_chat_model_streams_tokens_with_usage():
+    """
+    The answer is streamed token by token and its token usage is reported.
+    """
+    chat_model = FakeChatModel(latency=0, tokens_per_second=10_000, answer_tokens=5)
+    chunks = list(chat_model.stream([HumanMessage(content="What does the report conclude?")]))
+    assert len(chunks) == 5
+    result = chat_model.generate([[HumanMessage(content="What does the report conclude?")]])
+    assert result.llm_output == {"token_usage": {"prompt_tokens": 8, "completion_tokens": 5}}
+    assert result.generations[0][0].text == "".join(chunk.content for chunk in chunks)
+
+
+def test_make_docx():
+    """
+    The generated Word document contains the paragraphs.
+    """
+    with zipfile.ZipFile(io.BytesIO(make_docx(["First paragraph.", "Second paragraph."]))) as docx:
+        document = docx.read("word/document.xml").decode("utf-8")
+    assert "First paragraph." in document and "Second paragraph." in document
+
+
+def test_report():
+    """
+    The report holds the throughput and latency percentiles per route.
+    """
+    driver = LoadTestDriver("http://localhost:8000/", sessions=2, concurrency=1)
+    stats = driver.stats.setdefault("/prompt", RouteStats())
+    for latency in (0.1, 0.2, 0.3, 0.4):
+        stats.latencies.record(latency)
+    stats.errors = 1
+    report = driver.report(duration=2.0)
+    assert driver.url == "http://localhost:8000"
+    assert report["routes"]["/prompt"]["requests"] == 5
+    assert report["routes"]["/prompt"]["throughput"] == 2.5
+    assert report["routes"]["/prompt"]["max"] == 0.4
+    assert "/prompt" in format_report(report)
@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from chatdoc.local_llm import SessionStateCache, common_prefix_length
+
+
+def make_state(tokens: list[int], size: int = 10) -> SimpleNamespace:
+    """
+    Make a stand-in for a llama.cpp state with the given evaluated tokens.
+    """
+    return SimpleNamespace(input_ids=tokens + [0] * 4, n_tokens=len(tokens), llama_state_size=size)
+
+
+class FakeLlama:
+    """
+    A stand-in for a llama.cpp model that records the loaded states.
+    """
+
+    def __init__(self, tokens: list[int]):
+        self.input_ids = tokens
+        self.n_tokens = len(tokens)
+        self.loaded_states: list[SimpleNamespace] = []
+
+    def load_state(self, state: SimpleNamespace) -> None:
+        self.input_ids = state.input_ids
+        self.n_tokens = state.n_tokens
+        self.loaded_states.append(state)
+
+
+def test_common_prefix_length():
+    """
+    Test case to verify that the common prefix of two token sequences is counted.
+    """
+    assert common_prefix_length([1, 2, 3, 4], [1, 2, 5]) == 2
+    assert common_prefix_length([], [1]) == 0
+
+
+def test_restore_loads_state_of_session():
+    """
+    Test case to verify that the state of the session is loaded for its follow-up prompt.
+    """
+    cache = SessionStateCache(max_sessions=4, max_bytes=100)
+    session_state = make_state([1, 2, 3, 4, 5])
+    cache.store("session-a", session_state)
+    cache.store("session-b", make_state([7, 8, 9]))
+    llm = FakeLlama([7, 8, 9])
+    reused_tokens = cache.restore(llm, "session-a", [1, 2, 3, 4, 5, 6, 7])
+    assert reused_tokens == 5
+    assert llm.loaded_states == [session_state]
+    assert cache.stats["hits"] == 1 and cache.stats["evaluated_tokens"] == 2
+
+
+def test_restore_keeps_current_state_with_longer_prefix():
+    """
+    Test case to verify that no state is loaded when the model already shares a longer prefix.
+    """
+    cache = SessionStateCache(max_sessions=4, max_bytes=100)
+    cache.store("session-a", make_state([1, 2]))
+    llm = FakeLlama([1, 2, 3])
+    assert cache.restore(llm, "session-a", [1, 2, 3, 4]) == 3
+    assert not llm.loaded_states
+
+
+def test_restore_shares_prompt_prefix_across_sessions():
+    """
+    Test case to verify that a new session reuses the state of another session with the same prompt prefix.
+    """
+    cache = SessionStateCache(max_sessions=4, max_bytes=100)
+    cache.store("session-a", make_state([1, 2, 3, 9]))
+    llm = FakeLlama([])
+    assert cache.restore(llm, "session-b", [1, 2, 3, 4]) == 3
+
+
+def test_store_evicts_least_recently_used():
+    """
+    Test case to verify that states are evicted by number of sessions and by total size.
+    """
+    cache = SessionStateCache(max_sessions=2, max_bytes=25)
+    cache.store("session-a", make_state([1]))
+    cache.store("session-b", make_state([2]))
+    cache.restore(FakeLlama([]), "session-a", [1])
+    cache.store("session-c", make_state([3]))
+    assert cache.find("session-b", [2]) == (None, 0)
+    assert cache.find("session-a", [1])[1] == 1
+    cache.store("session-d", make_state([4], size=20))
+    assert len(cache) == 1 and cache.size == 20
+
+
+def test_size_counts_tokens_and_last_scores():
+    """
+    Test case to verify that the scores of a state are trimmed to their last row, and that the copies of the
+    tokens and that row count towards the size limit.
+    """
+    cache = SessionStateCache(max_sessions=4, max_bytes=500)
+    state = SimpleNamespace(
+        input_ids=np.array([1, 2], dtype=np.intc),
+        n_tokens=2,
+        llama_state_size=10,
+        scores=np.zeros((4, 200), dtype=np.single),
+    )
+    cache.store("session-a", state)
+    assert len(cache) == 0
+    state.scores = np.arange(200, dtype=np.single).reshape(2, 100)
+    cache.store("session-a", state)
+    assert state.scores.shape == (1, 100) and state.scores[0, 0] == 100
+    assert cache.size == 10 + 2 * 4 + 100 * 4
@@ -0,0 +1,70 @@
+"""
+Tests for the Prometheus metrics of the prompt and ingestion pipelines
+"""
+from uuid import uuid4
+
+import pytest
+from langchain_community.embeddings.fake import FakeEmbeddings
+from langchain_core.outputs import LLMResult
+from prometheus_client import REGISTRY
+
+from chatdoc.metrics import InstrumentedEmbeddings, generate_metrics, record_cache_lookup, stage_timer, token_usage_handler
+
+
+def sample(name: str, **labels: str) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_stage_timer_counts_errors():
+    """
+    A stage is timed also when it raises, and counted as an error.
+    """
+    count = sample("dora_stage_duration_seconds_count", operation="prompt", stage="test")
+    errors = sample("dora_stage_errors_total", operation="prompt", stage="test")
+    with stage_timer("prompt", "test"):
+        pass
+    with pytest.raises(ValueError):
+        with stage_timer("prompt", "test"):
+            raise ValueError("failed")
+    assert sample("dora_stage_duration_seconds_count", operation="prompt", stage="test") == count + 2
+    assert sample("dora_stage_errors_total", operation="prompt", stage="test") == errors + 1
+
+
+def test_instrumented_embeddings():
+    """
+    The embedding calls are timed as the embed stage and their total duration is kept.
+    """
+    count = sample("dora_stage_duration_seconds_count", operation="ingest", stage="embed")
+    embeddings = InstrumentedEmbeddings(FakeEmbeddings(size=4), "ingest")
+    assert len(embeddings.embed_documents(["a", "b"])) == 2
+    assert len(embeddings.embed_query("a")) == 4
+    assert sample("dora_stage_duration_seconds_count", operation="ingest", stage="embed") == count + 2
+    assert embeddings.seconds > 0
+
+
+def test_token_usage_handler():
+    """
+    Vendor token counts are used when reported, streamed tokens otherwise.
+    """
+    prompt_tokens = sample("dora_llm_tokens_total", kind="prompt")
+    completion_tokens = sample("dora_llm_tokens_total", kind="completion")
+    token_usage_handler.on_llm_end(
+        LLMResult(generations=[], llm_output={"token_usage": {"prompt_tokens": 10, "completion_tokens": 3}}),
+        run_id=uuid4(),
+    )
+    run_id = uuid4()
+    for token in ["Hel", "lo"]:
+        token_usage_handler.on_llm_new_token(token, run_id=run_id)
+    token_usage_handler.on_llm_end(LLMResult(generations=[]), run_id=run_id)
+    assert sample("dora_llm_tokens_total", kind="prompt") == prompt_tokens + 10
+    assert sample("dora_llm_tokens_total", kind="completion") == completion_tokens + 5
+
+
+def test_generate_metrics():
+    """
+    The metrics are rendered in the Prometheus text format.
+    """
+    record_cache_lookup("condense", True)
+    body, content_type = generate_metrics()
+    assert content_type.startswith("text/plain")
+    assert b'dora_cache_lookups_total{cache="condense",result="hit"}' in body
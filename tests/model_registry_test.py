@@ -0,0 +1,68 @@
+"""
+Tests for the model registry
+"""
+import threading
+import time
+
+import pytest
+
+from chatdoc.chat_model import ChatModel
+from chatdoc.embed.embedding_factory import EmbeddingFactory
+from chatdoc.model_registry import clear_models, get_model
+
+
+@pytest.fixture(autouse=True)
+def empty_registry():
+    """
+    Every test starts and ends with an empty registry.
+    """
+    clear_models()
+    yield
+    clear_models()
+
+
+def test_model_is_built_once():
+    """
+    Concurrent first uses of a key share one build, and later uses get the same model.
+    """
+    builds = []
+
+    def build() -> object:
+        builds.append(1)
+        time.sleep(0.1)
+        return object()
+
+    models = []
+    threads = [threading.Thread(target=lambda: models.append(get_model("key", build))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(builds) == 1
+    assert all(model is models[0] for model in models)
+    assert get_model("key", build) is models[0]
+
+
+def test_failed_build_is_not_kept():
+    """
+    A build that fails is retried on the next use.
+    """
+
+    def fail() -> object:
+        raise RuntimeError("no model")
+
+    with pytest.raises(RuntimeError):
+        get_model("key", fail)
+    assert get_model("key", lambda: "model") == "model"
+
+
+def test_factories_reuse_models():
+    """
+    The embedding factory and chat model reuse the models built with the same settings, e.g. by the pre-warm step.
+    """
+    embedding = EmbeddingFactory("fake", "fake-embedding").create()
+    assert EmbeddingFactory("fake", "fake-embedding").create() is embedding
+    assert EmbeddingFactory("fake", "other-embedding").create() is not embedding
+    chat_model = ChatModel("fake", "fake-chat").chat_model
+    assert ChatModel("fake", "fake-chat").chat_model is chat_model
+    assert ChatModel("fake", "fake-chat", streaming=True).chat_model is not chat_model
@@ -0,0 +1,118 @@
+import time
+from logging import Logger
+
+import pytest
+from langchain.schema.document import Document
+
+from chatdoc.doc_loader.ocr import OCRCache, OCRStage
+
+
+def fake_ocr(images: list[bytes], language: str, timeout: float) -> str:
+    """
+    Recognises the images as their own bytes, or hangs on a page whose image is b"hang".
+    """
+    if images == [b"hang"]:
+        time.sleep(60)
+    return b" ".join(images).decode()
+
+
+class FakeImage:
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+
+class FakePage:
+    def __init__(self, data: bytes | None) -> None:
+        self._data = data
+
+    @property
+    def images(self) -> list[FakeImage]:
+        if self._data is None:
+            raise ValueError("cannot decode image")
+        return [FakeImage(self._data)]
+
+
+class FakePdfReader:
+    pages_data: list[bytes | None] = []
+
+    def __init__(self, _source) -> None:
+        self.pages = [FakePage(data) for data in self.pages_data]
+
+
+@pytest.fixture(name="ocr_stage")
+def fixture_ocr_stage():
+    """
+    Returns an OCR stage that logs to a dummy logger.
+
+    Returns:
+        OCRStage: The OCR stage.
+    """
+    return OCRStage(Logger("test"))
+
+
+def test_needs_ocr(ocr_stage):
+    """
+    Test that only pages with (almost) no text are selected for OCR.
+    """
+    assert ocr_stage.needs_ocr(Document(page_content="  \n ", metadata={"page": 0}))
+    assert not ocr_stage.needs_ocr(Document(page_content="A page with plenty of extracted text.", metadata={"page": 0}))
+
+
+def test_pages_with_text_pass_through(ocr_stage):
+    """
+    Test that documents with text are yielded unchanged without opening the PDF.
+    """
+    pages = [Document(page_content="A page with plenty of extracted text.", metadata={"page": 0})]
+    assert list(ocr_stage.process(pages, "/path/to/missing.pdf", "missing.pdf")) == pages
+
+
+def test_ocr_cache_evicts_least_recently_used():
+    """
+    Test that the OCR cache evicts the least recently used entry.
+    """
+    cache = OCRCache(max_entries=2)
+    cache.put("a", "text a")
+    cache.put("b", "text b")
+    assert cache.get("a") == "text a"
+    cache.put("c", "text c")
+    assert cache.get("b") is None
+    assert cache.get("a") == "text a"
+
+
+@pytest.fixture(name="fake_pdf_stage")
+def fixture_fake_pdf_stage(monkeypatch):
+    """
+    Returns an OCR stage with a fake OCR engine, reading a fake PDF, and its own process pool.
+    """
+    monkeypatch.setattr("pypdf.PdfReader", FakePdfReader)
+    for attribute in ("_executor", "_in_flight", "_cache"):
+        monkeypatch.setattr(OCRStage, attribute, None)
+    stage = OCRStage(Logger("test"))
+    stage.ocr_function = fake_ocr
+    yield stage
+    if OCRStage._executor is not None:
+        OCRStage._recycle_executor(OCRStage._executor)
+
+
+def test_unreadable_images_skip_the_page(fake_pdf_stage, monkeypatch):
+    """
+    Test that a page whose images cannot be decoded is skipped instead of failing the document.
+    """
+    monkeypatch.setattr(FakePdfReader, "pages_data", [None, b"scanned"])
+    pages = [Document(page_content="", metadata={"page": number}) for number in range(2)]
+    texts = [page.page_content for page in fake_pdf_stage.process(pages, "scan.pdf", "scan.pdf")]
+    assert texts == ["", "scanned"]
+
+
+def test_page_past_its_deadline_recycles_the_pool(fake_pdf_stage, monkeypatch):
+    """
+    Test that a hanging page times out on its own deadline, and that its process is terminated
+    while the other pages are still recognised.
+    """
+    monkeypatch.setattr(FakePdfReader, "pages_data", [b"hang", b"first", b"second", b"third"])
+    fake_pdf_stage.page_timeout = 1
+    pages = [Document(page_content="", metadata={"page": number}) for number in range(4)]
+    started_at = time.monotonic()
+    texts = [page.page_content for page in fake_pdf_stage.process(pages, "scan.pdf", "scan.pdf")]
+    assert texts == ["", "first", "second", "third"]
+    assert time.monotonic() - started_at < 10
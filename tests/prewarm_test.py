@@ -0,0 +1,31 @@
+"""
+Tests for the pre-warm step
+"""
+from chatdoc.prewarm import prewarm, warm_up
+
+
+def test_warm_up_runs_every_stage():
+    """
+    Every stage runs, and the duration of every stage that succeeded is returned.
+    """
+    calls = []
+
+    def failing_stage():
+        calls.append("failing")
+        raise RuntimeError("no model")
+
+    durations = warm_up({"first": lambda: calls.append("first"), "failing": failing_stage, "last": lambda: calls.append("last")})
+    assert calls == ["first", "failing", "last"]
+    assert set(durations) == {"first", "last"}
+    assert all(duration >= 0 for duration in durations.values())
+
+
+def test_prewarm_runs_in_background():
+    """
+    The stages run in a daemon thread.
+    """
+    calls = []
+    thread = prewarm({"stage": lambda: calls.append("stage")})
+    thread.join(timeout=5)
+    assert thread.daemon
+    assert calls == ["stage"]
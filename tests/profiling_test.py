@@ -0,0 +1,100 @@
+"""
+Tests for the on-demand sampling profiler
+"""
+import threading
+import time
+
+import pytest
+
+from chatdoc.profiling import Profiler
+
+
+def busy_function(seconds: float) -> list[int]:
+    allocated = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        allocated.append(len(allocated))
+    return allocated
+
+
+def test_disabled_profiler_cannot_be_armed(tmp_path):
+    """
+    A disabled profiler refuses to be armed and never profiles.
+    """
+    profiler = Profiler(enabled=False, directory=tmp_path)
+    with pytest.raises(ValueError):
+        profiler.arm_route("/prompt")
+    assert profiler.start_request("/prompt") is None
+    with profiler.profile_job("session"):
+        pass
+    assert not list(tmp_path.iterdir())
+
+
+def test_route_is_profiled_for_the_armed_number_of_requests(tmp_path):
+    """
+    The next `count` requests of an armed route are written as collapsed stacks.
+    """
+    profiler = Profiler(enabled=True, directory=tmp_path, interval=0.001)
+    profiler.arm_route("/prompt", count=2)
+    assert profiler.start_request("/upload_files") is None
+    for _ in range(2):
+        profile = profiler.start_request("/prompt")
+        assert profile is not None
+        busy_function(0.05)
+        profiler.finish(profile)
+    assert profiler.start_request("/prompt") is None
+    assert profiler.status()["routes"] == {}
+    stacks_files = sorted(tmp_path.glob("*.collapsed"))
+    assert len(stacks_files) == 2
+    stacks = stacks_files[0].read_text(encoding="utf-8")
+    assert "busy_function (profiling_test.py:" in stacks
+    stack, count = stacks.splitlines()[0].rsplit(" ", 1)
+    assert int(count) > 0 and ";" in stack
+
+
+def test_job_is_profiled_with_allocations(tmp_path):
+    """
+    The next job of an armed session is profiled once, with its allocations.
+    """
+    profiler = Profiler(enabled=True, directory=tmp_path, interval=0.001)
+    profiler.arm_job("session")
+    with profiler.profile_job("session", "upload"):
+        busy_function(0.05)
+    with profiler.profile_job("session", "other-upload"):
+        pass
+    assert len(list(tmp_path.glob("*-ingest-upload.collapsed"))) == 1
+    allocations = next(tmp_path.glob("*-ingest-upload.allocations.txt")).read_text(encoding="utf-8")
+    assert allocations.startswith("peak traced memory:")
+    assert "profiling_test.py" in allocations
+    assert not list(tmp_path.glob("*other-upload*"))
+
+
+def test_admin_token_is_required(tmp_path):
+    """
+    Only the admin token is accepted, and no token at all without an admin token.
+    """
+    assert Profiler(enabled=True, directory=tmp_path, admin_token="secret").is_admin("secret")
+    assert not Profiler(enabled=True, directory=tmp_path, admin_token="secret").is_admin("guess")
+    assert not Profiler(enabled=True, directory=tmp_path, admin_token="secret").is_admin(None)
+    assert not Profiler(enabled=True, directory=tmp_path, admin_token="").is_admin("")
+
+
+def test_profile_follows_the_thread_of_an_async_view(tmp_path):
+    """
+    A profile samples the thread it follows, e.g. the event loop thread of an async view, and then its own thread again.
+    """
+    profiler = Profiler(enabled=True, directory=tmp_path, interval=0.001)
+    profiler.arm_route("/upload_files")
+    profile = profiler.start_request("/upload_files")
+    request_thread_id = profile.thread_id
+
+    def run_view() -> None:
+        with profile.follow_current_thread():
+            busy_function(0.05)
+
+    view_thread = threading.Thread(target=run_view)
+    view_thread.start()
+    view_thread.join()
+    assert profile.thread_id == request_thread_id
+    profiler.finish(profile)
+    assert any("run_view" in stack for stack in profile.samples)
@@ -0,0 +1,83 @@
+import pytest
+from langchain_community.chat_models.fake import FakeListChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+
+from chatdoc.question_condenser import QuestionCondenser
+
+CHAT_HISTORY = [
+    HumanMessage(content="Hoeveel vakantiedagen krijg ik per jaar?"),
+    AIMessage(content="Je krijgt vijfentwintig vakantiedagen per jaar."),
+]
+
+
+@pytest.fixture(name="condenser")
+def fixture_condenser():
+    """
+    Returns a question condenser whose chat model always gives the same rewrite.
+
+    Returns:
+        QuestionCondenser: The question condenser.
+    """
+    return QuestionCondenser(FakeListChatModel(responses=["Hoeveel vakantiedagen krijgen stagiairs per jaar?"]))
+
+
+def test_first_turn_is_not_rewritten(condenser):
+    """
+    Test that the question is passed through when there is no chat history.
+    """
+    assert condenser.condense("En stagiairs?", []) == "En stagiairs?"
+    assert condenser.last_outcome == "first_turn"
+
+
+def test_self_contained_question_is_not_rewritten(condenser):
+    """
+    Test that a self-contained follow-up question is passed through.
+    """
+    question = "Wat is de vergoeding voor reiskosten met het openbaar vervoer?"
+    assert condenser.condense(question, CHAT_HISTORY) == question
+    assert condenser.last_outcome == "self_contained"
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        "Wat is de regel die geldt voor thuiswerken?",
+        "Klopt het dat stagiairs een reiskostenvergoeding krijgen?",
+        "Welke medewerkers die parttime werken krijgen een vergoeding?",
+        "Is het waar dat het beleid in januari verandert?",
+    ],
+)
+def test_dutch_question_with_relative_pronoun_or_conjunction_is_self_contained(condenser, question):
+    """
+    Test that Dutch questions with die or dat as a relative pronoun or conjunction are passed through.
+    """
+    assert condenser.is_self_contained(question)
+
+
+def test_follow_up_question_is_rewritten_and_cached(condenser):
+    """
+    Test that a follow-up question is rewritten once and then served from the cache.
+    """
+    history = [*CHAT_HISTORY, HumanMessage(content="Een unieke vraag voor deze test")]
+    assert condenser.condense("En stagiairs?", history) == "Hoeveel vakantiedagen krijgen stagiairs per jaar?"
+    assert condenser.last_outcome == "rewritten"
+    assert condenser.condense("En stagiairs?", history) == "Hoeveel vakantiedagen krijgen stagiairs per jaar?"
+    assert condenser.last_outcome == "cache_hit"
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        "Geldt dit ook voor stagiairs van de opleiding?",
+        "Is die regeling ook van toepassing op parttimers?",
+        "Kan ik het nog aanvragen na mijn proeftijd?",
+        "Hoeveel dagen zijn dat dan voor een parttimer?",
+    ],
+)
+def test_dutch_follow_up_question_is_rewritten(condenser, question):
+    """
+    Test that Dutch follow-up questions that refer back with dit, dat, deze, die or het are rewritten.
+    """
+    assert not condenser.is_self_contained(question)
+    condenser.condense(question, CHAT_HISTORY)
+    assert condenser.last_outcome in ("rewritten", "cache_hit")
@@ -0,0 +1,125 @@
+"""
+Tests for the serialisation and compression of responses, and the compact prompt result
+"""
+import gzip
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import pytest
+from flask import Flask, send_file
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, HumanMessage
+
+from chatdoc.chatbot import Chatbot
+from chatdoc.context_packer import PackedContext
+from server_modules import responses
+from server_modules.responses import Compression, OrjsonProvider
+
+
+@dataclass
+class Point:
+    x: int
+    y: int
+
+
+def test_dumps_types_the_json_module_cannot():
+    body = responses.dumps(
+        {"when": datetime(2024, 1, 2, tzinfo=timezone.utc), "price": Decimal("2.40"), "point": Point(1, 2), 3: "x"}
+    )
+    assert body == b'{"when":"2024-01-02T00:00:00+00:00","price":"2.40","point":{"x":1,"y":2},"3":"x"}'
+
+
+def test_dumps_raises_on_unknown_types():
+    with pytest.raises(TypeError):
+        responses.dumps({"value": object()})
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, brotli_installed, expected",
+    [
+        ("gzip, deflate, br", True, "br"),
+        ("gzip, deflate, br", False, "gzip"),
+        ("br;q=0.5, gzip", True, "gzip"),
+        ("gzip;q=0", False, None),
+        ("*", False, "gzip"),
+        ("identity", True, None),
+        ("", True, None),
+    ],
+)
+def test_choose_encoding(monkeypatch, accept_encoding, brotli_installed, expected):
+    monkeypatch.setattr(responses, "brotli", object() if brotli_installed else None)
+    assert Compression.choose_encoding(accept_encoding) == expected
+
+
+def test_compress_above_threshold_only(monkeypatch):
+    monkeypatch.setattr(responses, "brotli", None)
+    compression = Compression(enabled=True, min_bytes=100, level=5)
+    small, large = b'{"a":1}', b'{"text":"' + b"citation " * 100 + b'"}'
+    assert compression.compress(small, "application/json", "gzip") == (small, None)
+    assert compression.compress(large, "image/png", "gzip") == (large, None)
+    body, encoding = compression.compress(large, "application/json", "gzip")
+    assert encoding == "gzip" and len(body) < len(large) and gzip.decompress(body) == large
+    assert Compression(enabled=False, min_bytes=0).compress(large, "application/json", "gzip") == (large, None)
+
+
+@pytest.fixture(name="client")
+def client_fixture(monkeypatch, tmp_path):
+    monkeypatch.setattr(responses, "brotli", None)
+    app = Flask(__name__)
+    app.json = OrjsonProvider(app)
+    Compression(enabled=True, min_bytes=100).init_app(app)
+    (tmp_path / "large.json").write_text("[" + "1," * 500 + "1]")
+
+    @app.route("/small")
+    def small():
+        return {"message": "ok"}
+
+    @app.route("/large")
+    def large():
+        return {"result": ["citation"] * 100}
+
+    @app.route("/file")
+    def file():
+        return send_file(tmp_path / "large.json")
+
+    return app.test_client()
+
+
+def test_flask_responses_are_compressed_when_accepted(client):
+    response = client.get("/large", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert int(response.headers["Content-Length"]) == len(response.data)
+    assert gzip.decompress(response.data) == responses.dumps({"result": ["citation"] * 100})
+    assert "Content-Encoding" not in client.get("/large").headers
+    assert client.get("/small", headers={"Accept-Encoding": "gzip"}).json == {"message": "ok"}
+    assert "Content-Encoding" not in client.get("/file", headers={"Accept-Encoding": "gzip"}).headers
+
+
+def test_prompt_result_refers_to_citations_instead_of_repeating_them():
+    chatbot = Chatbot.__new__(Chatbot)
+    documents = [
+        Document(
+            page_content="The pilot was a success.",
+            metadata={"source": "a.pdf", "page": 1, "ranking": 1, "score": 0.9},
+        )
+    ]
+    history = [HumanMessage(content="Hi"), AIMessage(content="Hello", additional_kwargs={"citations": []})]
+
+    result, messages = chatbot._build_result(  # pylint: disable=protected-access
+        "Was it a success?", "Was the pilot a success?", "Yes, it was.", PackedContext(documents, [])
+    )
+    assert [message["type"] for message in result["chat_history"]] == ["human", "ai"]
+    assert result["chat_history"][1]["data"]["additional_kwargs"] == {"citations_ref": "citations"}
+    assert result["citations"] and messages[1].additional_kwargs["citations"] == result["citations"]
+
+    result, _ = chatbot._build_result(  # pylint: disable=protected-access
+        "Was it a success?", "Was the pilot a success?", "Yes.", PackedContext(documents, []), history=history
+    )
+    assert [message["data"]["content"] for message in result["chat_history"]] == [
+        "Hi",
+        "Hello",
+        "Was it a success?",
+        "Yes.",
+    ]
@@ -0,0 +1,110 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from chatdoc.single_flight import SingleFlight
+
+
+def test_concurrent_calls_share_one_computation():
+    """
+    Test case to verify that concurrent calls for the same key wait for a single computation.
+    """
+    single_flight = SingleFlight()
+    computations = []
+    results = []
+
+    def compute() -> str:
+        computations.append(1)
+        time.sleep(0.2)
+        return "answer"
+
+    threads = [
+        threading.Thread(target=lambda: results.append(single_flight.do(("collection", "question", True), compute)))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(computations) == 1
+    assert results == ["answer"] * 5
+    assert single_flight.stats == {"leaders": 1, "coalesced": 4}
+
+
+def test_finished_computation_is_not_cached():
+    """
+    Test case to verify that a key is computed again once its computation has finished.
+    """
+    single_flight = SingleFlight()
+    assert single_flight.do("key", lambda: 1) == 1
+    assert single_flight.do("key", lambda: 2) == 2
+
+
+def test_error_is_shared_and_not_kept():
+    """
+    Test case to verify that the error of a computation is raised to its caller and the key is freed.
+    """
+    single_flight = SingleFlight()
+
+    def fail() -> None:
+        raise ConnectionError("backend unavailable")
+
+    with pytest.raises(ConnectionError):
+        single_flight.do("key", fail)
+    assert single_flight.do("key", lambda: "recovered") == "recovered"
+
+
+def test_concurrent_coroutines_share_one_computation():
+    """
+    Test case to verify that concurrent coroutines for the same key await a single computation.
+    """
+    single_flight = SingleFlight()
+    computations = []
+
+    async def compute() -> str:
+        computations.append(1)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def run() -> list[str]:
+        return await asyncio.gather(*(single_flight.ado("key", compute) for _ in range(5)))
+
+    assert asyncio.run(run()) == ["answer"] * 5
+    assert len(computations) == 1
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    """
+    Test case to verify that the computation goes on for the other callers when its first caller is cancelled,
+    and is only cancelled when all its callers are.
+    """
+    single_flight = SingleFlight()
+    cancelled = []
+
+    async def compute() -> str:
+        try:
+            await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+        return "answer"
+
+    async def run() -> str:
+        leader = asyncio.create_task(single_flight.ado("key", compute))
+        follower = asyncio.create_task(single_flight.ado("key", compute))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        answer = await follower
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        abandoned = asyncio.create_task(single_flight.ado("key", compute))
+        await asyncio.sleep(0.01)
+        abandoned.cancel()
+        await asyncio.sleep(0.01)
+        return answer
+
+    assert asyncio.run(run()) == "answer"
+    assert cancelled == [1]
+    assert single_flight.stats == {"leaders": 2, "coalesced": 1}
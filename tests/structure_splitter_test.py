@@ -0,0 +1,51 @@
+import pytest
+from langchain.schema.document import Document
+
+from chatdoc.doc_loader.structure_splitter import StructureAwareTextSplitter
+
+
+@pytest.fixture(name="splitter")
+def fixture_splitter():
+    """
+    Returns a structure-aware text splitter with a small chunk size.
+
+    Returns:
+        StructureAwareTextSplitter: The text splitter.
+    """
+    return StructureAwareTextSplitter(chunk_size=300, chunk_overlap=0)
+
+
+def test_paragraph_spanning_pages_is_merged(splitter):
+    """
+    Test that a paragraph continuing on the next page ends up in a single chunk with a page range.
+    """
+    pages = [
+        Document(page_content="3.2 Thuiswerken\nMedewerkers mogen twee dagen per week", metadata={"source": "policy.pdf", "page": 11}),
+        Document(page_content="thuiswerken na overleg met hun leidinggevende.", metadata={"source": "policy.pdf", "page": 12}),
+    ]
+    chunks = splitter.split_documents(pages)
+    assert len(chunks) == 1
+    assert "per week thuiswerken na overleg" in chunks[0].page_content
+    assert chunks[0].metadata["page"] == 11
+    assert chunks[0].metadata["page_end"] == 12
+    assert chunks[0].metadata["section"] == "§3.2"
+
+
+def test_heading_starts_new_chunk(splitter):
+    """
+    Test that headings are kept with their section and that the section path is tracked.
+    """
+    text = "1 Inleiding\nDit is de inleiding.\n\n1.1 Doel\nDit is het doel.\n\n2 Regels\nDit zijn de regels."
+    chunks = splitter.split_documents([Document(page_content=text, metadata={"source": "policy.pdf", "page": 0})])
+    assert [chunk.page_content.splitlines()[0] for chunk in chunks] == ["1 Inleiding", "1.1 Doel", "2 Regels"]
+    assert chunks[1].metadata["section_path"] == "1 Inleiding > 1.1 Doel"
+    assert chunks[2].metadata["section_path"] == "2 Regels"
+
+
+def test_table_and_list_detection(splitter):
+    """
+    Test that table rows and list items are classified as such.
+    """
+    assert splitter.classify_line("Naam   Dagen   Vergoeding")[0] == "table"
+    assert splitter.classify_line("- eerste punt")[0] == "list"
+    assert splitter.classify_line("Dit is een gewone zin.")[0] == "paragraph"
@@ -0,0 +1,117 @@
+"""
+Tests for the non-blocking, structured logging pipeline
+"""
+import json
+import logging
+import queue
+import sys
+
+import pytest
+
+from server_modules import set_logging_config
+from server_modules.structured_logging import (
+    ContextFilter,
+    JobProgress,
+    JsonFormatter,
+    NonBlockingQueueHandler,
+    bind_log_context,
+    end_request_context,
+    start_request_context,
+    stop_logging_pipeline,
+)
+
+
+def make_record(level: int = logging.INFO, **extra) -> logging.LogRecord:
+    record = logging.LogRecord("test", level, __file__, 1, "Processed %d files", (2,), None)
+    record.__dict__.update(extra)
+    return record
+
+
+@pytest.fixture(name="root_logger")
+def root_logger_fixture():
+    """
+    Restore the handlers and level of the root logger after a test.
+    """
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield root
+    stop_logging_pipeline()
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def test_json_record_has_context_and_extra_fields():
+    """
+    A record is formatted as JSON with the bound context and the fields passed with `extra`.
+    """
+    context_filter = ContextFilter()
+    with bind_log_context(upload_id="upload"):
+        tokens = start_request_context("request", "session", debug_sample_ratio=0)
+        record = make_record(event="progress")
+        assert context_filter.filter(record)
+        end_request_context(tokens)
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["message"] == "Processed 2 files"
+    assert entry["level"] == "INFO"
+    assert entry["upload_id"] == "upload"
+    assert entry["request_id"] == "request" and entry["session_id"] == "session"
+    assert entry["event"] == "progress"
+
+
+def test_debug_records_are_sampled_per_request():
+    """
+    The debug records of a request are kept or dropped together; info records are always kept.
+    """
+    context_filter = ContextFilter(debug_sample_ratio=0)
+    assert not context_filter.filter(make_record(logging.DEBUG))
+    tokens = start_request_context("request", "session", debug_sample_ratio=1)
+    assert context_filter.filter(make_record(logging.DEBUG))
+    end_request_context(tokens)
+    tokens = start_request_context("request", "session", debug_sample_ratio=0)
+    assert not context_filter.filter(make_record(logging.DEBUG))
+    assert context_filter.filter(make_record(logging.INFO))
+    end_request_context(tokens)
+
+
+def test_queue_handler_drops_records_when_full():
+    """
+    Records are rendered before they are queued, and dropped instead of blocking when the queue is full.
+    """
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=1))
+    try:
+        raise ValueError("failed")
+    except ValueError:
+        record = make_record()
+        record.exc_info = sys.exc_info()
+    handler.handle(record)
+    handler.handle(make_record())
+    assert handler.dropped == 1
+    queued = handler.queue.get_nowait()
+    assert queued.msg == "Processed 2 files" and queued.args is None
+    assert queued.exc_info is None and "ValueError: failed" in queued.exc_text
+
+
+def test_set_logging_config_writes_json_lines(tmp_path, monkeypatch, root_logger):
+    """
+    Records are written to the log file by the background thread.
+    """
+    monkeypatch.setenv("LOGGING_FORMAT", "json")
+    log_file = tmp_path / "logs" / "log.txt"
+    set_logging_config(str(log_file))
+    logging.getLogger("test").info("Hello %s", "world", extra={"event": "greeting"})
+    stop_logging_pipeline()
+    entry = json.loads(log_file.read_text(encoding="utf-8").splitlines()[-1])
+    assert entry["message"] == "Hello world" and entry["event"] == "greeting"
+
+
+def test_job_progress():
+    """
+    The progress of running jobs is kept until they finish.
+    """
+    progress = JobProgress()
+    progress.update("upload", "parse", 0, 2, file="report.pdf")
+    progress.update("upload", "embed", 0, 2, file="report.pdf", chunks=10)
+    (snapshot,) = progress.snapshot()
+    assert snapshot["stage"] == "embed" and snapshot["chunks"] == 10 and snapshot["total"] == 2
+    progress.finish("upload")
+    assert progress.snapshot() == []
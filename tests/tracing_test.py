@@ -0,0 +1,90 @@
+"""
+Tests for the tracing of requests, executor jobs and langchain calls
+"""
+import asyncio
+import threading
+from uuid import uuid4
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.outputs import LLMResult
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+from chatdoc.tracing import TracingCallbackHandler, end_request_span, start_request_span, tracer, with_trace_context
+
+
+exporter = InMemorySpanExporter()
+
+
+@pytest.fixture(name="spans", autouse=True)
+def spans_fixture():
+    """
+    Record the finished spans in memory.
+    """
+    if not isinstance(trace.get_tracer_provider(), TracerProvider):
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(exporter))
+        trace.set_tracer_provider(provider)
+    exporter.clear()
+    yield exporter
+    exporter.clear()
+
+
+def finished(spans: InMemorySpanExporter, name: str):
+    return next(span for span in spans.get_finished_spans() if span.name == name)
+
+
+def test_job_continues_trace_of_request(spans):
+    """
+    A job run in another thread is a child of the span current when it was submitted.
+    """
+    span, token = start_request_span("POST /upload_files", {})
+    job = with_trace_context(lambda: trace.get_current_span().get_span_context().trace_id, "process_files")
+    end_request_span(span, token)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(job()))
+    thread.start()
+    thread.join()
+    request_span, job_span = finished(spans, "POST /upload_files"), finished(spans, "process_files")
+    assert job_span.parent.span_id == request_span.context.span_id
+    assert results == [request_span.context.trace_id]
+
+
+def test_async_job_continues_trace(spans):
+    """
+    Coroutine functions stay coroutine functions and run in the span of their job.
+    """
+
+    async def process_files(upload_id: str) -> str:
+        return upload_id
+
+    with tracer.start_as_current_span("request"):
+        job = with_trace_context(process_files, "process_files", **{"upload.id": "upload"})
+    assert asyncio.run(job("upload")) == "upload"
+    job_span = finished(spans, "process_files")
+    assert job_span.parent.span_id == finished(spans, "request").context.span_id
+    assert job_span.attributes["upload.id"] == "upload"
+
+
+def test_callback_handler_spans(spans):
+    """
+    Retriever and chat model calls become spans, with the number of documents and tokens.
+    """
+    handler = TracingCallbackHandler()
+    retriever_run, llm_run = uuid4(), uuid4()
+    with tracer.start_as_current_span("prompt"):
+        handler.on_retriever_start({}, "question", run_id=retriever_run)
+        handler.on_retriever_end([Document(page_content="a"), Document(page_content="b")], run_id=retriever_run)
+        handler.on_llm_start({"id": ["langchain", "FakeChatModel"]}, ["prompt"], run_id=llm_run)
+        for token in ["Hel", "lo", "!"]:
+            handler.on_llm_new_token(token, run_id=llm_run)
+        handler.on_llm_end(LLMResult(generations=[]), run_id=llm_run)
+    prompt_span = finished(spans, "prompt")
+    retriever_span, llm_span = finished(spans, "retriever"), finished(spans, "llm")
+    assert retriever_span.attributes["retriever.documents"] == 2
+    assert llm_span.attributes["llm.completion_tokens"] == 3
+    assert llm_span.attributes["llm.model"] == "FakeChatModel"
+    assert retriever_span.parent.span_id == llm_span.parent.span_id == prompt_span.context.span_id
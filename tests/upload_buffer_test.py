@@ -0,0 +1,37 @@
+import io
+
+from pypdf import PdfWriter
+
+from chatdoc.doc_loader.document_loader_factory import DocumentLoaderFactory
+from chatdoc.doc_loader.upload_buffer import BufferedPDFLoader, MemoryViewStream, UploadBuffer
+
+
+def test_memoryview_stream_read_and_seek():
+    """
+    Test that the memoryview stream reads and seeks like a regular binary stream.
+    """
+    stream = MemoryViewStream(memoryview(b"0123456789"))
+    buffer = bytearray(4)
+    assert stream.readinto(buffer) == 4
+    assert bytes(buffer) == b"0123"
+    assert stream.seek(-2, io.SEEK_END) == 8
+    assert stream.read() == b"89"
+
+
+def test_buffered_pdf_loader_reads_from_memory():
+    """
+    Test that a PDF held in memory is loaded page by page with the upload name as its source.
+    """
+    pdf_writer = PdfWriter()
+    pdf_writer.add_blank_page(width=200, height=200)
+    pdf_writer.add_blank_page(width=200, height=200)
+    pdf_stream = io.BytesIO()
+    pdf_writer.write(pdf_stream)
+    buffer = UploadBuffer("policy.pdf", data=memoryview(pdf_stream.getvalue()))
+    loader = DocumentLoaderFactory().create_from_buffer(buffer)
+    assert isinstance(loader, BufferedPDFLoader)
+    documents = loader.load()
+    assert [document.metadata for document in documents] == [
+        {"source": "policy.pdf", "page": 0},
+        {"source": "policy.pdf", "page": 1},
+    ]
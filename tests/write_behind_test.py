@@ -0,0 +1,105 @@
+"""
+Tests for the write-behind buffer
+"""
+import sqlalchemy
+from sqlalchemy.exc import OperationalError
+
+from chatdoc.write_behind import WriteBehindBuffer, get_engine
+
+
+def insert(value: int):
+    def write(connection: sqlalchemy.Connection) -> None:
+        connection.execute(sqlalchemy.text("INSERT INTO item (value) VALUES (:value)"), {"value": value})
+
+    return write
+
+
+def stored(connection_string: str) -> list[int]:
+    with get_engine(connection_string).connect() as connection:
+        return connection.execute(sqlalchemy.text("SELECT value FROM item ORDER BY id")).scalars().all()
+
+
+def make_database(tmp_path, name: str = "items.db") -> str:
+    connection_string = f"sqlite:///{tmp_path / name}"
+    with get_engine(connection_string).begin() as connection:
+        connection.execute(sqlalchemy.text("CREATE TABLE item (id INTEGER PRIMARY KEY, value INTEGER)"))
+    return connection_string
+
+
+def test_writes_are_queued_until_flushed_in_order(tmp_path):
+    connection_string = make_database(tmp_path)
+    other_connection_string = make_database(tmp_path, "other.db")
+    buffer = WriteBehindBuffer(enabled=True, interval=60, max_pending=1000)
+    buffer.submit(connection_string, insert(1), key="a", items=["one"])
+    buffer.submit(other_connection_string, insert(2))
+    buffer.submit(connection_string, insert(3), key="a", items=["three"])
+
+    generation, pending = buffer.snapshot("a")
+    assert pending == ["one", "three"] and not stored(connection_string)
+    assert buffer.flush() == 3
+    assert stored(connection_string) == [1, 3] and stored(other_connection_string) == [2]
+    assert buffer.snapshot("a") == (generation + 2, [])
+    buffer.close()
+
+
+def test_unavailable_database_is_retried_and_failing_writes_are_dropped(tmp_path):
+    connection_string = make_database(tmp_path)
+    buffer = WriteBehindBuffer(enabled=True, interval=60, max_pending=1000)
+    attempts = []
+
+    def flaky(connection: sqlalchemy.Connection) -> None:
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise OperationalError("INSERT", {}, Exception("database is locked"))
+        insert(2)(connection)
+
+    def poison(connection: sqlalchemy.Connection) -> None:
+        raise ValueError("not a database problem")
+
+    buffer.submit(connection_string, insert(1), key="a", items=["one"])
+    buffer.submit(connection_string, flaky, key="a", items=["two"])
+    assert buffer.flush() == 0
+    assert not stored(connection_string) and buffer.snapshot("a")[1] == ["one", "two"]
+
+    buffer.submit(connection_string, poison)
+    buffer.submit(connection_string, insert(3))
+    assert buffer.flush() == 4
+    assert stored(connection_string) == [1, 2, 3] and buffer.snapshot("a")[1] == []
+    buffer.close()
+
+
+def test_background_thread_and_disabled_buffer(tmp_path):
+    connection_string = make_database(tmp_path)
+    buffer = WriteBehindBuffer(enabled=True, interval=0.01, max_pending=1000)
+    buffer.submit(connection_string, insert(1))
+    buffer.close()
+    assert stored(connection_string) == [1]
+
+    WriteBehindBuffer(enabled=False).submit(connection_string, insert(2))
+    assert stored(connection_string) == [1, 2]
+
+
+def test_write_errors_are_not_retried_and_retries_are_capped(tmp_path):
+    connection_string = make_database(tmp_path)
+    buffer = WriteBehindBuffer(enabled=True, interval=60, max_pending=1000, max_retries=2)
+
+    def missing_table(connection: sqlalchemy.Connection) -> None:
+        connection.execute(sqlalchemy.text("INSERT INTO missing (value) VALUES (1)"))
+
+    buffer.submit(connection_string, missing_table)
+    buffer.submit(connection_string, insert(1))
+    assert buffer.flush() == 2
+    assert stored(connection_string) == [1]
+
+    attempts = []
+
+    def locked(connection: sqlalchemy.Connection) -> None:
+        attempts.append(1)
+        raise OperationalError("INSERT", {}, Exception("database is locked"))
+
+    buffer.submit(connection_string, locked, key="a", items=["locked"])
+    for _ in range(5):
+        buffer.flush()
+    assert len(attempts) == 3
+    assert buffer.snapshot("a")[1] == [] and stored(connection_string) == [1]
+    buffer.close()